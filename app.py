@@ -1,163 +1,644 @@
 import os
-import re
 import json
+import math
+import time
+import hmac
+import hashlib
+import functools
 import logging
-from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response
-from flask_sqlalchemy import SQLAlchemy
-from flask_wtf.csrf import CSRFProtect
-import requests
-import trafilatura
-from sqlalchemy.dialects.postgresql import JSONB
-
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+import click
+import tempfile
+import weakref
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context, session, send_file, make_response
+from sqlalchemy import tuple_, select, literal, update
+from sqlalchemy.exc import DataError
+from sqlalchemy.orm import load_only
+from sqlalchemy.orm.attributes import set_committed_value, flag_modified
+from config import load_config
+from extensions import db, csrf
+from models import Message, PublishedSnapshot, lineage_root_id, lineage_ids
+from llm_client import LLMClient, LLMError, UpstreamCooldown
+from jobs import JobQueue, JobError, QueueFullError
+from ingest import ContentIngestor
+from importer import IMPORT_MODES, normalize_template, parse_import_payload, prepare_import, import_records
+from serving import PromptCache, compile_prompt
+from metrics import Metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from catalog import write_catalog
+from version_store import (VersionStore, DeltaBaseMismatch, CONTENT_FIELDS, PLACEHOLDERS, content_digest, json_diff,
+                           apply_patch, plan_lineage, encoded_size)
+from extraction import ExtractionError, extract_json, check_template_fields
+from prompt_compiler import compile_optimization_prompt
+from similarity import SimilarityIndex, INDEXED_FIELDS
+from patching import JSON_PATCH_MIMETYPE, PatchError, compile_json_patch, compile_merge_patch
+from exporter import EXPORT_MIMETYPES, render_message_xml, ndjson_stream, json_array_stream, zip_stream
+import migrations
+
 logger = logging.getLogger(__name__)
 
-# Initialize Flask app
-app = Flask(__name__)
-app.secret_key = os.environ.get("FLASK_SECRET_KEY", "dev")
-
-# Database configuration with enhanced connection settings
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_pre_ping": True,           # Enable connection pre-ping
-    "pool_recycle": 300,             # Recycle connections every 5 minutes
-    "pool_timeout": 30,              # Connection timeout of 30 seconds
-    "max_overflow": 10,              # Allow up to 10 connections over pool size
-    "pool_size": 5,                  # Maintain a pool of 5 connections
-    "connect_args": {
-        "connect_timeout": 10,        # PostgreSQL connection timeout
-        "keepalives": 1,             # Enable keepalive
-        "keepalives_idle": 30,       # Idle time before sending keepalive
-        "keepalives_interval": 10,    # Interval between keepalives
-        "keepalives_count": 5        # Number of keepalive attempts
-    }
-}
-
-# Initialize extensions
-db = SQLAlchemy(app)
-csrf = CSRFProtect(app)
-
-# Add more detailed logging for database operations
-def init_db_logging():
-    logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
-    logging.getLogger('sqlalchemy.pool').setLevel(logging.DEBUG)
-
-init_db_logging()
-
-class Message(db.Model):
-    __tablename__ = 'system_message'  # Match the table name from models.py
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    bio = db.Column(db.Text, nullable=False)
-    voice_style = db.Column(db.Text, nullable=False)
-    persona = db.Column(JSONB, nullable=False)
-    rules = db.Column(JSONB, nullable=False)
-    instructions = db.Column(JSONB, nullable=False)
-    example_dialogue = db.Column(JSONB, nullable=False)
-    published = db.Column(db.Boolean, default=False)
-    published_at = db.Column(db.DateTime)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    original_id = db.Column(db.Integer, db.ForeignKey('system_message.id'), nullable=True)
-    version_number = db.Column(db.Integer, default=1)
-    version_note = db.Column(db.Text)
-
-    # Add relationship for version tracking
-    copies = db.relationship(
-        'Message',
-        backref=db.backref('original', remote_side=[id]),
-        foreign_keys=[original_id]
+# Unbound until create_app(); views reach the app through current_app
+llm = LLMClient()
+jobs = JobQueue()
+ingestor = ContentIngestor()
+prompts = PromptCache()
+versions = VersionStore()
+similarity = SimilarityIndex()
+metrics = Metrics()
+
+bp = Blueprint('main', __name__, cli_group=None)
+
+def decode_delta(connection, base_id, delta):
+    """Rebuild delta-stored content from its (cached) full base version.
+
+    Raises DeltaBaseMismatch when the base no longer holds the content the
+    delta was encoded against, rather than returning wrong content.
+    """
+    base_hash = delta.get('base_hash')
+    key = (base_id, base_hash or delta['base_updated_at'])
+    base = versions.cached_base(key)
+    if base is None:
+        row = connection.execute(
+            select(*[getattr(Message, field) for field in CONTENT_FIELDS], Message.updated_at)
+            .where(Message.id == base_id)
+        ).one()
+        base = {field: getattr(row, field) for field in CONTENT_FIELDS}
+        if base_hash is not None:
+            if content_digest(base) != base_hash:
+                raise DeltaBaseMismatch(f"Delta base {base_id} changed after versions were encoded against it")
+        elif row.updated_at.isoformat() != delta['base_updated_at']:
+            # Deltas from before base hashes were recorded can only be checked by updated_at, which also
+            # moves on publish and other non-content edits; `flask pack-versions` re-encodes them with hashes
+            logger.warning(f"Delta base {base_id} was updated after it was encoded against; "
+                           f"run flask pack-versions to verify")
+        versions.remember_base(key, base)
+    return apply_patch(base, delta['ops'])
+
+def decode_loaded_delta(target, session, attrs=None):
+    state = target.__dict__
+    if attrs is not None and not set(attrs) & set(CONTENT_FIELDS):
+        return
+    if 'bio' not in state or state.get('delta_base_id') is None or state.get('delta') is None:
+        return
+    content = decode_delta(session.connection(), state['delta_base_id'], state['delta'])
+    for field in CONTENT_FIELDS:
+        set_committed_value(target, field, content[field])
+
+@db.event.listens_for(Message, 'load')
+def decode_delta_on_load(target, context):
+    decode_loaded_delta(target, context.session)
+
+@db.event.listens_for(Message, 'refresh')
+def decode_delta_on_refresh(target, context, attrs):
+    decode_loaded_delta(target, context.session, attrs)
+
+def store_in_full(session, condition):
+    """Decode and store in full every delta-stored version matching condition"""
+    connection = session.connection()
+    rows = connection.execute(
+        select(Message.id, Message.delta_base_id, Message.delta, Message.updated_at)
+        .where(condition, Message.delta_base_id.isnot(None))
+    ).all()
+    for row in rows:
+        content = decode_delta(connection, row.delta_base_id, row.delta)
+        # Storage-only change: keep updated_at as it was
+        connection.execute(update(Message.__table__).where(Message.__table__.c.id == row.id)
+                           .values(**content, delta_base_id=None, delta=None, updated_at=row.updated_at))
+        loaded = session.identity_map.get(db.inspect(Message).identity_key_from_primary_key((row.id,)))
+        if loaded is not None:
+            set_committed_value(loaded, 'delta_base_id', None)
+            set_committed_value(loaded, 'delta', None)
+
+def unpack_dependents(session, base_id):
+    """Store every version encoded against base_id in full again (before base_id changes)"""
+    store_in_full(session, Message.delta_base_id == base_id)
+
+@db.event.listens_for(db.session, 'before_flush')
+def unpack_changed_versions(session, flush_context, instances):
+    """Edited delta-stored versions are written in full again, and versions encoded
+    against an edited or deleted version are decoded first"""
+    with session.no_autoflush:
+        for message in list(session.dirty):
+            if not isinstance(message, Message):
+                continue
+            state = db.inspect(message)
+            if not any(state.attrs[field].history.has_changes() for field in CONTENT_FIELDS):
+                continue
+            if message.delta_base_id is not None:
+                message.delta_base_id = None
+                message.delta = None
+                for field in CONTENT_FIELDS:
+                    flag_modified(message, field)
+            unpack_dependents(session, message.id)
+        for message in list(session.deleted):
+            if isinstance(message, Message):
+                unpack_dependents(session, message.id)
+
+def indexed_content(message):
+    return {field: getattr(message, field) for field in INDEXED_FIELDS}
+
+@db.event.listens_for(db.session, 'after_flush')
+def collect_similarity_changes(session, flush_context):
+    """Capture the indexed content of created, edited and deleted templates for the similarity index"""
+    changes = session.info.setdefault('similarity_changes', {})
+    for message in session.new:
+        if isinstance(message, Message):
+            changes[message.id] = (message.original_id or message.id, indexed_content(message))
+    for message in session.dirty:
+        if not isinstance(message, Message):
+            continue
+        state = db.inspect(message)
+        if any(state.attrs[field].history.has_changes() for field in INDEXED_FIELDS + ('original_id',)):
+            changes[message.id] = (message.original_id or message.id, indexed_content(message))
+    for message in session.deleted:
+        if isinstance(message, Message):
+            changes[message.id] = None
+
+@db.event.listens_for(db.session, 'after_commit')
+def apply_similarity_changes(session):
+    for id, change in session.info.pop('similarity_changes', {}).items():
+        if change is None:
+            similarity.remove(id)
+        else:
+            similarity.update(id, *change)
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discard_similarity_changes(session):
+    session.info.pop('similarity_changes', None)
+
+def indexed_templates():
+    """Yield (id, lineage root id, indexed content) for every template, decoding delta-stored versions"""
+    connection = db.session.connection()
+    rows = connection.execute(
+        select(Message.id, Message.original_id, Message.delta_base_id, Message.delta,
+               *[getattr(Message, field) for field in INDEXED_FIELDS])
+        .execution_options(yield_per=current_app.config["EXPORT_BATCH_SIZE"])
     )
-
-    def to_dict(self):
-        """Convert message to dictionary format"""
-        return {
-            'id': self.id,
-            'name': self.name,
-            'bio': self.bio,
-            'voice_style': self.voice_style,
-            'persona': self.persona,
-            'rules': self.rules,
-            'instructions': self.instructions,
-            'example_dialogue': self.example_dialogue,
-            'published': self.published,
-            'published_at': self.published_at.isoformat() if self.published_at else None,
-            'created_at': self.created_at.isoformat(),
-            'updated_at': self.updated_at.isoformat(),
-            'original_id': self.original_id,
-            'version_number': self.version_number,
-            'version_note': self.version_note
-        }
-
-    def get_version_history(self):
-        """Get the complete version history of this message"""
-        if self.original_id:
-            # This is a copy, start from the original
-            original = Message.query.get(self.original_id)
-            if original:
-                return original.get_version_history()
-            return [self]  # Original not found, return just this message
+    for row in rows:
+        if row.delta_base_id is not None:
+            content = decode_delta(connection, row.delta_base_id, row.delta)
+            content = {field: content[field] for field in INDEXED_FIELDS}
         else:
-            # This is an original, get all copies
-            versions = [self]
-            for copy in self.copies:
-                versions.append(copy)
-            return sorted(versions, key=lambda x: x.version_number)
-
-# Create all database tables
-with app.app_context():
+            content = {field: getattr(row, field) for field in INDEXED_FIELDS}
+        yield row.id, row.original_id or row.id, content
+
+def pack_lineage(id, full=False):
+    """Re-encode the lineage containing id for the configured version storage.
+
+    With full=True every version is stored in full. Runs in the current
+    transaction; the caller commits. Returns storage statistics.
+    """
+    connection = db.session.connection()
+    rows = connection.execute(
+        select(Message.id, Message.updated_at, Message.delta_base_id, Message.delta,
+               *[getattr(Message, field) for field in CONTENT_FIELDS])
+        .where(Message.id.in_(lineage_ids(id)))
+        .order_by(Message.version_number, Message.id)
+    ).all()
+    stored = {row.id: row.delta if row.delta_base_id is not None else {field: getattr(row, field) for field in CONTENT_FIELDS}
+              for row in rows}
+    contents = {row.id: decode_delta(connection, row.delta_base_id, row.delta) if row.delta_base_id is not None
+                else stored[row.id] for row in rows}
+    if full:
+        plan = {row.id: None for row in rows}
+    else:
+        plan = plan_lineage([(row.id, contents[row.id]) for row in rows], versions.interval)
+
+    table = Message.__table__
+    stats = {'versions': len(rows), 'deltas': 0, 'bytes_before': 0, 'bytes_after': 0}
+    for row in rows:
+        stats['bytes_before'] += encoded_size(stored[row.id])
+        if plan[row.id] is None:
+            stats['bytes_after'] += encoded_size(contents[row.id])
+            if row.delta_base_id is not None:
+                connection.execute(update(table).where(table.c.id == row.id).values(
+                    **contents[row.id], delta_base_id=None, delta=None, updated_at=row.updated_at))
+            continue
+        base_id, ops = plan[row.id]
+        delta = {'base_hash': content_digest(contents[base_id]), 'ops': ops}
+        stats['deltas'] += 1
+        stats['bytes_after'] += encoded_size(delta)
+        if row.delta_base_id != base_id or row.delta != delta:
+            connection.execute(update(table).where(table.c.id == row.id).values(
+                **PLACEHOLDERS, delta_base_id=base_id, delta=delta, updated_at=row.updated_at))
+    return stats
+
+def upgrade_schema():
+    """Create missing tables, then apply the idempotent migrations (needs an app context)"""
     db.create_all()
-    logger.info("Database tables created successfully")
+    migrations.upgrade(db)
+    logger.info("Database schema is up to date")
+
+@bp.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create missing tables and apply schema migrations."""
+    upgrade_schema()
+    click.echo('Database schema is up to date')
+
+# Columns needed to validate a client's cached copy of a template
+VALIDATOR_COLUMNS = (Message.id, Message.updated_at, Message.version_number, Message.published)
+
+def load_validators(id):
+    """Load only the columns that identify a template revision (404 if missing)"""
+    return Message.query.options(load_only(*VALIDATOR_COLUMNS)).get_or_404(id)
+
+def template_etag(message, variant, *extra):
+    """Strong ETag from id + updated_at + version_number, distinct per representation"""
+    updated_at = message.updated_at.isoformat() if message.updated_at else ''
+    parts = [str(message.id), updated_at, str(message.version_number), variant, *map(str, extra)]
+    return hashlib.sha1(':'.join(parts).encode('utf-8')).hexdigest()
+
+def template_last_modified(message):
+    if message.updated_at is None:
+        return None
+    return message.updated_at.replace(tzinfo=timezone.utc)
+
+def is_not_modified(etag, last_modified=None):
+    """Evaluate If-None-Match (preferred) or If-Modified-Since against the current validators"""
+    if request.if_none_match:
+        return etag in request.if_none_match
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+def cache_headers(response, message, variant, editable=False):
+    """Attach validators and the Cache-Control policy for this template's publish state.
+
+    editable=True is for reads the editor saves back with If-Match: those are
+    always revalidated, so a cached copy never hands it a stale ETag.
+    """
+    response.set_etag(template_etag(message, variant))
+    response.last_modified = template_last_modified(message)
+    response.headers['Cache-Control'] = (current_app.config["PUBLISHED_CACHE_CONTROL"]
+                                         if message.published and not editable
+                                         else current_app.config["DRAFT_CACHE_CONTROL"])
+    return response
+
+def not_modified_response(message, variant, editable=False):
+    """A 304 for this representation if the client's copy is current, otherwise None"""
+    if is_not_modified(template_etag(message, variant), template_last_modified(message)):
+        return cache_headers(Response(status=304), message, variant, editable)
+    return None
+
+def api_route(view):
+    """Let scripts and other systems call a JSON route with an API token instead of a CSRF token.
+
+    A request with ``Authorization: Bearer <API_TOKEN>`` skips the CSRF check
+    (browsers never attach that header on their own); any other request needs
+    a CSRF token as usual. With API_TOKEN unset only the latter is accepted.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer':
+            expected = current_app.config["API_TOKEN"]
+            if not expected or not hmac.compare_digest(token.strip().encode(), expected.encode()):
+                return jsonify({'error': 'Invalid API token'}), 401
+        else:
+            csrf.protect()
+        return view(*args, **kwargs)
+    return csrf.exempt(wrapper)
 
-@app.route('/')
+@bp.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/messages')
+# Columns needed to render a template in a listing; the JSONB content is left unloaded
+LIST_COLUMNS = (Message.id, Message.name, Message.created_at, Message.published)
+
+def encode_cursor(message):
+    return f"{message.created_at.isoformat()}_{message.id}"
+
+def decode_cursor(cursor):
+    """Parse a (created_at, id) keyset cursor; raises ValueError when malformed"""
+    created_at, _, id = cursor.rpartition('_')
+    return datetime.fromisoformat(created_at), int(id)
+
+def keyset_page(query, cursor, limit):
+    """Return (items, next_cursor) for the page after cursor, newest first"""
+    query = query.order_by(Message.created_at.desc(), Message.id.desc())
+    if cursor:
+        query = query.filter(tuple_(Message.created_at, Message.id) < decode_cursor(cursor))
+    items = query.limit(limit + 1).all()
+    next_cursor = encode_cursor(items[limit - 1]) if len(items) > limit else None
+    return items[:limit], next_cursor
+
+def requested_page_size():
+    return max(1, min(request.args.get('limit', current_app.config["PAGE_SIZE"], type=int), current_app.config["MAX_PAGE_SIZE"]))
+
+def search_filters():
+    """Read search criteria from the query string.
+
+    ``q`` is a web-style full-text query; ``persona.<key>=<value>`` and ``rule``
+    become JSONB containment filters; ``published`` is 1 or 0.
+    """
+    persona = {key[len('persona.'):]: value for key, value in request.args.items()
+               if key.startswith('persona.') and value}
+    published = request.args.get('published')
+    return {
+        'q': request.args.get('q', '').strip(),
+        'persona': persona,
+        'rule': request.args.get('rule', '').strip(),
+        'published': None if published in (None, '') else published in ('1', 'true')
+    }
+
+def search_templates(filters, limit, offset):
+    """Ranked template search; returns ([(message, rank)], has_more)"""
+    query = Message.query.options(load_only(*LIST_COLUMNS))
+    if filters['q'] or filters['persona'] or filters['rule']:
+        # Delta-stored versions keep only placeholders in the content columns (and so in
+        # search_vector), which would never match, or match any containment filter on {}
+        query = query.filter(Message.delta_base_id.is_(None))
+    rank = literal(0.0)
+    if filters['q']:
+        ts_query = db.func.websearch_to_tsquery('english', filters['q'])
+        query = query.filter(Message.search_vector.op('@@')(ts_query))
+        rank = db.func.ts_rank_cd(Message.search_vector, ts_query)
+    if filters['persona']:
+        query = query.filter(Message.persona.contains(filters['persona']))
+    if filters['rule']:
+        query = query.filter(Message.rules.contains([filters['rule']]))
+    if filters['published'] is not None:
+        query = query.filter(Message.published.is_(filters['published']))
+
+    rows = (query.add_columns(rank.label('rank'))
+            .order_by(db.desc('rank'), Message.created_at.desc(), Message.id.desc())
+            .offset(offset).limit(limit + 1).all())
+    return rows[:limit], len(rows) > limit
+
+def is_search_request(filters):
+    return bool(filters['q'] or filters['persona'] or filters['rule'] or filters['published'] is not None)
+
+@bp.route('/messages')
 def list_messages():
     try:
-        messages = Message.query.order_by(Message.created_at.desc()).all()
+        filters = search_filters()
+        if is_search_request(filters):
+            page = max(request.args.get('page', 1, type=int), 1)
+            limit = requested_page_size()
+            rows, has_more = search_templates(filters, limit, (page - 1) * limit)
+            return render_template('list.html', messages=[message for message, _ in rows], next_cursor=None,
+                                   paginated=False, search=filters, page=page, has_more=has_more)
+
+        query = Message.query.options(load_only(*LIST_COLUMNS))
+        messages, next_cursor = keyset_page(query, request.args.get('cursor'), requested_page_size())
         logger.debug(f"Found {len(messages)} messages")
-        for msg in messages:
-            logger.debug(f"Message ID: {msg.id}, Name: {msg.name}")
-        return render_template('list.html', messages=messages)
+        return render_template('list.html', messages=messages, next_cursor=next_cursor,
+                               paginated=bool(request.args.get('cursor')))
     except Exception as e:
         logger.error(f"Error fetching messages: {e}", exc_info=True)
         flash('Error loading messages', 'error')
-        return render_template('list.html', messages=[])
-
-@app.route('/messages/<int:id>/delete', methods=['GET', 'POST'])
+        return render_template('list.html', messages=[], next_cursor=None, paginated=False)
+
+@bp.route('/templates/search')
+def search_templates_api():
+    """Route for ranked, paginated template search (full-text plus JSONB containment)"""
+    filters = search_filters()
+    page = max(request.args.get('page', 1, type=int), 1)
+    limit = requested_page_size()
+    try:
+        rows, has_more = search_templates(filters, limit, (page - 1) * limit)
+    except Exception as e:
+        logger.error(f"Error searching templates: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+    return jsonify({
+        'items': [{
+            'id': message.id,
+            'name': message.name,
+            'published': message.published,
+            'created_at': message.created_at.isoformat() if message.created_at else None,
+            'rank': round(float(rank), 6)
+        } for message, rank in rows],
+        'page': page,
+        'has_more': has_more
+    })
+
+@bp.route('/messages/<int:id>/delete', methods=['GET', 'POST'])
 def delete_message(id):
     message = Message.query.get_or_404(id)
     try:
         db.session.delete(message)
         db.session.commit()
+        prompts.invalidate(id)
         flash('Message deleted successfully', 'success')
     except Exception as e:
         logger.error(f"Error deleting message: {e}")
         db.session.rollback()
         flash('Error deleting message', 'error')
-    return redirect(url_for('list_messages'))
+    return redirect(url_for('main.list_messages'))
 
-@app.route('/generate-template')
+@bp.route('/generate-template')
 def generate_template():
     return render_template('generate.html')
 
-@app.route('/messages/<int:id>')
+@bp.route('/messages/<int:id>')
 def preview_message(id):
-    message = Message.query.get_or_404(id)
-    return render_template('preview.html', message=message)
+    message = load_validators(id)
+    versions = message.get_version_history()
+    # The page also lists the lineage and embeds CSRF tokens, so both feed the ETag.
+    # Tokens expire after WTF_CSRF_TIME_LIMIT, so a cached page is reused for at
+    # most half of that.
+    time_limit = current_app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+    csrf_window = int(time.time() // (time_limit / 2)) if time_limit else 0
+    lineage = [(version.id, version.version_number, version.name, version.published) for version in versions]
+    flashes = session.get('_flashes')
+    etag = template_etag(message, 'html', lineage, session.get('csrf_token'), csrf_window)
+    if not flashes and is_not_modified(etag):
+        response = Response(status=304)
+    else:
+        db.session.refresh(message)
+        response = make_response(render_template('preview.html', message=message, versions=versions))
+        # Rendering may have issued the session's first CSRF token
+        etag = template_etag(message, 'html', lineage, session.get('csrf_token'), csrf_window)
+    # Pages carrying one-off flash messages are never reused
+    if not flashes:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@bp.route('/messages/<int:id>/versions')
+def message_versions(id):
+    """Route to list every version in a message's lineage (lightweight columns only)"""
+    message = Message.query.options(load_only(Message.id)).get_or_404(id)
+    return jsonify([version.version_summary() for version in message.get_version_history()])
+
+@bp.route('/messages/<int:id>/diff/<int:other_id>')
+def diff_messages(id, other_id):
+    """Route to get the JSON Patch (RFC 6902) that turns one version's content into another's"""
+    source = Message.query.get_or_404(id)
+    target = Message.query.get_or_404(other_id)
+    document = lambda message: dict({field: getattr(message, field) for field in CONTENT_FIELDS}, name=message.name)
+    return jsonify({'from': id, 'to': other_id, 'patch': json_diff(document(source), document(target))})
+
+def template_names(ids):
+    rows = db.session.execute(
+        select(Message.id, Message.name, Message.version_number).where(Message.id.in_(ids))
+    ).all()
+    return {row.id: {'id': row.id, 'name': row.name, 'version_number': row.version_number} for row in rows}
+
+def similarity_building():
+    response = jsonify({'error': 'The similarity index is being built, try again shortly'})
+    response.headers['Retry-After'] = '5'
+    return response, 503
+
+@bp.route('/templates/<int:id>/similar')
+def similar_templates(id):
+    """Route to find the templates most similar to one (?k=10&exclude_lineage=1 skips its own versions)"""
+    if not similarity.refresh(indexed_templates):
+        return similarity_building()
+    k = max(1, min(request.args.get('k', 10, type=int), current_app.config["MAX_PAGE_SIZE"]))
+    matches = similarity.similar(id, k, exclude_lineage=request.args.get('exclude_lineage') == '1')
+    if matches is None:
+        return jsonify({'error': 'Template not found'}), 404
+    names = template_names([match_id for match_id, _, _ in matches])
+    return jsonify({
+        'id': id,
+        'similar': [dict(names[match_id], score=round(score, 4), same_lineage=same_lineage)
+                    for match_id, score, same_lineage in matches if match_id in names]
+    })
+
+@bp.route('/templates/duplicates')
+def duplicate_templates():
+    """Route to report groups of near-duplicate templates.
+
+    ?threshold= is the cosine similarity that makes two templates duplicates,
+    ?include_versions=1 also pairs versions of the same lineage, ?limit= caps
+    the number of groups returned (largest first).
+    """
+    if not similarity.refresh(indexed_templates):
+        return similarity_building()
+    threshold = request.args.get('threshold', current_app.config["SIMILARITY_DUPLICATE_THRESHOLD"], type=float)
+    if not 0 < threshold <= 1:
+        return jsonify({'error': 'threshold must be in (0, 1]'}), 400
+    limit = max(1, min(request.args.get('limit', 50, type=int), current_app.config["MAX_PAGE_SIZE"]))
+    groups = similarity.duplicate_groups(threshold, include_lineage=request.args.get('include_versions') == '1')
+    names = template_names([id for group in groups[:limit] for id in group['ids']])
+    return jsonify({
+        'threshold': threshold,
+        'total_groups': len(groups),
+        'groups': [{
+            'templates': [names[id] for id in group['ids'] if id in names],
+            'pairs': group['pairs'],
+            'max_score': group['max_score'],
+            'min_score': group['min_score']
+        } for group in groups[:limit]]
+    })
+
+@bp.cli.command('pack-versions')
+@click.option('--full', is_flag=True, help='Store every version in full again (before leaving delta mode)')
+def pack_versions_command(full):
+    """Re-encode every version lineage for the configured version storage"""
+    if not full and not versions.enabled:
+        raise click.UsageError('VERSION_STORAGE is not "delta"; pass --full to decode stored deltas')
+    # Lineage roots that have at least one copy
+    roots = db.session.scalars(
+        select(Message.id).where(Message.original_id.is_(None),
+                                 Message.id.in_(select(Message.original_id).where(Message.original_id.isnot(None))))
+    ).all()
+    totals = {'lineages': 0, 'versions': 0, 'deltas': 0, 'bytes_before': 0, 'bytes_after': 0}
+    for root_id in roots:
+        stats = pack_lineage(root_id, full=full)
+        db.session.commit()
+        totals['lineages'] += 1
+        for key, value in stats.items():
+            totals[key] += value
+    click.echo(json.dumps(totals, indent=2))
 
-@app.route('/optimize')
+@bp.route('/optimize')
 def optimize_view():
     """Route for the schema optimization interface"""
-    messages = Message.query.order_by(Message.created_at.desc()).all()
-    return render_template('optimize.html', messages=messages)
+    query = Message.query.options(load_only(Message.id, Message.name, Message.created_at))
+    messages, next_cursor = keyset_page(query, None, current_app.config["PAGE_SIZE"])
+    return render_template('optimize.html', messages=messages, next_cursor=next_cursor)
 
-@app.route('/optimize-schema/<int:id>', methods=['POST'])
+@bp.route('/templates/options')
+def template_options():
+    """Route to page through template names for the optimize picker ("load more")"""
+    try:
+        query = Message.query.options(load_only(Message.id, Message.name, Message.created_at))
+        messages, next_cursor = keyset_page(query, request.args.get('cursor'), requested_page_size())
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    return jsonify({
+        'items': [{'id': m.id, 'name': m.name} for m in messages],
+        'next_cursor': next_cursor
+    })
+
+OPTIMIZER_SYSTEM_PROMPT = 'You are an expert in optimizing message templates. Return only valid JSON with the exact fields that need updating. You can add new rules, modify dialogue, or update any part of the template.'
+
+TEMPLATE_FIELDS = ('rules', 'bio', 'voice_style', 'persona', 'instructions', 'example_dialogue')
+
+def parse_template_updates(content):
+    """Extract the template updates from an LLM response, or None"""
+    try:
+        updates = extract_json(content, check_template_fields)
+    except ExtractionError as e:
+        logger.error(f"Failed to parse updates: {e}")
+        return None
+    # Normalize only the fields present so the rest of the template is left alone
+    normalized = normalize_template(updates)
+    return {field: normalized[field] for field in updates}
+
+def apply_template_updates(message, updates):
+    """Copy the updated template fields onto the message and bump updated_at"""
+    for field in TEMPLATE_FIELDS:
+        if field in updates:
+            setattr(message, field, updates[field])
+    message.updated_at = datetime.utcnow()
+
+def build_optimization_prompt(message, custom_request):
+    """Compile the optimization prompt for a template and a custom request (see prompt_compiler)"""
+    return compile_optimization_prompt(message, custom_request, current_app.config["PROMPT_TOKEN_BUDGET"],
+                                       select_fields=current_app.config["PROMPT_SELECT_FIELDS"])
+
+def editable_updates(updates, editable):
+    """Drop updates to fields the model was not shown in full"""
+    ignored = [field for field in updates if field not in editable]
+    if ignored:
+        logger.warning(f"Ignoring updates to fields outside the optimization prompt: {', '.join(ignored)}")
+    return {field: value for field, value in updates.items() if field in editable}
+
+def run_optimization_job(id, prompt, expected_updated_at, editable=TEMPLATE_FIELDS):
+    """Background job: ask the LLM for template updates and apply them.
+
+    No DB connection is held during the LLM call; the session is only used for
+    the short load-apply-commit step at the end.
+    """
+    logger.debug("Sending optimization request to Perplexity API")
+    llm_messages = [
+        {'role': 'system', 'content': OPTIMIZER_SYSTEM_PROMPT},
+        {'role': 'user', 'content': prompt}
+    ]
+    try:
+        content = llm.chat(llm_messages, route='optimize')
+    except LLMError as e:
+        logger.error(f"API Error: {e}")
+        raise JobError('Failed to optimize template', e.status_code)
+
+    logger.debug(f"Raw content from API: {content}")
+
+    # Extract JSON from the response
+    updates = parse_template_updates(content)
+    if updates is None:
+        llm.discard(llm_messages, route='optimize')
+        raise JobError('Failed to parse optimization updates')
+    updates = editable_updates(updates, editable)
+
+    message = db.session.get(Message, id)
+    if message is None:
+        raise JobError('Template not found', 404)
+    if message.updated_at != expected_updated_at:
+        raise JobError('Template was modified while the optimization was running', 409)
+
+    apply_template_updates(message, updates)
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return {'success': True, 'template_id': id, 'message': 'Template updated successfully'}
+
+@bp.route('/optimize-schema/<int:id>', methods=['POST'])
 def optimize_schema(id):
     try:
         message = Message.query.get_or_404(id)
@@ -171,133 +652,182 @@ def optimize_schema(id):
         logger.info(f"Optimization request received for template {id}: {custom_request}")
 
         # Construct optimization prompt
-        prompt = f"""Analyze and modify this template based on the following request:
-{custom_request}
-
-Current Template:
-Bio: {message.bio}
-Voice Style: {message.voice_style}
-Persona: {json.dumps(message.persona, indent=2)}
-Rules: {json.dumps(message.rules, indent=2)}
-Instructions: {json.dumps(message.instructions, indent=2)}
-Example Dialogue: {json.dumps(message.example_dialogue, indent=2)}
-
-Return a JSON object containing ONLY the fields that need to be updated:
-{{
-    "rules": ["list of all rules including any new ones"],
-    "bio": "only if it needs updating",
-    "voice_style": "only if it needs updating",
-    "persona": {{}},
-    "instructions": [],
-    "example_dialogue": []
-}}
-
-Important:
-- Return valid JSON only
-- For rules, include ALL existing rules plus any new ones
-- Only include fields that actually need updating
-- Keep existing content for fields not mentioned in request"""
+        prompt = build_optimization_prompt(message, custom_request)
 
-        # Call Perplexity API
-        headers = {
-            'Authorization': f'Bearer {os.environ["PERPLEXITY_API_KEY"]}',
-            'Content-Type': 'application/json'
-        }
-
-        logger.debug("Sending request to Perplexity API")
-        api_response = requests.post(
-            'https://api.perplexity.ai/chat/completions',
-            headers=headers,
-            json={
-                'model': 'llama-3.1-sonar-small-128k-online',
-                'messages': [
-                    {'role': 'system', 'content': 'You are an expert in optimizing message templates. Return only valid JSON with the exact fields that need updating. You can add new rules, modify dialogue, or update any part of the template.'},
-                    {'role': 'user', 'content': prompt}
-                ],
-                'temperature': 0.2
-            },
-            timeout=30
-        )
+        job_id = jobs.submit('optimize', run_optimization_job, message.id, prompt.text, message.updated_at,
+                             prompt.editable)
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status_url': url_for('main.job_status', job_id=job_id)
+        }), 202
+
+    except QueueFullError as e:
+        logger.warning(f"Rejecting optimization for template {id}: {e}")
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        logger.error(f"Unexpected error in optimize_schema: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
 
-        if not api_response.ok:
-            logger.error(f"API Error: {api_response.text}")
-            return jsonify({'error': 'Failed to optimize template'}), api_response.status_code
+def request_template_updates(prompt, cooldown, retries):
+    """Ask the LLM for template updates, pausing with every other batch worker on 429s.
+
+    Runs on batch pool threads, outside the app context, so the retry limit is passed in.
+    """
+    llm_messages = [
+        {'role': 'system', 'content': OPTIMIZER_SYSTEM_PROMPT},
+        {'role': 'user', 'content': prompt.text}
+    ]
+    for attempt in range(retries + 1):
+        cooldown.wait()
+        try:
+            content = llm.chat(llm_messages, route='optimize')
+            break
+        except LLMError as e:
+            if e.status_code != 429 or attempt == retries:
+                raise JobError('Failed to optimize template', e.status_code)
+            logger.warning(f"Upstream rate limited batch optimization, backing off: {e}")
+            cooldown.trip(e.retry_after)
+
+    updates = parse_template_updates(content)
+    if updates is None:
+        llm.discard(llm_messages, route='optimize')
+        raise JobError('Failed to parse optimization updates')
+    return editable_updates(updates, prompt.editable)
+
+def run_batch_optimization_job(ids, custom_request, concurrency):
+    """Background job: apply one optimization request to many templates.
+
+    LLM calls fan out over a bounded thread pool and successful updates are
+    applied in batched commits of BATCH_COMMIT_SIZE templates.
+    """
+    # Snapshot the templates, then release the DB connection for the LLM phase
+    snapshots = {}
+    for message in Message.query.filter(Message.id.in_(ids)).all():
+        snapshots[message.id] = (build_optimization_prompt(message, custom_request), message.updated_at)
+    db.session.close()
+
+    items = {id: {'id': id, 'status': 'pending', 'error': None} for id in ids}
+    for id in ids:
+        if id not in snapshots:
+            items[id].update(status='failed', error='Template not found')
+
+    def report_progress():
+        statuses = [item['status'] for item in items.values()]
+        jobs.set_progress({
+            'total': len(ids),
+            'completed': len(ids) - statuses.count('pending'),
+            'succeeded': statuses.count('succeeded'),
+            'failed': statuses.count('failed')
+        })
 
-        response_data = api_response.json()
-        logger.debug(f"API Response received: {response_data}")
+    def commit_updates(batch):
+        if not batch:
+            return
+        current = {m.id: m for m in Message.query.filter(Message.id.in_([id for id, _ in batch])).all()}
+        applied = []
+        for id, updates in batch:
+            message = current.get(id)
+            if message is None:
+                items[id].update(status='failed', error='Template not found')
+            elif message.updated_at != snapshots[id][1]:
+                items[id].update(status='failed', error='Template was modified while the optimization was running')
+            else:
+                apply_template_updates(message, updates)
+                applied.append(id)
+        try:
+            db.session.commit()
+            for id in applied:
+                items[id]['status'] = 'succeeded'
+        except Exception as e:
+            logger.error(f"Failed to commit batch optimization updates: {e}", exc_info=True)
+            db.session.rollback()
+            for id in applied:
+                items[id].update(status='failed', error='Failed to save optimization updates')
+        finally:
+            db.session.close()
+
+    report_progress()
+    cooldown = UpstreamCooldown()
+    retries = current_app.config["BATCH_RATE_LIMIT_RETRIES"]
+    ready = []
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch') as pool:
+        futures = {pool.submit(request_template_updates, prompt, cooldown, retries): id
+                   for id, (prompt, _) in snapshots.items()}
+        for future in as_completed(futures):
+            id = futures[future]
+            try:
+                ready.append((id, future.result()))
+            except JobError as e:
+                items[id].update(status='failed', error=str(e))
+            except Exception as e:
+                logger.error(f"Batch optimization failed for template {id}: {e}", exc_info=True)
+                items[id].update(status='failed', error=str(e))
+
+            if len(ready) >= current_app.config["BATCH_COMMIT_SIZE"]:
+                commit_updates(ready)
+                ready = []
+            report_progress()
+    commit_updates(ready)
+    report_progress()
+
+    results = list(items.values())
+    return {
+        'total': len(results),
+        'succeeded': sum(1 for item in results if item['status'] == 'succeeded'),
+        'failed': sum(1 for item in results if item['status'] == 'failed'),
+        'items': results
+    }
 
-        if not response_data.get('choices'):
-            logger.error("No choices in API response")
-            return jsonify({'error': 'Invalid API response'}), 500
+@bp.route('/optimize-batch', methods=['POST'])
+@api_route
+def optimize_batch():
+    """Route to apply one optimization request to many templates as a background job"""
+    try:
+        data = request.get_json(silent=True) or {}
+        custom_request = data.get('custom_optimization', '')
+        ids = data.get('ids')
 
-        # Extract JSON from the response
-        content = response_data['choices'][0]['message']['content']
-        logger.debug(f"Raw content from API: {content}")
+        if not custom_request:
+            return jsonify({'error': 'No optimization request provided'}), 400
+        if not isinstance(ids, list) or not ids or not all(isinstance(id, int) for id in ids):
+            return jsonify({'error': 'ids must be a non-empty list of template ids'}), 400
+
+        ids = list(dict.fromkeys(ids))
+        if len(ids) > current_app.config["BATCH_MAX_SIZE"]:
+            return jsonify({'error': f'At most {current_app.config["BATCH_MAX_SIZE"]} templates per batch'}), 400
 
         try:
-            # First try to parse the content directly
-            updates = json.loads(content)
-            if not isinstance(updates, dict):
-                logger.error(f"Invalid updates format: {type(updates)}")
-                return jsonify({'error': 'Invalid update format received'}), 500
-
-            # Apply updates to the message
-            if 'rules' in updates:
-                message.rules = updates['rules']
-            if 'bio' in updates:
-                message.bio = updates['bio']
-            if 'voice_style' in updates:
-                message.voice_style = updates['voice_style']
-            if 'persona' in updates:
-                message.persona = updates['persona']
-            if 'instructions' in updates:
-                message.instructions = updates['instructions']
-            if 'example_dialogue' in updates:
-                message.example_dialogue = updates['example_dialogue']
+            concurrency = int(data.get('concurrency', current_app.config["BATCH_CONCURRENCY"]))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'concurrency must be an integer'}), 400
+        concurrency = max(1, min(concurrency, current_app.config["BATCH_MAX_CONCURRENCY"]))
 
-            message.updated_at = datetime.utcnow()
-            db.session.commit()
-            return jsonify({'success': True})
-
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON Parse Error: {e}")
-            # Try to find JSON object in the content
-            json_match = re.search(r'\{[\s\S]*\}', content)
-            if json_match:
-                try:
-                    updates = json.loads(json_match.group())
-                    if isinstance(updates, dict):
-                        # Apply updates
-                        if 'rules' in updates:
-                            message.rules = updates['rules']
-                        if 'bio' in updates:
-                            message.bio = updates['bio']
-                        if 'voice_style' in updates:
-                            message.voice_style = updates['voice_style']
-                        if 'persona' in updates:
-                            message.persona = updates['persona']
-                        if 'instructions' in updates:
-                            message.instructions = updates['instructions']
-                        if 'example_dialogue' in updates:
-                            message.example_dialogue = updates['example_dialogue']
-
-                        message.updated_at = datetime.utcnow()
-                        db.session.commit()
-                        return jsonify({'success': True})
-                except Exception as e:
-                    logger.error(f"Failed to parse or apply updates: {e}", exc_info=True)
-            return jsonify({'error': 'Failed to parse optimization updates'}), 500
+        logger.info(f"Batch optimization request received for {len(ids)} templates: {custom_request}")
+        job_id = jobs.submit('optimize_batch', run_batch_optimization_job, ids, custom_request, concurrency)
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status_url': url_for('main.job_status', job_id=job_id)
+        }), 202
 
+    except QueueFullError as e:
+        logger.warning(f"Rejecting batch optimization: {e}")
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
-        logger.error(f"Unexpected error in optimize_schema: {e}", exc_info=True)
+        logger.error(f"Unexpected error in optimize_batch: {e}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
-@app.route('/get-template/<int:id>')
+@bp.route('/get-template/<int:id>')
 def get_template(id):
-    """Route to get template details"""
+    """Route to get template details (answers 304 when the client's copy is current)"""
+    message = load_validators(id)
+    cached = not_modified_response(message, 'template', editable=True)
+    if cached is not None:
+        return cached
     try:
-        message = Message.query.get_or_404(id)
-        return jsonify({
+        db.session.refresh(message)
+        response = jsonify({
             'bio': message.bio,
             'voice_style': message.voice_style,
             'persona': message.persona,
@@ -305,11 +835,12 @@ def get_template(id):
             'instructions': message.instructions,
             'example_dialogue': message.example_dialogue
         })
+        return cache_headers(response, message, 'template', editable=True)
     except Exception as e:
         logger.error(f"Error getting template: {e}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/update-template/<int:id>', methods=['POST'])
+@bp.route('/update-template/<int:id>', methods=['POST'])
 def update_template(id):
     """Route to update template with edited values"""
     try:
@@ -342,6 +873,7 @@ def update_template(id):
 
         message.updated_at = datetime.utcnow()
         db.session.commit()
+        prompts.invalidate(id)
 
         return jsonify({'success': True, 'message': 'Template updated successfully'})
 
@@ -350,7 +882,67 @@ def update_template(id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
-@app.route('/apply-optimization/<int:id>', methods=['POST'])
+@bp.route('/templates/<int:id>', methods=['PATCH'])
+def patch_template(id):
+    """Apply a JSON Patch (RFC 6902) or merge patch (RFC 7386) to a template in SQL.
+
+    The patch is compiled into a single UPDATE built from jsonb_set, jsonb_insert,
+    || and #-, so only the patch travels over the wire. With If-Match set to the
+    ETag from /get-template/<id>, a template changed in the meantime gets a 412.
+    """
+    patch = request.get_json(force=True, silent=True)
+    if patch is None:
+        return jsonify({'error': 'Request body must be JSON'}), 400
+    table = Message.__table__
+    try:
+        if request.mimetype == JSON_PATCH_MIMETYPE:
+            values, conditions = compile_json_patch(table, patch)
+        else:
+            values, conditions = compile_merge_patch(table, patch)
+    except PatchError as e:
+        return jsonify({'error': str(e)}), 422
+
+    try:
+        # Lock the row so the If-Match check and the update see the same revision
+        message = db.get_or_404(Message, id, options=[load_only(*VALIDATOR_COLUMNS)], with_for_update=True)
+        etag = template_etag(message, 'template')
+        if request.if_match and etag not in request.if_match:
+            db.session.rollback()
+            response = jsonify({'error': 'Template was modified since it was read; reload and retry'})
+            response.set_etag(etag)
+            return response, 412
+
+        # The UPDATE bypasses the flush hooks, so make sure the row is stored in full
+        prepare_bulk_content_update(db.session, [id])
+        row = db.session.execute(
+            update(table).where(table.c.id == id, *conditions)
+            .values(**values, updated_at=datetime.utcnow())
+            .returning(table.c.updated_at, table.c.version_number, table.c.original_id,
+                       *[table.c[field] for field in INDEXED_FIELDS])
+        ).first()
+        if row is None:
+            db.session.rollback()
+            return jsonify({'error': 'Patch does not apply: a test failed or a path does not exist'}), 409
+        db.session.commit()
+        prompts.invalidate(id)
+        # Core UPDATEs bypass the session hooks that keep the similarity index current
+        similarity.update(id, row.original_id or id, {field: getattr(row, field) for field in INDEXED_FIELDS})
+
+        set_committed_value(message, 'updated_at', row.updated_at)
+        response = jsonify({'success': True, 'updated_at': row.updated_at.isoformat(),
+                            'version_number': row.version_number})
+        response.set_etag(template_etag(message, 'template'))
+        return response
+
+    except DataError as e:
+        db.session.rollback()
+        return jsonify({'error': f'Patch does not apply: {e.orig}'}), 409
+    except Exception as e:
+        logger.error(f"Error patching template: {e}", exc_info=True)
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/apply-optimization/<int:id>', methods=['POST'])
 def apply_optimization(id):
     """Route to apply optimizations to a template"""
     try:
@@ -360,117 +952,16 @@ def apply_optimization(id):
 
         if custom_request:
             # Use Perplexity API to process the custom request
-            headers = {
-                'Authorization': f'Bearer {os.environ["PERPLEXITY_API_KEY"]}',
-                'Content-Type': 'application/json'
-            }
-
-            prompt = f"""Apply the following optimization request to this template:
-Custom Request: {custom_request}
-
-Current Template:
-Bio: {message.bio}
-Voice Style: {message.voice_style}
-Persona: {json.dumps(message.persona, indent=2)}
-Rules: {json.dumps(message.rules, indent=2)}
-Instructions: {json.dumps(message.instructions, indent=2)}
-Example Dialogue: {json.dumps(message.example_dialogue, indent=2)}
-
-Based on the custom request, return a JSON object with ONLY the fields that need to be updated:
-{{
-    "rules": ["list of all rules including any new ones"],
-    "bio": "only if it needs updating",
-    "voice_style": "only if it needs updating",
-    "persona": {{}},
-    "instructions": [],
-    "example_dialogue": []
-}}
-
-Important:
-- Return valid JSON only
-- Include ALL existing rules plus any new ones in the rules array
-- Only include fields that actually need updating
-- Keep existing content for fields not mentioned in custom request"""
-
-            logger.debug("Sending optimization request to Perplexity API")
-            api_response = requests.post(
-                'https://api.perplexity.ai/chat/completions',
-                headers=headers,
-                json={
-                    'model': 'llama-3.1-sonar-small-128k-online',
-                    'messages': [
-                        {'role': 'system', 'content': 'You are an expert in optimizing message templates. Return only valid JSON with the exact fields that need updating. You can add new rules, modify dialogue, or update any part of the template.'},
-                        {'role': 'user', 'content': prompt}
-                    ],
-                    'temperature': 0.2
-                },
-                timeout=30
-            )
-
-            if not api_response.ok:
-                logger.error(f"API Error: {api_response.text}")
-                return jsonify({'error': 'Failed to apply optimization'}), 500
-
-            response_data = api_response.json()
-            content = response_data['choices'][0]['message']['content']
-
-            # Extract JSON from the response
-            content = response_data['choices'][0]['message']['content']
-            logger.debug(f"Raw content from API: {content}")
-
-            # First try to parse the content directly
-            try:
-                updates = json.loads(content)
-                logger.debug(f"Parsed updates: {updates}")
-
-                # Apply updates to the message
-                if isinstance(updates, dict):
-                    if 'rules' in updates:
-                        message.rules = updates['rules']
-                    if 'bio' in updates:
-                        message.bio = updates['bio']
-                    if 'voice_style' in updates:
-                        message.voice_style = updates['voice_style']
-                    if 'persona' in updates:
-                        message.persona = updates['persona']
-                    if 'instructions' in updates:
-                        message.instructions = updates['instructions']
-                    if 'example_dialogue' in updates:
-                        message.example_dialogue = updates['example_dialogue']
-
-                    message.updated_at = datetime.utcnow()
-                    db.session.commit()
-                    return jsonify({'success': True, 'message': 'Template updated successfully'})
-
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON Parse Error: {e}")
-                # If direct parsing fails, try to extract JSON object
-                json_match = re.search(r'\{[\s\S]*\}', content)
-                if json_match:
-                    try:
-                        updates = json.loads(json_match.group())
-                        if isinstance(updates, dict):
-                            # Apply the same updates as above
-                            if 'rules' in updates:
-                                message.rules = updates['rules']
-                            if 'bio' in updates:
-                                message.bio = updates['bio']
-                            if 'voice_style' in updates:
-                                message.voice_style = updates['voice_style']
-                            if 'persona' in updates:
-                                message.persona = updates['persona']
-                            if 'instructions' in updates:
-                                message.instructions = updates['instructions']
-                            if 'example_dialogue' in updates:
-                                message.example_dialogue = updates['example_dialogue']
-
-                            message.updated_at = datetime.utcnow()
-                            db.session.commit()
-                            return jsonify({'success': True, 'message': 'Template updated successfully'})
-                    except Exception as e:
-                        logger.error(f"Failed to parse or apply updates: {e}", exc_info=True)
-
-            return jsonify({'error': 'Failed to optimize schema'}), 500
+            prompt = build_optimization_prompt(message, custom_request)
+
+            job_id = jobs.submit('apply_optimization', run_optimization_job, message.id, prompt.text,
+                                 message.updated_at, prompt.editable)
+            return jsonify({
+                'success': True,
+                'template_id': message.id,
+                'job_id': job_id,
+                'status_url': url_for('main.job_status', job_id=job_id)
+            }), 202
 
         return jsonify({
             'success': True, 
@@ -478,121 +969,278 @@ Important:
             'message': 'Template updated successfully'
         })
 
+    except QueueFullError as e:
+        logger.warning(f"Rejecting optimization for template {id}: {e}")
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         logger.error(f"Error applying optimizations: {e}", exc_info=True)
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
-@app.route('/builder')
+@bp.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Route to get the status and result of a background job"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@bp.route('/builder')
 def template_builder():
     """Route for the template builder interface"""
     return render_template('builder.html')
 
-@app.route('/list_categories')
+@bp.route('/list_categories')
 def list_categories():
     """Route for listing categories"""
     return render_template('categories.html')
 
-@app.route('/list_tags')
+@bp.route('/list_tags')
 def list_tags():
     """Route for listing tags"""
     return render_template('tags.html')
 
-@app.route('/generate-schema', methods=['POST'])
+GENERATION_SYSTEM_PROMPT = 'You are an expert in creating system message templates. Return only valid JSON in this format: {"bio": "...", "voice_style": "...", "persona": {...}, "rules": ["Please provide your contact information", "Customize your order"], "instructions": ["Create an account by providing your contact information", "Browse the menu and select items", "Customize your order with preferences", "Submit your order through the app", "Track your order status in real-time"], "example_dialogue": ["Agent: Hello! How can I help you today?", "Customer: I would like to place an order.", "Agent: I\'d be happy to help you with that!", "Customer: Thank you."]}'
+
+def build_generation_messages(prompt, urls):
+    """Build the chat messages for schema generation, prefixing website content when URLs are given"""
+    if urls:
+        pages = ingestor.ingest(urls)
+        if len(pages) == 1:
+            prompt = f"Based on this website content:\n{pages[0][1]}\n\n{prompt}"
+        elif pages:
+            context = "\n\n".join(f"Source: {url}\n{text}" for url, text in pages)
+            prompt = f"Based on this website content:\n{context}\n\n{prompt}"
+
+    return [
+        {'role': 'system', 'content': GENERATION_SYSTEM_PROMPT},
+        {'role': 'user', 'content': prompt}
+    ]
+
+def parse_generated_schema(content):
+    """Parse and normalize a generated schema; returns (schema_data, error)"""
+    try:
+        schema_data = extract_json(content, lambda data: check_template_fields(data, required=True))
+    except ExtractionError as e:
+        return None, str(e)
+    return normalize_template(schema_data), None
+
+def requested_urls(data):
+    """Collect website URLs from a generation request ('urls' list and/or legacy 'url')"""
+    urls = data.get('urls') or []
+    if isinstance(urls, str):
+        urls = urls.split()
+    if data.get('url'):
+        urls = [data['url']] + list(urls)
+    return [url.strip() for url in urls if isinstance(url, str) and url.strip()]
+
+@bp.route('/generate-schema', methods=['POST'])
 def generate_schema():
     """Route to generate a new schema using Perplexity API"""
     try:
         data = request.get_json()
         prompt = data.get('prompt')
-        url = data.get('url', '')
+        urls = requested_urls(data)
 
         if not prompt:
             return jsonify({'error': 'Prompt is required'}), 400
 
-        # If URL is provided, get website content
-        context = ""
-        if url:
-            try:
-                downloaded = trafilatura.fetch_url(url)
-                context = trafilatura.extract(downloaded)
-                if context:
-                    prompt = f"Based on this website content:\n{context}\n\n{prompt}"
-            except Exception as e:
-                logger.warning(f"Failed to fetch URL content: {e}")
-
         # Call Perplexity API
-        headers = {
-            'Authorization': f'Bearer {os.environ["PERPLEXITY_API_KEY"]}',
-            'Content-Type': 'application/json'
-        }
-
-        api_response = requests.post(
-            'https://api.perplexity.ai/chat/completions',
-            headers=headers,
-            json={
-                'model': 'llama-3.1-sonar-small-128k-online',
-                'messages': [
-                    {'role': 'system', 'content': 'You are an expert in creating system message templates. Return only valid JSON in this format: {"bio": "...", "voice_style": "...", "persona": {...}, "rules": ["Please provide your contact information", "Customize your order"], "instructions": ["Create an account by providing your contact information", "Browse the menu and select items", "Customize your order with preferences", "Submit your order through the app", "Track your order status in real-time"], "example_dialogue": ["Agent: Hello! How can I help you today?", "Customer: I would like to place an order.", "Agent: I\'d be happy to help you with that!", "Customer: Thank you."]}'},
-                    {'role': 'user', 'content': prompt}
-                ],
-                'temperature': 0.2
-            }
-        )
-
-        if not api_response.ok:
-            logger.error(f"API Error: {api_response.text}")
-            return jsonify({'error': 'Failed to generate schema'}), 500
-
-        response_data = api_response.json()
-        if not response_data.get('choices'):
-            return jsonify({'error': 'Invalid API response'}), 500
+        llm_messages = build_generation_messages(prompt, urls)
+        try:
+            content = llm.chat(llm_messages, route='generate')
+        except LLMError as e:
+            logger.error(f"API Error: {e}")
+            return llm_error_response(e, 'Failed to generate schema')
 
         # Extract JSON from the response
-        try:
-            content = response_data['choices'][0]['message']['content']
-            try:
-                # First try to parse content directly
-                schema_data = json.loads(content)
-            except json.JSONDecodeError:
-                # If that fails, try to find JSON object in the content
-                json_match = re.search(r'\{[\s\S]*\}', content)
-                if not json_match:
-                    return jsonify({'error': 'Invalid schema format'}), 500
-                try:
-                    schema_data = json.loads(json_match.group())
-                except json.JSONDecodeError:
-                    return jsonify({'error': 'Invalid schema format'}), 500
-
-            # Validate required fields
-            required_fields = ['bio', 'voice_style', 'persona', 'rules', 'instructions', 'example_dialogue']
-            if not all(field in schema_data for field in required_fields):
-                return jsonify({'error': 'Missing required fields'}), 500
-
-            # Ensure rules and instructions are lists
-            if isinstance(schema_data.get('rules'), str):
-                schema_data['rules'] = [schema_data['rules']]
-            if isinstance(schema_data.get('instructions'), str):
-                schema_data['instructions'] = [schema_data['instructions']]
-
-            # Ensure example_dialogue is a list of strings
-            if isinstance(schema_data.get('example_dialogue'), dict):
-                dialogue = []
-                for speaker, text in schema_data['example_dialogue'].items():
-                    dialogue.append(f"{speaker}: {text}")
-                schema_data['example_dialogue'] = dialogue
-            elif isinstance(schema_data.get('example_dialogue'), str):
-                schema_data['example_dialogue'] = [line.strip() for line in schema_data['example_dialogue'].split('\n') if line.strip()]
-
-            return jsonify(schema_data)
-        except (json.JSONDecodeError, KeyError) as e:
-            logger.error(f"Schema Parse Error: {e}")
-            return jsonify({'error': 'Failed to parse generated schema'}), 500
+        schema_data, error = parse_generated_schema(content)
+        if error:
+            logger.error(f"Schema Parse Error: {error}")
+            llm.discard(llm_messages, route='generate')
+            return jsonify({'error': error}), 500
+
+        return jsonify(schema_data)
 
     except Exception as e:
         logger.error(f"Unexpected error in generate_schema: {e}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/use-generated-schema', methods=['POST'])
+def retry_after_seconds(error):
+    return math.ceil(error.retry_after or 1)
+
+def llm_error_response(error, message):
+    """429 with Retry-After when the upstream (or the local limiter) is rate limiting, 500 otherwise"""
+    if error.status_code == 429:
+        response = jsonify({'error': 'Too many requests to the LLM, try again shortly'})
+        response.headers['Retry-After'] = str(retry_after_seconds(error))
+        return response, 429
+    return jsonify({'error': message}), 500
+
+def sse_event(event, data):
+    """Format a single Server-Sent Events frame with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@bp.route('/generate-schema/stream', methods=['POST'])
+def generate_schema_stream():
+    """Route to generate a new schema, streaming tokens over Server-Sent Events.
+
+    Emits ``token`` events as the completion arrives and a terminal ``schema``
+    (normalized like /generate-schema) or ``error`` event. The worker serving
+    the request is held until the stream ends, so serve many concurrent streams
+    from threaded or async workers. No database connection is held meanwhile.
+    """
+    data = request.get_json(silent=True) or {}
+    prompt = data.get('prompt')
+    urls = requested_urls(data)
+
+    if not prompt:
+        return jsonify({'error': 'Prompt is required'}), 400
+
+    def events():
+        # Flush a first frame straight away so the client sees progress during URL fetching
+        yield sse_event('status', {'stage': 'started'})
+        llm_messages = build_generation_messages(prompt, urls)
+        chunks = []
+        try:
+            for delta in llm.stream_chat(llm_messages, route='generate'):
+                chunks.append(delta)
+                yield sse_event('token', {'content': delta})
+        except LLMError as e:
+            logger.error(f"API Error: {e}")
+            error = {'error': 'Failed to generate schema'}
+            if e.status_code == 429:
+                error.update(status=429, retry_after=retry_after_seconds(e))
+            yield sse_event('error', error)
+            return
+
+        schema_data, error = parse_generated_schema(''.join(chunks))
+        if error:
+            logger.error(f"Schema Parse Error: {error}")
+            llm.discard(llm_messages, route='generate')
+            yield sse_event('error', {'error': error})
+            return
+        yield sse_event('schema', schema_data)
+
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics: per-route latency and SQL, pool state, LLM calls, caches, rendering"""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@bp.route('/llm/cache-stats')
+def llm_cache_stats():
+    """Route to report LLM response cache hit/miss statistics"""
+    return jsonify(llm.cache_stats())
+
+def live_prompt(message):
+    """Prompt, ETag and pre-serialized JSON for what message currently serves"""
+    snapshot = db.session.get(PublishedSnapshot, message.published_snapshot_id) if message.published_snapshot_id else None
+    if snapshot is not None:
+        prompt, etag = snapshot.prompt, f'snapshot-{snapshot.id}'
+        body = {'id': message.id, 'name': snapshot.name, 'version_number': snapshot.version_number,
+                'revision': snapshot.revision, 'published_at': snapshot.published_at.isoformat()}
+    else:
+        db.session.refresh(message)
+        prompt, etag = compile_prompt(message), template_etag(message, 'prompt')
+        body = {'id': message.id, 'name': message.name, 'version_number': message.version_number, 'revision': None,
+                'published_at': message.published_at.isoformat() if message.published_at else None}
+    body['prompt'] = prompt
+    return {'prompt': prompt, 'etag': etag, 'json': json.dumps(body)}
+
+def catalog_entries():
+    """Yield the live prompt of every published template for the catalog artifact"""
+    snapshots = (select(PublishedSnapshot.message_id, PublishedSnapshot.id.label('snapshot_id'),
+                        PublishedSnapshot.revision, PublishedSnapshot.version_number, PublishedSnapshot.name,
+                        PublishedSnapshot.published_at, PublishedSnapshot.content_hash, PublishedSnapshot.prompt)
+                 .join(Message, Message.published_snapshot_id == PublishedSnapshot.id)
+                 .where(Message.published.is_(True))
+                 .execution_options(yield_per=current_app.config["EXPORT_BATCH_SIZE"]))
+    for row in db.session.execute(snapshots).mappings():
+        yield dict(row)
+
+    # Templates published before snapshots existed
+    legacy = (select(Message)
+              .where(Message.published.is_(True), Message.published_snapshot_id.is_(None))
+              .execution_options(yield_per=current_app.config["EXPORT_BATCH_SIZE"]))
+    for message in db.session.scalars(legacy):
+        yield {'message_id': message.id, 'snapshot_id': None, 'revision': None,
+               'version_number': message.version_number, 'name': message.name,
+               'published_at': message.published_at, 'content_hash': None, 'prompt': compile_prompt(message)}
+
+@bp.route('/prompts/catalog')
+def prompt_catalog():
+    """Route to download every published prompt as a single memory-mappable catalog file"""
+    artifact = tempfile.TemporaryFile()
+    try:
+        count = write_catalog(artifact, catalog_entries())
+    except Exception as e:
+        artifact.close()
+        logger.error(f"Error building prompt catalog: {e}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+    finally:
+        db.session.rollback()
+    logger.info(f"Built prompt catalog with {count} published prompts")
+    artifact.seek(0)
+    return send_file(artifact, mimetype='application/octet-stream', as_attachment=True,
+                     download_name='prompts.catalog')
+
+@bp.cli.command('build-prompt-catalog')
+@click.argument('output', type=click.Path(dir_okay=False))
+def build_prompt_catalog_command(output):
+    """Write every published prompt to a memory-mappable catalog file"""
+    partial = f'{output}.partial'
+    with open(partial, 'wb') as artifact:
+        count = write_catalog(artifact, catalog_entries())
+    os.replace(partial, output)
+    click.echo(f'Wrote {count} published prompts to {output}')
+
+@bp.route('/prompts/<int:id>')
+def serve_prompt(id):
+    """Route to serve the compiled system prompt of a published template.
+
+    Hot templates are answered from the in-process prompt cache without a
+    database query; ?format=text returns the bare prompt.
+    """
+    entry = prompts.get(id)
+    if entry is None:
+        current = (Message.query
+                   .options(load_only(Message.id, Message.published, Message.published_snapshot_id, Message.updated_at))
+                   .filter_by(id=id).first())
+        if current is None or not current.published:
+            prompts.invalidate(id)
+            return jsonify({'error': 'No published template with this id'}), 404
+        # Templates published before snapshots existed are compiled from the live row
+        if current.published_snapshot_id is not None:
+            validator = ('snapshot', current.published_snapshot_id)
+        else:
+            validator = ('row', current.updated_at)
+        entry = prompts.revalidate(id, validator)
+        if entry is None:
+            entry = prompts.put(id, validator, **live_prompt(current))
+
+    text = request.args.get('format') == 'text'
+    etag = f"{entry['etag']}-{'text' if text else 'json'}"
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    elif text:
+        response = Response(entry['prompt'], mimetype='text/plain')
+    else:
+        response = Response(entry['json'], mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = current_app.config["PUBLISHED_CACHE_CONTROL"]
+    return response
+
+@bp.route('/prompts/cache-stats')
+def prompt_cache_stats():
+    """Route to report compiled prompt cache statistics"""
+    return jsonify(prompts.stats())
+
+@bp.route('/use-generated-schema', methods=['POST'])
 def use_generated_schema():
     """Route to save the generated schema as a new template"""
     try:
@@ -602,41 +1250,17 @@ def use_generated_schema():
             return jsonify({'error': 'No schema data provided'}), 400
 
         # Convert all JSON fields to proper format
-        persona_data = schema_data.get('persona', {})
-        if isinstance(persona_data, str):
-            try:
-                persona_data = json.loads(persona_data)
-            except json.JSONDecodeError:
-                persona_data = {'description': persona_data}
-
-        # Convert dialogue to proper format
-        example_dialogue = schema_data.get('example_dialogue', [])
-        if isinstance(example_dialogue, dict):
-            dialogue_list = []
-            for role, text in example_dialogue.items():
-                dialogue_list.append(f"{role}: {text}")
-            example_dialogue = dialogue_list
-        elif isinstance(example_dialogue, str):
-            example_dialogue = [line.strip() for line in example_dialogue.split('\n') if line.strip()]
-
-        # Ensure rules and instructions are lists
-        rules = schema_data.get('rules', [])
-        if isinstance(rules, str):
-            rules = [rules]
-
-        instructions = schema_data.get('instructions', [])
-        if isinstance(instructions, str):
-            instructions = [instructions]
+        schema_data = normalize_template(schema_data)
 
         # Create new message from schema with properly formatted data
         message = Message(
             name=f"Generated Template {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}",
             bio=schema_data.get('bio', ''),
             voice_style=schema_data.get('voice_style', ''),
-            persona=persona_data,
-            rules=rules,
-            instructions=instructions,
-            example_dialogue=example_dialogue,
+            persona=schema_data['persona'],
+            rules=schema_data['rules'],
+            instructions=schema_data['instructions'],
+            example_dialogue=schema_data['example_dialogue'],
             created_at=datetime.utcnow(),
             published=False,
             published_at=None
@@ -647,7 +1271,7 @@ def use_generated_schema():
 
         return jsonify({
             'success': True,
-            'redirect_url': url_for('preview_message', id=message.id)
+            'redirect_url': url_for('main.preview_message', id=message.id)
         })
 
     except Exception as e:
@@ -655,66 +1279,237 @@ def use_generated_schema():
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
-@app.route('/messages/<int:id>/export.<format>')
+def prepare_bulk_content_update(session, ids):
+    """Bulk updates bypass the flush hooks, so decode affected delta-stored versions first"""
+    store_in_full(session, Message.id.in_(ids) | Message.delta_base_id.in_(ids))
+
+def import_templates(text, mode='insert', skip_invalid=False, max_rows=None):
+    """Parse, validate and write an NDJSON or JSON array import.
+
+    Every row is validated before anything is written; unless skip_invalid is
+    set, a single invalid row rejects the whole import.
+    """
+    rows, errors = parse_import_payload(text)
+    if max_rows is not None and len(rows) > max_rows:
+        return {'success': False, 'inserted': 0, 'updated': 0,
+                'errors': [{'row': None, 'error': f'At most {max_rows} rows per import'}]}
+
+    records, invalid = prepare_import(rows, mode, datetime.utcnow())
+    errors += invalid
+    if errors and not skip_invalid:
+        return {'success': False, 'inserted': 0, 'updated': 0, 'errors': errors}
+
+    summary = import_records(db.session, Message, records, mode, current_app.config["IMPORT_CHUNK_SIZE"],
+                             before_update=prepare_bulk_content_update)
+    summary['errors'] = errors + summary['errors']
+    summary['success'] = not summary['errors']
+    if summary['inserted'] or summary['updated']:
+        # Bulk writes bypass the session hooks; re-read everything on the next similarity query
+        similarity.invalidate()
+    logger.info(f"Imported templates ({mode}): {summary['inserted']} inserted, "
+                f"{summary['updated']} updated, {len(summary['errors'])} errors")
+    return summary
+
+@bp.route('/messages/import', methods=['POST'])
+@api_route
+def import_messages():
+    """Route to bulk import templates from an NDJSON or JSON array body"""
+    mode = request.args.get('mode', 'insert')
+    if mode not in IMPORT_MODES:
+        return jsonify({'error': f'mode must be one of {", ".join(IMPORT_MODES)}'}), 400
+    skip_invalid = request.args.get('skip_invalid') in ('1', 'true')
+    try:
+        result = import_templates(request.get_data(as_text=True), mode, skip_invalid, current_app.config["IMPORT_MAX_ROWS"])
+    except Exception as e:
+        logger.error(f"Error importing templates: {e}", exc_info=True)
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+    if not result['success'] and not result['inserted'] and not result['updated']:
+        return jsonify(result), 422
+    return jsonify(result)
+
+@bp.cli.command('import-templates')
+@click.argument('source', type=click.File('r'))
+@click.option('--mode', type=click.Choice(IMPORT_MODES), default='insert', help='upsert updates templates with the same name')
+@click.option('--skip-invalid', is_flag=True, help='Import the valid rows even if some rows are invalid')
+def import_templates_command(source, mode, skip_invalid):
+    """Bulk import templates from an NDJSON or JSON array file ('-' for stdin)"""
+    result = import_templates(source.read(), mode, skip_invalid)
+    click.echo(json.dumps(result, indent=2))
+    if not result['success']:
+        raise SystemExit(1)
+
+@bp.route('/messages/<int:id>/export.<format>')
 def export_message(id, format):
     """Export message in the specified format (xml or json)"""
-    message = Message.query.get_or_404(id)
+    if format not in ('json', 'xml'):
+        return 'Unsupported format', 400
+
+    message = load_validators(id)
+    cached = not_modified_response(message, format)
+    if cached is not None:
+        return cached
 
+    db.session.refresh(message)
     if format == 'json':
-        return jsonify(message.to_dict())
-    elif format == 'xml':
-        # Create XML representation
-        xml_data = f'''<?xml version="1.0" encoding="UTF-8"?>
-<message>
-    <id>{message.id}</id>
-    <name>{message.name}</name>
-    <bio><![CDATA[{message.bio}]]></bio>
-    <voice_style><![CDATA[{message.voice_style}]]></voice_style>
-    <persona><![CDATA[{json.dumps(message.persona)}]]></persona>
-    <rules><![CDATA[{json.dumps(message.rules)}]]></rules>
-    <instructions><![CDATA[{json.dumps(message.instructions)}]]></instructions>
-    <example_dialogue><![CDATA[{json.dumps(message.example_dialogue)}]]></example_dialogue>
-    <published>{str(message.published).lower()}</published>
-    <published_at>{message.published_at.isoformat() if message.published_at else ''}</published_at>
-    <created_at>{message.created_at.isoformat()}</created_at>
-    <updated_at>{message.updated_at.isoformat()}</updated_at>
-</message>'''
-        return Response(xml_data, mimetype='application/xml')
+        response = jsonify(message.to_dict())
     else:
-        return 'Unsupported format', 400
-
+        response = Response(render_message_xml(message), mimetype='application/xml')
+    return cache_headers(response, message, format)
+
+def export_statement():
+    """Build the bulk export query from the published, updated_since and ids parameters.
+
+    Raises ValueError when a parameter is malformed.
+    """
+    statement = select(Message).order_by(Message.id)
+    published = request.args.get('published')
+    if published not in (None, ''):
+        statement = statement.where(Message.published.is_(published in ('1', 'true')))
+    updated_since = request.args.get('updated_since')
+    if updated_since:
+        since = datetime.fromisoformat(updated_since)
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        statement = statement.where(Message.updated_at >= since)
+    ids = request.args.get('ids')
+    if ids:
+        statement = statement.where(Message.id.in_([int(id) for id in ids.split(',') if id.strip()]))
+    # yield_per streams rows from a server-side cursor in fixed-size batches
+    return statement.execution_options(yield_per=current_app.config["EXPORT_BATCH_SIZE"])
+
+def iter_export(statement):
+    """Yield messages from a server-side cursor, dropping each from the session once written"""
+    try:
+        for message in db.session.scalars(statement):
+            yield message
+            db.session.expunge(message)
+    except Exception as e:
+        logger.error(f"Error during bulk export: {e}", exc_info=True)
+        raise
+    finally:
+        db.session.rollback()
 
-@app.route('/messages/<int:id>/publish', methods=['POST'])
+@bp.route('/messages/export.<format>')
+def export_messages(format):
+    """Route to stream many templates as NDJSON, a JSON array or a ZIP of per-template files"""
+    if format not in EXPORT_MIMETYPES:
+        return 'Unsupported format', 400
+    file_format = request.args.get('files', 'json')
+    if file_format not in ('json', 'xml'):
+        return 'Unsupported file format', 400
+    try:
+        statement = export_statement()
+    except ValueError as e:
+        return jsonify({'error': f'Invalid export filter: {e}'}), 400
+
+    messages = iter_export(statement)
+    if format == 'ndjson':
+        body = ndjson_stream(messages)
+    elif format == 'json':
+        body = json_array_stream(messages)
+    else:
+        body = zip_stream(messages, file_format)
+
+    filename = f"templates-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.{format}"
+    return Response(stream_with_context(body), mimetype=EXPORT_MIMETYPES[format],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+SNAPSHOT_FIELDS = ('bio', 'voice_style', 'persona', 'rules', 'instructions', 'example_dialogue')
+
+def publish_snapshot(message):
+    """Make an immutable snapshot of message's current content the live one.
+
+    Republishing unchanged content reuses the latest snapshot rather than
+    adding a revision. The caller commits.
+    """
+    content = {field: getattr(message, field) for field in SNAPSHOT_FIELDS}
+    content_hash = hashlib.sha256(json.dumps([message.name, content], sort_keys=True).encode('utf-8')).hexdigest()
+    latest = (PublishedSnapshot.query
+              .options(load_only(PublishedSnapshot.id, PublishedSnapshot.revision, PublishedSnapshot.content_hash))
+              .filter_by(message_id=message.id)
+              .order_by(PublishedSnapshot.revision.desc())
+              .first())
+    if latest is None or latest.content_hash != content_hash:
+        latest = PublishedSnapshot(
+            message_id=message.id,
+            revision=latest.revision + 1 if latest else 1,
+            name=message.name,
+            version_number=message.version_number,
+            content=content,
+            prompt=compile_prompt(message),
+            content_hash=content_hash,
+            published_at=message.published_at or datetime.utcnow()
+        )
+        db.session.add(latest)
+        db.session.flush()
+    message.published_snapshot_id = latest.id
+    return latest
+
+@bp.route('/messages/<int:id>/snapshots')
+def message_snapshots(id):
+    """Route to list the published snapshots of a message, newest first"""
+    snapshots = (PublishedSnapshot.query
+                 .options(load_only(PublishedSnapshot.id, PublishedSnapshot.message_id, PublishedSnapshot.revision,
+                                    PublishedSnapshot.name, PublishedSnapshot.version_number,
+                                    PublishedSnapshot.content_hash, PublishedSnapshot.published_at))
+                 .filter_by(message_id=id)
+                 .order_by(PublishedSnapshot.revision.desc())
+                 .all())
+    return jsonify([snapshot.to_dict() for snapshot in snapshots])
+
+@bp.route('/messages/<int:id>/snapshots/<int:revision>')
+def message_snapshot(id, revision):
+    """Route to get one published snapshot with its content and compiled prompt"""
+    snapshot = PublishedSnapshot.query.filter_by(message_id=id, revision=revision).first_or_404()
+    return jsonify(snapshot.to_dict(include_content=True))
+
+@bp.route('/messages/<int:id>/publish', methods=['POST'])
 def publish_message(id):
     """Route to publish a message"""
     try:
         message = Message.query.get_or_404(id)
         message.published = True
         message.published_at = datetime.utcnow()
+        publish_snapshot(message)
         db.session.commit()
+        prompts.invalidate(id)
         flash('Message published successfully', 'success')
     except Exception as e:
         logger.error(f"Error publishing message: {e}")
         db.session.rollback()
         flash('Error publishing message', 'error')
-    return redirect(url_for('preview_message', id=message.id))
+    return redirect(url_for('main.preview_message', id=message.id))
 
-@app.route('/messages/<int:id>/unpublish', methods=['POST'])
+@bp.route('/messages/<int:id>/unpublish', methods=['POST'])
 def unpublish_message(id):
     """Route to unpublish a message"""
     try:
         message = Message.query.get_or_404(id)
         message.published = False
         message.published_at = None
+        message.published_snapshot_id = None
         db.session.commit()
+        prompts.invalidate(id)
         flash('Message unpublished successfully', 'success')
     except Exception as e:
         logger.error(f"Error unpublishing message: {e}")
         db.session.rollback()
         flash('Error unpublishing message', 'error')
-    return redirect(url_for('preview_message', id=message.id))
+    return redirect(url_for('main.preview_message', id=message.id))
 
-@app.route('/messages/<int:id>/edit', methods=['GET', 'POST'])
+def decode_list_field(value):
+    """A list field submitted as a list, a JSON-encoded list or plain text (one item per line)"""
+    if not isinstance(value, str):
+        return value
+    try:
+        decoded = json.loads(value)
+    except json.JSONDecodeError:
+        return [line.strip() for line in value.split('\n') if line.strip()]
+    return decoded if isinstance(decoded, list) else [value]
+
+@bp.route('/messages/<int:id>/edit', methods=['GET', 'POST'])
 def edit_message(id):
     """Route to edit an existing message"""
     message = Message.query.get_or_404(id)
@@ -734,20 +1529,17 @@ def edit_message(id):
                 else:
                     message.persona = data['persona']
 
-            if 'rules' in data:
-                message.rules = json.dumps(data['rules']) if isinstance(data['rules'], list) else data['rules']
-
-            if 'instructions' in data:
-                message.instructions = json.dumps(data['instructions']) if isinstance(data['instructions'], list) else data['instructions']
-
-            if 'example_dialogue' in data:
-                message.example_dialogue = json.dumps(data['example_dialogue']) if isinstance(data['example_dialogue'], list) else data['example_dialogue']
+            # List fields are stored as JSONB arrays, never as JSON-encoded strings
+            for field in ('rules', 'instructions', 'example_dialogue'):
+                if field in data:
+                    setattr(message, field, decode_list_field(data[field]))
 
             message.updated_at = datetime.utcnow()
             db.session.commit()
+            prompts.invalidate(id)
 
             flash('Message updated successfully', 'success')
-            return jsonify({'success': True, 'redirect_url': url_for('preview_message', id=message.id)})
+            return jsonify({'success': True, 'redirect_url': url_for('main.preview_message', id=message.id)})
 
         except Exception as e:
             logger.error(f"Error updating message: {e}")
@@ -756,18 +1548,23 @@ def edit_message(id):
 
     return render_template('edit.html', message=message)
 
-@app.route('/messages/<int:id>/copy', methods=['POST'])
+# First key of the two-key advisory locks guarding version numbering (second key: lineage root id)
+VERSION_LOCK_NAMESPACE = 1001
+
+@bp.route('/messages/<int:id>/copy', methods=['POST'])
 def copy_message(id):
     """Route to create a copy of an existing message with version tracking"""
     try:
         source_message = Message.query.get_or_404(id)
 
-        # Get the highest version number among copies
-        max_version = db.session.query(db.func.max(Message.version_number)).filter(
-            db.or_(
-                Message.id == id,
-                Message.original_id == id
-            )
+        # Serialize version allocation per lineage: a transaction-scoped advisory lock
+        # on the lineage root makes concurrent copies wait for each other's commit
+        root_id = db.session.execute(select(lineage_root_id(id))).scalar_one()
+        db.session.execute(select(db.func.pg_advisory_xact_lock(VERSION_LOCK_NAMESPACE, root_id)))
+
+        # Get the highest version number in the whole lineage
+        max_version = db.session.execute(
+            select(db.func.max(Message.version_number)).where(Message.id.in_(lineage_ids(root_id)))
         ).scalar() or 1
 
         # Create a new message with copied content
@@ -790,14 +1587,76 @@ def copy_message(id):
 
         db.session.add(new_message)
         db.session.commit()
+        new_id = new_message.id
+
+        if versions.enabled:
+            try:
+                pack_lineage(new_id)
+                db.session.commit()
+            except Exception as e:
+                logger.error(f"Error delta-encoding the versions of message {new_id}: {e}", exc_info=True)
+                db.session.rollback()
+
         flash('Message copied successfully', 'success')
-        return redirect(url_for('preview_message', id=new_message.id))
+        return redirect(url_for('main.preview_message', id=new_id))
 
     except Exception as e:
         logger.error(f"Error copying message: {e}")
         db.session.rollback()
         flash('Error copying message', 'error')
-        return redirect(url_for('list_messages'))
-
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+        return redirect(url_for('main.list_messages'))
+
+def configure_logging(app):
+    """Root log level from LOG_LEVEL; SQL statements are only logged with SQL_LOG=1"""
+    logging.basicConfig(level=app.config["LOG_LEVEL"])
+    logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO if app.config["SQL_LOG"] else logging.WARNING)
+
+# Engines of every app built in this process; held weakly so discarded apps are not kept alive
+_fork_engines = weakref.WeakSet()
+
+def _dispose_engines_after_fork():
+    for engine in list(_fork_engines):
+        # close=False: the parent still owns those connections and must not see them closed
+        engine.dispose(close=False)
+
+# Registered once per process, however many times create_app() runs
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_dispose_engines_after_fork)
+
+def dispose_after_fork(engines):
+    """Give a forked worker (e.g. gunicorn --preload) fresh pools instead of its parent's sockets"""
+    _fork_engines.update(engines)
+
+def create_app(config=None):
+    """Build the app: settings from the environment, overridden by the config mapping.
+
+    Nothing here touches the database; engines connect on first use, and the
+    schema is managed separately (flask upgrade-db, or SCHEMA_AUTO_UPGRADE=1).
+    """
+    app = Flask(__name__)
+    load_config(app)
+    if config:
+        app.config.update(config)
+    configure_logging(app)
+
+    db.init_app(app)
+    csrf.init_app(app)
+    llm.init_app(app)
+    jobs.init_app(app)
+    ingestor.init_app(app)
+    prompts.init_app(app)
+    versions.init_app(app)
+    similarity.init_app(app)
+    metrics.init_app(app)
+    metrics.track_stats('llm', llm.cache_stats)
+    metrics.track_stats('prompts', prompts.stats)
+    metrics.track_stats('similarity', similarity.stats)
+    app.register_blueprint(bp)
+
+    with app.app_context():
+        engines = list(db.engines.values())
+        metrics.instrument_engine(db.engine)
+        if app.config["SCHEMA_AUTO_UPGRADE"]:
+            upgrade_schema()
+    dispose_after_fork(engines)
+    return app
@@ -0,0 +1,160 @@
+"""Benchmark JSON extraction from LLM responses.
+
+Compares extraction.extract_json with the json.loads + greedy regex fallback it
+replaced, over realistic responses and adversarial ones, at growing sizes. A
+linear extractor takes about twice as long when the input doubles, so the
+"growth" column should stay near 2x; the greedy regex goes quadratic (4x) on
+opening braces that never close, and often grabs the wrong span.
+
+    python benchmarks/bench_extraction.py [--max-kb 512] [--repeat 3]
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extraction import ExtractionError, extract_json, check_template_fields  # noqa: E402
+
+TEMPLATE = {
+    'bio': 'A friendly assistant for a neighbourhood bakery.',
+    'voice_style': 'Warm, concise and upbeat.',
+    'persona': {'name': 'Bella', 'occupation': 'Baker', 'personality': 'Cheerful {and} patient'},
+    'rules': ['Never promise delivery times', 'Quote prices as "from $X"'],
+    'instructions': ['Greet the customer', 'Take the order', 'Confirm the pickup time'],
+    'example_dialogue': ['Agent: Hi! What can I bake for you today?', 'Customer: A dozen croissants.'],
+}
+
+
+def legacy_extract(content):
+    """The json.loads + re.search(r'\\{[\\s\\S]*\\}') fallback previously used by the LLM routes"""
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        match = re.search(r'\{[\s\S]*\}', content)
+        if not match:
+            return None
+        try:
+            return json.loads(match.group())
+        except json.JSONDecodeError:
+            return None
+
+
+def _filler(size, unit):
+    return (unit * (size // len(unit) + 1))[:size]
+
+
+def realistic_fenced(size):
+    rules = [f'Rule {i}: keep answers about the menu {{no prices}} under "100 words"' for i in range(size // 70 + 1)]
+    body = json.dumps(dict(TEMPLATE, rules=rules), indent=2)
+    return f"Here are the updates you asked for:\n\n```json\n{body}\n```\n\nLet me know if you want {{more}} changes!"
+
+
+def realistic_prose(size):
+    prose = _filler(size, 'The template could use a clearer tone; consider "friendly" wording. ')
+    return f"{prose}\n{json.dumps(TEMPLATE)}\nThese changes keep the persona {{consistent}}."
+
+
+def open_braces_only(size):
+    # Opening braces and no closing one anywhere
+    return _filler(size, 'template {name ')
+
+
+def unbalanced_braces(size):
+    # Many opening braces that never close, then the real answer
+    return _filler(size, 'use {placeholders like {this ') + json.dumps(TEMPLATE)
+
+
+def braces_in_strings(size):
+    rules = [_filler(size, '}{"\\} '), 'Short rule']
+    return 'Result: ' + json.dumps(dict(TEMPLATE, rules=rules)) + ' -- done'
+
+
+def deep_nesting(size):
+    # Valid nesting the decoder can handle, then invalid nesting past its recursion limit
+    depth = min(size // 16, 500)
+    valid = '{"a": ' * depth + '1' + '}' * depth
+    depth = size // 16
+    invalid = '{"a": ' * depth + 'x' + '}' * depth
+    return f'Nested example: {valid}, a broken one: {invalid} and the answer {json.dumps(TEMPLATE)}'
+
+
+def deep_invalid_blocks(size):
+    # Many invalid objects nested just under the recursion limit, each failing at its core
+    block = '{"a": ' * 900 + '1,' + '}' * 900 + ' '
+    return block * max(size // len(block), 1) + json.dumps(TEMPLATE)
+
+
+def no_json(size):
+    return _filler(size, 'I could not produce a template for that request, sorry. ')
+
+
+CORPUS = {
+    'fenced ```json': realistic_fenced,
+    'prose + object': realistic_prose,
+    'unbalanced {': unbalanced_braces,
+    'open braces only': open_braces_only,
+    'braces in strings': braces_in_strings,
+    'deep nesting': deep_nesting,
+    'deep invalid blocks': deep_invalid_blocks,
+    'no JSON': no_json,
+}
+
+
+def timed(function, text, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(text)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def extract(text):
+    try:
+        return extract_json(text, check_template_fields)
+    except ExtractionError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-kb', type=int, default=512, help='largest response size in KB')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement (best is reported)')
+    parser.add_argument('--legacy-limit-kb', type=int, default=64,
+                        help='skip the legacy regex above this size on inputs where it goes quadratic')
+    args = parser.parse_args()
+
+    sizes = []
+    size = 8
+    while size <= args.max_kb:
+        sizes.append(size)
+        size *= 2
+
+    print(f"{'corpus':<20}{'KB':>6}{'extract ms':>12}{'growth':>8}{'legacy ms':>12}{'growth':>8}  found (legacy)")
+    for name, build in CORPUS.items():
+        previous = previous_legacy = None
+        for kb in sizes:
+            text = build(kb * 1024)
+            found = extract(text) is not None
+            elapsed = timed(extract, text, args.repeat)
+            growth = f'{elapsed / previous:.1f}x' if previous else ''
+            previous = elapsed
+
+            if name == 'open braces only' and kb > args.legacy_limit_kb:
+                legacy, legacy_growth, legacy_found = 'skipped', '', ''
+            else:
+                legacy_found = isinstance(legacy_extract(text), dict)
+                legacy_elapsed = timed(legacy_extract, text, args.repeat)
+                legacy = f'{legacy_elapsed * 1000:.2f}'
+                legacy_growth = f'{legacy_elapsed / previous_legacy:.1f}x' if previous_legacy else ''
+                previous_legacy = legacy_elapsed
+            print(f"{name:<20}{kb:>6}{elapsed * 1000:>12.2f}{growth:>8}{legacy:>12}{legacy_growth:>8}  {found} ({legacy_found})")
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""Local stand-in for the Perplexity chat-completions API.
+
+Answers POST /chat/completions with a template (schema generation) or a set of
+template updates (optimization), after a configurable latency with an optional
+slow tail, optionally streamed as Server-Sent Events, with injected 5xx and 429
+failures. Point the app at it with LLM_BASE_URL=http://127.0.0.1:<port>.
+
+    python benchmarks/fake_llm.py --port 8765 --latency 0.8 --jitter 0.2 --error-rate 0.02
+    python benchmarks/fake_llm.py --port 8766 --latency 0.3 --slow-rate 0.05 --slow-latency 5
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+GENERATED_TEMPLATE = {
+    'bio': 'A friendly ordering assistant for a neighbourhood bakery.',
+    'voice_style': 'Warm, concise and upbeat.',
+    'persona': {'name': 'Bella', 'occupation': 'Baker', 'personality': 'Cheerful and patient'},
+    'rules': ['Never promise delivery times', 'Quote prices as "from $X"', 'Escalate allergy questions'],
+    'instructions': ['Greet the customer', 'Take the order', 'Confirm the pickup time'],
+    'example_dialogue': ['Agent: Hi! What can I bake for you today?', 'Customer: A dozen croissants, please.',
+                         'Agent: Lovely, they will be ready at 9am.'],
+}
+
+
+class FakeLLMServer:
+    """Threaded HTTP server speaking just enough of the chat-completions protocol.
+
+    latency/jitter are seconds before the first byte, except for the slow_rate
+    fraction of requests that take slow_latency instead (a heavy tail, for
+    hedging). stream_delay is the pause between streamed chunks. error_rate and
+    rate_limit_rate are the fractions of requests answered with a 503 or a 429
+    (with Retry-After).
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, stream_delay=0.0,
+                 chunk_size=16, error_rate=0.0, rate_limit_rate=0.0, retry_after=1, slow_rate=0.0,
+                 slow_latency=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.stream_delay = stream_delay
+        self.chunk_size = chunk_size
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'streamed': 0, 'slow': 0, 'errors': 0, 'rate_limited': 0}
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _draw(self):
+        """Decide this request's fate and delay under one lock (random.Random is shared)"""
+        with self._lock:
+            self.stats['requests'] += 1
+            roll = self._random.random()
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            if self._random.random() < self.slow_rate:
+                self.stats['slow'] += 1
+                delay = self.slow_latency
+            if roll < self.error_rate:
+                self.stats['errors'] += 1
+                return 'error', delay
+            if roll < self.error_rate + self.rate_limit_rate:
+                self.stats['rate_limited'] += 1
+                return 'rate_limited', delay
+            return 'ok', delay
+
+    @staticmethod
+    def completion_content(payload):
+        """Updates for optimization prompts, a full template for everything else"""
+        system = next((m.get('content', '') for m in payload.get('messages', []) if m.get('role') == 'system'), '')
+        if 'optimizing' in system:
+            user = payload['messages'][-1].get('content', '')
+            return json.dumps({'rules': GENERATED_TEMPLATE['rules'] + [f'Follow-up rule #{len(user) % 97}']})
+        return json.dumps(GENERATED_TEMPLATE)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send_empty(self, status, headers=()):
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def _write_chunk(self, data):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                self.wfile.flush()
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                outcome, delay = server._draw()
+                time.sleep(delay)
+                if outcome == 'error':
+                    return self._send_empty(503)
+                if outcome == 'rate_limited':
+                    return self._send_empty(429, [('Retry-After', str(server.retry_after))])
+
+                content = server.completion_content(payload)
+                if payload.get('stream'):
+                    with server._lock:
+                        server.stats['streamed'] += 1
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    for start in range(0, len(content), server.chunk_size):
+                        event = {'choices': [{'delta': {'content': content[start:start + server.chunk_size]}}]}
+                        self._write_chunk(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+                        if server.stream_delay:
+                            time.sleep(server.stream_delay)
+                    self._write_chunk(b'data: [DONE]\n\n')
+                    self.wfile.write(b'0\r\n\r\n')
+                    return
+
+                body = json.dumps({
+                    'choices': [{'message': {'role': 'assistant', 'content': content}}],
+                    'usage': {'prompt_tokens': length // 4, 'completion_tokens': len(content) // 4}
+                }).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds before responding')
+    parser.add_argument('--jitter', type=float, default=0.1, help='+/- seconds of random latency')
+    parser.add_argument('--stream-delay', type=float, default=0.01, help='seconds between streamed chunks')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='fraction of requests taking --slow-latency')
+    parser.add_argument('--slow-latency', type=float, default=5.0, help='seconds before answering a slow request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered 503')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of requests answered 429')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = FakeLLMServer(args.host, args.port, args.latency, args.jitter, args.stream_delay,
+                           error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                           slow_rate=args.slow_rate, slow_latency=args.slow_latency, seed=args.seed)
+    print(f'Fake LLM server listening on {server.url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Seeded benchmark data: N templates, each with a lineage of copies.
+
+Rows are named with FIXTURE_PREFIX so they can be removed again without
+touching anything else in the database. The content is generated from a seed,
+so two runs with the same arguments load identical data.
+"""
+import random
+from datetime import datetime, timedelta
+from sqlalchemy import insert, delete, update, select
+
+FIXTURE_PREFIX = 'bench-'
+
+WORDS = ('order', 'menu', 'pickup', 'delivery', 'allergy', 'price', 'refund', 'schedule', 'booking', 'account',
+         'friendly', 'concise', 'customer', 'support', 'payment', 'discount', 'loyalty', 'weekend', 'gluten', 'vegan')
+
+
+def _sentence(rng, words=12):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def template_content(rng, rules=20, dialogue=12):
+    return {
+        'bio': ' '.join(_sentence(rng) for _ in range(4)),
+        'voice_style': _sentence(rng, 8),
+        'persona': {'name': rng.choice(WORDS).title(), 'occupation': rng.choice(WORDS),
+                    'personality': _sentence(rng, 6), 'skills': _sentence(rng, 6)},
+        'rules': [_sentence(rng) for _ in range(rules)],
+        'instructions': [_sentence(rng, 8) for _ in range(rules // 2)],
+        'example_dialogue': [f"{'Agent' if i % 2 == 0 else 'Customer'}: {_sentence(rng, 10)}" for i in range(dialogue)],
+    }
+
+
+def seed_templates(session, model, templates=200, chain=20, seed=1234, published_ratio=0.3):
+    """Insert templates with lineages of chain versions each; returns the root ids.
+
+    Each copy changes one rule and appends another, like an edit-and-copy cycle
+    in the UI. Runs in the given session and commits.
+    """
+    rng = random.Random(seed)
+    started = datetime.utcnow() - timedelta(days=30)
+    roots = []
+    for index in range(templates):
+        content = template_content(rng)
+        published = rng.random() < published_ratio
+        created_at = started + timedelta(minutes=index)
+        root_id = session.execute(insert(model).returning(model.id), [dict(
+            content, name=f'{FIXTURE_PREFIX}{index:05d}', published=published,
+            published_at=created_at if published else None, created_at=created_at, updated_at=created_at,
+            version_number=1)]).scalar_one()
+        roots.append(root_id)
+
+        versions = []
+        for version in range(2, chain + 1):
+            content = dict(content, rules=list(content['rules']))
+            content['rules'][rng.randrange(len(content['rules']))] = _sentence(rng)
+            content['rules'].append(_sentence(rng))
+            stamp = created_at + timedelta(seconds=version)
+            versions.append(dict(content, name=f'{FIXTURE_PREFIX}{index:05d} v{version}', published=False,
+                                 published_at=None, created_at=stamp, updated_at=stamp, original_id=root_id,
+                                 version_number=version, version_note=f'Copied from version {version - 1}'))
+        if versions:
+            session.execute(insert(model), versions)
+        session.commit()
+    return roots
+
+
+def fixture_ids(session, model):
+    return session.execute(
+        select(model.id).where(model.name.startswith(FIXTURE_PREFIX)).order_by(model.id)
+    ).scalars().all()
+
+
+def clear_fixtures(session, model):
+    """Delete every fixture row (lineage and delta links first, so no foreign key blocks the delete)"""
+    condition = model.name.startswith(FIXTURE_PREFIX)
+    session.execute(update(model).where(condition).values(original_id=None, delta_base_id=None,
+                                                          published_snapshot_id=None))
+    deleted = session.execute(delete(model).where(condition)).rowcount
+    session.commit()
+    return deleted
@@ -0,0 +1,342 @@
+"""Load scenarios against the app in-process, with a local fake LLM upstream.
+
+Seeds fixture templates (see fixtures.py), starts fake_llm.FakeLLMServer and
+points the app at it, then fires each scenario from a pool of threads, each
+with its own Flask test client. Per scenario it reports p50/p95/p99 latency,
+requests/s, SQL statements per request (counted with an engine event) and the
+peak RSS of the process so far.
+
+Run against a scratch database: fixtures are inserted into DATABASE_URL (and
+removed afterwards unless --keep-fixtures is given).
+
+    DATABASE_URL=postgresql://... python benchmarks/run.py --templates 200 --chain 20 \\
+        --requests 500 --concurrency 8 --scenarios messages,get-template,export-ndjson
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import resource
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event, select
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_llm import FakeLLMServer  # noqa: E402
+from fixtures import seed_templates, fixture_ids, clear_fixtures  # noqa: E402
+
+OPTIMIZATION_REQUEST = 'Add a rule about allergy questions and tighten the voice style'
+
+
+class Context:
+    """Fixture ids and per-thread clients/random generators shared by the scenarios"""
+
+    def __init__(self, app, roots, ids, seed):
+        self.app = app
+        self.roots = roots
+        self.ids = ids
+        self.seed = seed
+        self._local = threading.local()
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = self.app.test_client()
+        return self._local.client
+
+    @property
+    def random(self):
+        if not hasattr(self._local, 'random'):
+            with self._lock:
+                self._counter += 1
+                self._local.random = random.Random(self.seed + self._counter)
+        return self._local.random
+
+    def next_number(self):
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+
+def wait_for_job(ctx, response, timeout=60):
+    status_url = response.get_json()['status_url']
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = ctx.client.get(status_url)
+        if job.get_json()['status'] in ('succeeded', 'failed'):
+            return job
+        time.sleep(0.005)
+    raise TimeoutError(f'{status_url} did not finish within {timeout}s')
+
+
+def optimize_schema(ctx):
+    response = ctx.client.post(f'/optimize-schema/{ctx.random.choice(ctx.ids)}',
+                               json={'custom_optimization': OPTIMIZATION_REQUEST})
+    if response.status_code != 202:
+        return response
+    job = wait_for_job(ctx, response)
+    # A job that failed is reported with its own status code
+    return job if job.get_json()['status'] == 'succeeded' else _Status(job.get_json().get('status_code') or 500)
+
+
+class _Status:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def get_data(self):
+        return b''
+
+
+def generation_body(ctx):
+    # A distinct prompt per request, so the LLM response cache is not what gets measured
+    return {'prompt': f'A bakery ordering assistant, variant {ctx.next_number()}'}
+
+
+SCENARIOS = {
+    'messages': lambda ctx: ctx.client.get('/messages'),
+    'search': lambda ctx: ctx.client.get('/templates/search?q=allergy+menu'),
+    'optimize': lambda ctx: ctx.client.get('/optimize'),
+    'get-template': lambda ctx: ctx.client.get(f'/get-template/{ctx.random.choice(ctx.ids)}'),
+    'versions': lambda ctx: ctx.client.get(f'/messages/{ctx.random.choice(ctx.roots)}/versions'),
+    'optimize-schema': optimize_schema,
+    'generate-schema': lambda ctx: ctx.client.post('/generate-schema', json=generation_body(ctx)),
+    'generate-schema-stream': lambda ctx: ctx.client.post('/generate-schema/stream', json=generation_body(ctx)),
+    'export-one': lambda ctx: ctx.client.get(f'/messages/{ctx.random.choice(ctx.ids)}/export.json'),
+    'export-ndjson': lambda ctx: ctx.client.get('/messages/export.ndjson'),
+    'export-zip': lambda ctx: ctx.client.get('/messages/export.zip?ids=' +
+                                             ','.join(map(str, ctx.random.sample(ctx.ids, min(100, len(ctx.ids)))))),
+}
+
+DEFAULT_SCENARIOS = ('messages', 'optimize', 'get-template', 'optimize-schema', 'generate-schema',
+                     'generate-schema-stream', 'export-one', 'export-ndjson', 'export-zip')
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+class QueryCounter:
+    """Counts statements and their time on an engine via cursor execute events"""
+
+    def __init__(self, engine):
+        self.count = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        self._local.started = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - getattr(self._local, 'started', time.perf_counter())
+        with self._lock:
+            self.count += 1
+            self.seconds += elapsed
+
+    def snapshot(self):
+        with self._lock:
+            return self.count, self.seconds
+
+
+def run_scenario(ctx, counter, name, requests, concurrency):
+    scenario = SCENARIOS[name]
+    latencies, errors = [], {}
+    lock = threading.Lock()
+
+    def one(_):
+        started = time.perf_counter()
+        try:
+            response = scenario(ctx)
+            response.get_data()  # drain streamed bodies
+            status = response.status_code
+        except Exception as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            if not isinstance(status, int) or status >= 400:
+                errors[str(status)] = errors.get(str(status), 0) + 1
+
+    queries_before, sql_before = counter.snapshot()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+    queries, sql_seconds = counter.snapshot()
+
+    latencies.sort()
+    return {
+        'scenario': name,
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'requests_per_s': round(requests / wall, 1),
+        'queries_per_request': round((queries - queries_before) / requests, 2),
+        'sql_ms_per_request': round((sql_seconds - sql_before) * 1000 / requests, 2),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def copy_hammer(ctx, app_module, copies, concurrency):
+    """Concurrent copies of one template; every copy must get its own version number"""
+    root = ctx.roots[0]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        statuses = list(pool.map(lambda _: ctx.client.post(f'/messages/{root}/copy').status_code, range(copies)))
+    wall = time.perf_counter() - started
+    with ctx.app.app_context():
+        Message = app_module.Message
+        numbers = app_module.db.session.execute(
+            select(Message.version_number).where(Message.id.in_(app_module.lineage_ids(root)))
+        ).scalars().all()
+    return {
+        'scenario': 'copy-hammer',
+        'requests': copies,
+        'concurrency': concurrency,
+        'errors': {str(status): statuses.count(status) for status in set(statuses) if status >= 400},
+        'copies_per_s': round(copies / wall, 1),
+        'lineage_versions': len(numbers),
+        'duplicate_version_numbers': len(numbers) - len(set(numbers)),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def print_table(results):
+    print(f"\n{'scenario':<24}{'reqs':>6}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'req/s':>8}{'queries':>9}{'sql ms':>8}{'RSS MB':>8}")
+    for result in results:
+        if result['scenario'] == 'copy-hammer':
+            continue
+        print(f"{result['scenario']:<24}{result['requests']:>6}{sum(result['errors'].values()):>8}"
+              f"{result['p50_ms']:>9}{result['p95_ms']:>9}{result['p99_ms']:>9}{result['requests_per_s']:>8}"
+              f"{result['queries_per_request']:>9}{result['sql_ms_per_request']:>8}{result['peak_rss_mb']:>8}")
+    for result in results:
+        if result['scenario'] == 'copy-hammer':
+            print(f"\ncopy-hammer: {result['requests']} copies at concurrency {result['concurrency']}, "
+                  f"{result['copies_per_s']} copies/s, {result['duplicate_version_numbers']} duplicate version "
+                  f"numbers across {result['lineage_versions']} versions, errors {result['errors'] or 'none'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=','.join(DEFAULT_SCENARIOS),
+                        help=f"comma-separated, from: {', '.join(SCENARIOS)}, copy-hammer")
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--templates', type=int, default=100, help='fixture templates to seed')
+    parser.add_argument('--chain', type=int, default=20, help='versions per fixture lineage')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--keep-fixtures', action='store_true', help='leave the fixtures in the database')
+    parser.add_argument('--reuse-fixtures', action='store_true', help='use fixtures left by an earlier run')
+    parser.add_argument('--copies', type=int, default=100, help='copies made by the copy-hammer scenario')
+    parser.add_argument('--llm-latency', type=float, default=0.2)
+    parser.add_argument('--llm-jitter', type=float, default=0.05)
+    parser.add_argument('--llm-stream-delay', type=float, default=0.002)
+    parser.add_argument('--llm-error-rate', type=float, default=0.0)
+    parser.add_argument('--llm-rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--llm-slow-rate', type=float, default=0.0, help='fraction of LLM calls in the slow tail')
+    parser.add_argument('--llm-slow-latency', type=float, default=3.0)
+    parser.add_argument('--no-hedge', action='store_true', help='disable hedged LLM requests')
+    parser.add_argument('--fallback', action='store_true',
+                        help='start a second, healthy fake LLM server as the fallback target of every route')
+    parser.add_argument('--llm-cache', action='store_true', help='keep the LLM response cache enabled')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='keep the app\'s INFO/DEBUG logging')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS and name != 'copy-hammer']
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    if not os.environ.get('DATABASE_URL'):
+        parser.error('DATABASE_URL must point at a scratch database')
+
+    fake = FakeLLMServer(latency=args.llm_latency, jitter=args.llm_jitter, stream_delay=args.llm_stream_delay,
+                         error_rate=args.llm_error_rate, rate_limit_rate=args.llm_rate_limit_rate,
+                         slow_rate=args.llm_slow_rate, slow_latency=args.llm_slow_latency, seed=args.seed).start()
+    fallback = None
+    # The app reads its configuration from the environment when it is created
+    os.environ['LLM_BASE_URL'] = fake.url
+    os.environ.setdefault('PERPLEXITY_API_KEY', 'benchmark')
+    if not args.llm_cache:
+        os.environ['LLM_CACHE_ENABLED'] = '0'
+    if args.no_hedge:
+        os.environ['LLM_HEDGE_ENABLED'] = '0'
+    if args.fallback:
+        fallback = FakeLLMServer(latency=args.llm_latency, jitter=args.llm_jitter,
+                                 stream_delay=args.llm_stream_delay, seed=args.seed + 1).start()
+        os.environ['LLM_PROVIDERS'] = json.dumps({'fallback': {'base_url': fallback.url}})
+        os.environ['LLM_ROUTES'] = json.dumps({route: ['default', 'fallback'] for route in ('optimize', 'generate')})
+
+    import logging
+    import app as app_module
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    app = app_module.create_app({'WTF_CSRF_ENABLED': False})
+    Message = app_module.Message
+
+    with app.app_context():
+        app_module.upgrade_schema()
+        session = app_module.db.session
+        if not args.reuse_fixtures:
+            clear_fixtures(session, Message)
+            started = time.perf_counter()
+            roots = seed_templates(session, Message, args.templates, args.chain, args.seed)
+            print(f'Seeded {args.templates} templates x {args.chain} versions in {time.perf_counter() - started:.1f}s')
+        ids = fixture_ids(session, Message)
+        if args.reuse_fixtures:
+            roots = session.execute(select(Message.id).where(
+                Message.id.in_(ids), Message.original_id.is_(None)).order_by(Message.id)).scalars().all()
+        if not ids:
+            parser.error('no fixtures found')
+        counter = QueryCounter(app_module.db.engine)
+
+    ctx = Context(app, roots, ids, args.seed)
+    results = []
+    try:
+        for name in names:
+            if name == 'copy-hammer':
+                results.append(copy_hammer(ctx, app_module, args.copies, args.concurrency))
+            else:
+                results.append(run_scenario(ctx, counter, name, args.requests, args.concurrency))
+            print(f"{name}: done", file=sys.stderr)
+    finally:
+        if not args.keep_fixtures:
+            with app.app_context():
+                clear_fixtures(app_module.db.session, Message)
+        fake.stop()
+        if fallback is not None:
+            fallback.stop()
+
+    print_table(results)
+    print(f"\nfake LLM: {fake.stats}")
+    if fallback is not None:
+        print(f"fallback LLM: {fallback.stats}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'arguments': vars(args), 'llm': fake.stats, 'fallback_llm': fallback and fallback.stats,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
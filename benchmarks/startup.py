@@ -0,0 +1,83 @@
+"""Measure cold start: importing the app module and running create_app().
+
+Each run is a fresh interpreter, so nothing is warm in sys.modules. The
+database URL points at a closed port by default: create_app() must not connect,
+so any attempt to fails the run instead of quietly adding a round trip. Exits
+non-zero when the median total is over --target seconds.
+
+    python benchmarks/startup.py [--runs 5] [--target 1.5] [--importtime]
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child interpreter; prints the timings as one JSON line
+PROBE = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+print(json.dumps({'import': imported - started, 'create_app': created - imported, 'total': created - started,
+                  'routes': len(list(application.url_map.iter_rules()))}))
+"""
+
+
+def probe(env):
+    result = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f'create_app() failed:\n{result.stderr}')
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(env, count):
+    """The app module's direct imports with the largest cumulative time, from python -X importtime"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=ROOT, env=env,
+                            capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # importtime indents two spaces per level: keep the app's direct imports, whose times include theirs
+        if name.startswith('   ') and not name.startswith('     '):
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--target', type=float, default=1.5, help='maximum median seconds to a ready app')
+    parser.add_argument('--database-url', default='postgresql+psycopg2://127.0.0.1:9/unreachable',
+                        help='database the app is configured with (never contacted)')
+    parser.add_argument('--importtime', action='store_true', help='also list the slowest imports of the app module')
+    args = parser.parse_args()
+
+    env = dict(os.environ, DATABASE_URL=args.database_url, LOG_LEVEL='WARNING', SCHEMA_AUTO_UPGRADE='0')
+    runs = [probe(env) for _ in range(args.runs)]
+    print(f"{'stage':<12}{'median ms':>11}{'max ms':>9}")
+    for stage in ('import', 'create_app', 'total'):
+        values = [run[stage] * 1000 for run in runs]
+        print(f'{stage:<12}{statistics.median(values):>11.1f}{max(values):>9.1f}')
+    print(f"{runs[0]['routes']} routes registered")
+
+    if args.importtime:
+        print(f"\n{'cumulative ms':>14}  module")
+        for microseconds, name in slowest_imports(env, 10):
+            print(f'{microseconds / 1000:>14.1f}  {name}')
+
+    median = statistics.median(run['total'] for run in runs)
+    if median > args.target:
+        print(f'\nCold start {median:.2f}s is over the {args.target:.2f}s target', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import json
+import mmap
+import struct
+import time
+
+# File layout (all integers little-endian):
+#   header   magic, format version, entry count, index offset, build time
+#   data     per entry: a small JSON metadata record followed by the UTF-8 prompt
+#   index    fixed-size entries sorted by message id, pointing into the data section
+MAGIC = b'SPCATLG\x00'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIQQ')
+INDEX_ENTRY = struct.Struct('<QQIIQIQI')
+
+
+class CatalogError(Exception):
+    """Raised when a catalog file is truncated or not a prompt catalog"""
+
+
+def _json_default(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def write_catalog(fileobj, entries):
+    """Write published prompts to a seekable binary file object.
+
+    entries yields dicts with message_id, snapshot_id, revision, version_number,
+    prompt and any extra metadata (name, published_at, content_hash). Prompts
+    are written as they arrive; only the fixed-size index is held in memory.
+    Returns the number of entries written.
+    """
+    start = fileobj.tell()
+    fileobj.write(b'\x00' * HEADER.size)
+    offset = HEADER.size
+    index = []
+    for entry in entries:
+        entry = dict(entry)
+        prompt = entry.pop('prompt').encode('utf-8')
+        message_id = entry.pop('message_id')
+        snapshot_id = entry.pop('snapshot_id') or 0
+        revision = entry.pop('revision') or 0
+        version_number = entry.pop('version_number') or 0
+        meta = json.dumps(entry, default=_json_default, separators=(',', ':')).encode('utf-8')
+        fileobj.write(meta)
+        fileobj.write(prompt)
+        index.append((message_id, snapshot_id, revision, version_number,
+                      offset, len(meta), offset + len(meta), len(prompt)))
+        offset += len(meta) + len(prompt)
+
+    index.sort()
+    for item in index:
+        fileobj.write(INDEX_ENTRY.pack(*item))
+    end = fileobj.tell()
+    fileobj.seek(start)
+    fileobj.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(index), offset, int(time.time())))
+    fileobj.seek(end)
+    return len(index)
+
+
+class PromptCatalog:
+    """Read-only view of a catalog file through mmap.
+
+    Opening only parses the header; lookups binary-search the index in place
+    and prompt_bytes() returns a memoryview into the mapping, so nothing is
+    copied until a caller decodes it. Those views pin the mapping: release
+    them (or use prompt(), which copies) before close().
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                # mmap refuses empty files
+                raise CatalogError(f'{path} is not a prompt catalog: {e}') from e
+        try:
+            if len(self._mmap) < HEADER.size:
+                raise CatalogError(f'{path} is too short to be a prompt catalog')
+            magic, version, self.count, self._index_offset, self.built_at = HEADER.unpack_from(self._mmap, 0)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise CatalogError(f'{path} is not a version {FORMAT_VERSION} prompt catalog')
+            if self._index_offset + self.count * INDEX_ENTRY.size > len(self._mmap):
+                raise CatalogError(f'{path} is truncated')
+        except CatalogError:
+            self._mmap.close()
+            raise
+        self._view = memoryview(self._mmap)
+
+    def _entry(self, position):
+        return INDEX_ENTRY.unpack_from(self._mmap, self._index_offset + position * INDEX_ENTRY.size)
+
+    def _find(self, message_id):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            entry = self._entry(middle)
+            if entry[0] < message_id:
+                low = middle + 1
+            elif entry[0] > message_id:
+                high = middle
+            else:
+                return entry
+        return None
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, message_id):
+        return self._find(message_id) is not None
+
+    def ids(self):
+        return [self._entry(position)[0] for position in range(self.count)]
+
+    def prompt_bytes(self, message_id):
+        """Zero-copy view of the UTF-8 prompt, or None if the id is not in the catalog"""
+        entry = self._find(message_id)
+        if entry is None:
+            return None
+        return self._view[entry[6]:entry[6] + entry[7]]
+
+    def prompt(self, message_id):
+        data = self.prompt_bytes(message_id)
+        if data is None:
+            return None
+        with data:
+            return str(data, 'utf-8')
+
+    def metadata(self, message_id):
+        entry = self._find(message_id)
+        if entry is None:
+            return None
+        meta = json.loads(bytes(self._view[entry[4]:entry[4] + entry[5]]))
+        meta.update(message_id=entry[0], snapshot_id=entry[1] or None,
+                    revision=entry[2] or None, version_number=entry[3] or None)
+        return meta
+
+    def close(self):
+        """Unmap the file; raises CatalogError while views from prompt_bytes() are still alive"""
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError as e:
+            raise CatalogError('prompt_bytes() views are still in use; release them before closing') from e
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
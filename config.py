@@ -0,0 +1,132 @@
+import os
+import json
+from metrics import InstrumentedQueuePool
+
+
+def load_config(app):
+    """Read the app's settings from the environment (see README for each group)"""
+    app.secret_key = os.environ.get("FLASK_SECRET_KEY", "dev")
+
+    # Bearer token that lets scripts call the JSON API routes without a CSRF token (unset: browsers only)
+    app.config["API_TOKEN"] = os.environ.get("API_TOKEN")
+
+    # Database configuration with enhanced connection settings
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_pre_ping": True,           # Enable connection pre-ping
+        "pool_recycle": 300,             # Recycle connections every 5 minutes
+        "pool_timeout": 30,              # Connection timeout of 30 seconds
+        "max_overflow": 10,              # Allow up to 10 connections over pool size
+        "pool_size": 5,                  # Maintain a pool of 5 connections
+        "poolclass": InstrumentedQueuePool,  # QueuePool that records checkout wait time for /metrics
+        "connect_args": {
+            "connect_timeout": 10,        # PostgreSQL connection timeout
+            "keepalives": 1,             # Enable keepalive
+            "keepalives_idle": 30,       # Idle time before sending keepalive
+            "keepalives_interval": 10,    # Interval between keepalives
+            "keepalives_count": 5        # Number of keepalive attempts
+        }
+    }
+
+    # LLM client configuration (chat-completions endpoint, pooling, timeouts, retries)
+    app.config["LLM_BASE_URL"] = os.environ.get("LLM_BASE_URL", "https://api.perplexity.ai")
+    app.config["LLM_API_KEY"] = os.environ.get("PERPLEXITY_API_KEY")
+    app.config["LLM_MODEL"] = os.environ.get("LLM_MODEL", "llama-3.1-sonar-small-128k-online")
+    app.config["LLM_CONNECT_TIMEOUT"] = float(os.environ.get("LLM_CONNECT_TIMEOUT", 5))
+    app.config["LLM_READ_TIMEOUT"] = float(os.environ.get("LLM_READ_TIMEOUT", 30))
+    app.config["LLM_MAX_RETRIES"] = int(os.environ.get("LLM_MAX_RETRIES", 2))
+    app.config["LLM_BACKOFF_BASE"] = float(os.environ.get("LLM_BACKOFF_BASE", 0.5))
+    app.config["LLM_BACKOFF_MAX"] = float(os.environ.get("LLM_BACKOFF_MAX", 8))
+    app.config["LLM_POOL_SIZE"] = int(os.environ.get("LLM_POOL_SIZE", 10))
+    app.config["LLM_BREAKER_THRESHOLD"] = int(os.environ.get("LLM_BREAKER_THRESHOLD", 5))
+    app.config["LLM_BREAKER_RESET"] = float(os.environ.get("LLM_BREAKER_RESET", 30))
+
+    # LLM response cache (in-process LRU, plus a SQLite tier when LLM_CACHE_PATH is set)
+    app.config["LLM_CACHE_ENABLED"] = os.environ.get("LLM_CACHE_ENABLED", "1") == "1"
+    app.config["LLM_CACHE_SIZE"] = int(os.environ.get("LLM_CACHE_SIZE", 256))
+    app.config["LLM_CACHE_TTL"] = float(os.environ.get("LLM_CACHE_TTL", 3600))
+    app.config["LLM_CACHE_PATH"] = os.environ.get("LLM_CACHE_PATH")
+
+    # Upstream call shaping: coalesce identical in-flight calls, local requests/tokens per minute limits (0 = unlimited)
+    app.config["LLM_SINGLEFLIGHT"] = os.environ.get("LLM_SINGLEFLIGHT", "1") == "1"
+    app.config["LLM_RATE_LIMIT_RPM"] = int(os.environ.get("LLM_RATE_LIMIT_RPM", 0))
+    app.config["LLM_RATE_LIMIT_TPM"] = int(os.environ.get("LLM_RATE_LIMIT_TPM", 0))
+    app.config["LLM_RATE_LIMIT_MAX_WAIT"] = float(os.environ.get("LLM_RATE_LIMIT_MAX_WAIT", 2.0))
+
+    # Extra LLM providers and per-route targets in fallback order, as JSON (see README); the LLM_* keys above
+    # configure the "default" provider and are the defaults for the others
+    app.config["LLM_PROVIDERS"] = json.loads(os.environ.get("LLM_PROVIDERS") or "{}")
+    app.config["LLM_ROUTES"] = json.loads(os.environ.get("LLM_ROUTES") or "{}")
+
+    # Hedged requests: duplicate a call still unanswered after the target's recent latency quantile
+    app.config["LLM_HEDGE_ENABLED"] = os.environ.get("LLM_HEDGE_ENABLED", "1") == "1"
+    app.config["LLM_HEDGE_QUANTILE"] = float(os.environ.get("LLM_HEDGE_QUANTILE", 0.95))
+    app.config["LLM_HEDGE_MIN_SAMPLES"] = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", 20))
+    app.config["LLM_HEDGE_MIN_DELAY"] = float(os.environ.get("LLM_HEDGE_MIN_DELAY", 0.5))
+
+    # Background job queue for LLM-backed optimizations ("memory" or "sqlite" backend)
+    app.config["JOB_BACKEND"] = os.environ.get("JOB_BACKEND", "memory")
+    app.config["JOB_DB_PATH"] = os.environ.get("JOB_DB_PATH", "jobs.sqlite3")
+    app.config["JOB_WORKERS"] = int(os.environ.get("JOB_WORKERS", 4))
+    app.config["JOB_MAX_PENDING"] = int(os.environ.get("JOB_MAX_PENDING", 100))
+    app.config["JOB_RESULT_TTL"] = float(os.environ.get("JOB_RESULT_TTL", 3600))
+
+    # Bulk optimization fan-out limits
+    app.config["BATCH_MAX_SIZE"] = int(os.environ.get("BATCH_MAX_SIZE", 500))
+    app.config["BATCH_CONCURRENCY"] = int(os.environ.get("BATCH_CONCURRENCY", 4))
+    app.config["BATCH_MAX_CONCURRENCY"] = int(os.environ.get("BATCH_MAX_CONCURRENCY", 16))
+    app.config["BATCH_COMMIT_SIZE"] = int(os.environ.get("BATCH_COMMIT_SIZE", 20))
+    app.config["BATCH_RATE_LIMIT_RETRIES"] = int(os.environ.get("BATCH_RATE_LIMIT_RETRIES", 3))
+
+    # Website content ingestion for schema generation
+    app.config["INGEST_TTL"] = float(os.environ.get("INGEST_TTL", 3600))
+    app.config["INGEST_CACHE_SIZE"] = int(os.environ.get("INGEST_CACHE_SIZE", 128))
+    app.config["INGEST_TIMEOUT"] = float(os.environ.get("INGEST_TIMEOUT", 10))
+    app.config["INGEST_MAX_WORKERS"] = int(os.environ.get("INGEST_MAX_WORKERS", 4))
+    app.config["INGEST_MAX_URLS"] = int(os.environ.get("INGEST_MAX_URLS", 5))
+    app.config["INGEST_TOKEN_BUDGET"] = int(os.environ.get("INGEST_TOKEN_BUDGET", 3000))
+
+    # Template listing page sizes
+    app.config["PAGE_SIZE"] = int(os.environ.get("PAGE_SIZE", 50))
+    app.config["MAX_PAGE_SIZE"] = int(os.environ.get("MAX_PAGE_SIZE", 200))
+
+    # Bulk export: rows fetched per round trip from the server-side cursor
+    app.config["EXPORT_BATCH_SIZE"] = int(os.environ.get("EXPORT_BATCH_SIZE", 200))
+
+    # Bulk import: rows per executemany/transaction and the most rows accepted per request
+    app.config["IMPORT_CHUNK_SIZE"] = int(os.environ.get("IMPORT_CHUNK_SIZE", 500))
+    app.config["IMPORT_MAX_ROWS"] = int(os.environ.get("IMPORT_MAX_ROWS", 10000))
+
+    # HTTP caching for template reads: published templates may be cached downstream,
+    # drafts must always be revalidated (cheap thanks to ETag / 304)
+    app.config["PUBLISHED_CACHE_CONTROL"] = os.environ.get("PUBLISHED_CACHE_CONTROL", "public, max-age=60")
+    app.config["DRAFT_CACHE_CONTROL"] = os.environ.get("DRAFT_CACHE_CONTROL", "private, no-cache")
+
+    # Compiled prompt serving: cached prompts and how long one is served before updated_at is re-checked
+    app.config["PROMPT_CACHE_SIZE"] = int(os.environ.get("PROMPT_CACHE_SIZE", 1024))
+    app.config["PROMPT_CACHE_REVALIDATE"] = float(os.environ.get("PROMPT_CACHE_REVALIDATE", 5))
+
+    # Optimization prompts: estimated token budget, and whether to send only the fields a request is about
+    app.config["PROMPT_TOKEN_BUDGET"] = int(os.environ.get("PROMPT_TOKEN_BUDGET", 4000))
+    app.config["PROMPT_SELECT_FIELDS"] = os.environ.get("PROMPT_SELECT_FIELDS", "1") == "1"
+
+    # Version storage: "full" copies every version; "delta" keeps every Nth version (and the
+    # newest) in full and stores the others as JSON Patches against them
+    app.config["VERSION_STORAGE"] = os.environ.get("VERSION_STORAGE", "full")
+    app.config["VERSION_KEYFRAME_INTERVAL"] = int(os.environ.get("VERSION_KEYFRAME_INTERVAL", 10))
+    app.config["VERSION_CACHE_SIZE"] = int(os.environ.get("VERSION_CACHE_SIZE", 256))
+
+    # Near-duplicate detection: hashed n-gram vector width, the share of changed rows that triggers a
+    # rebuild (to refresh IDF weights), and the default similarity for the duplicates report
+    app.config["SIMILARITY_DIMENSIONS"] = int(os.environ.get("SIMILARITY_DIMENSIONS", 1024))
+    app.config["SIMILARITY_REBUILD_FRACTION"] = float(os.environ.get("SIMILARITY_REBUILD_FRACTION", 0.25))
+    app.config["SIMILARITY_DUPLICATE_THRESHOLD"] = float(os.environ.get("SIMILARITY_DUPLICATE_THRESHOLD", 0.9))
+
+    # Logging: root level, and SQL statement logging (very verbose; off unless SQL_LOG=1)
+    app.config["LOG_LEVEL"] = os.environ.get("LOG_LEVEL", "INFO").upper()
+    app.config["SQL_LOG"] = os.environ.get("SQL_LOG", "0") == "1"
+
+    # Create missing tables and apply migrations.MIGRATIONS when the app is created; off by default,
+    # run `flask upgrade-db` as a deploy step instead
+    app.config["SCHEMA_AUTO_UPGRADE"] = os.environ.get("SCHEMA_AUTO_UPGRADE", "0") == "1"
@@ -0,0 +1,99 @@
+import io
+import re
+import json
+import zipfile
+from xml.sax.saxutils import escape
+
+# Bulk export formats and the mimetype each is served with
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+    'zip': 'application/zip'
+}
+
+
+def cdata(value):
+    """Wrap text in a CDATA section, splitting any ']]>' it contains"""
+    return '<![CDATA[' + str(value).replace(']]>', ']]]]><![CDATA[>') + ']]>'
+
+
+def render_message_xml(message):
+    """XML document for a single message"""
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
+<message>
+    <id>{message.id}</id>
+    <name>{escape(message.name)}</name>
+    <bio>{cdata(message.bio)}</bio>
+    <voice_style>{cdata(message.voice_style)}</voice_style>
+    <persona>{cdata(json.dumps(message.persona))}</persona>
+    <rules>{cdata(json.dumps(message.rules))}</rules>
+    <instructions>{cdata(json.dumps(message.instructions))}</instructions>
+    <example_dialogue>{cdata(json.dumps(message.example_dialogue))}</example_dialogue>
+    <published>{str(message.published).lower()}</published>
+    <published_at>{message.published_at.isoformat() if message.published_at else ''}</published_at>
+    <created_at>{message.created_at.isoformat()}</created_at>
+    <updated_at>{message.updated_at.isoformat()}</updated_at>
+</message>'''
+
+
+def ndjson_stream(messages):
+    """One JSON document per line"""
+    for message in messages:
+        yield json.dumps(message.to_dict()) + '\n'
+
+
+def json_array_stream(messages):
+    """A single JSON array, emitted one element at a time"""
+    yield '['
+    separator = '\n'
+    for message in messages:
+        yield separator + json.dumps(message.to_dict())
+        separator = ',\n'
+    yield '\n]\n'
+
+
+class _ZipSink(io.RawIOBase):
+    """Write-only, unseekable file object that collects what zipfile writes.
+
+    Because tell() and seek() are unsupported, zipfile writes each entry with a
+    trailing data descriptor instead of seeking back to patch its header, so the
+    archive can be sent as it is produced.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def archive_filename(message, extension):
+    slug = re.sub(r'[^a-z0-9]+', '-', (message.name or '').lower()).strip('-')[:50] or 'template'
+    return f"{message.id:06d}-{slug}.{extension}"
+
+
+def zip_stream(messages, file_format='json'):
+    """A ZIP archive with one file per message, yielded entry by entry"""
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for message in messages:
+            if file_format == 'xml':
+                content = render_message_xml(message)
+            else:
+                content = json.dumps(message.to_dict(), indent=2)
+            info = zipfile.ZipInfo(archive_filename(message, file_format),
+                                   date_time=(message.updated_at or message.created_at).timetuple()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            archive.writestr(info, content)
+            yield sink.drain()
+    # Closing the archive writes the central directory
+    yield sink.drain()
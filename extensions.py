@@ -0,0 +1,6 @@
+"""Extensions shared by the models and the views, bound to an app by create_app()"""
+from flask_sqlalchemy import SQLAlchemy
+from flask_wtf.csrf import CSRFProtect
+
+db = SQLAlchemy()
+csrf = CSRFProtect()
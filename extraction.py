@@ -0,0 +1,153 @@
+import re
+import json
+
+# Shapes accepted for each template field in model output; importer.normalize_template
+# turns the alternatives into the stored shapes
+TEMPLATE_FIELD_TYPES = {
+    'bio': (str,),
+    'voice_style': (str,),
+    'persona': (dict, str),
+    'rules': (list, str),
+    'instructions': (list, str),
+    'example_dialogue': (list, dict, str),
+}
+
+_STRUCTURE = re.compile(r'[{}"]')
+_STRING_REST = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+_OBJECT_START = re.compile(r'\{\s*["}]')
+_FENCE = '```'
+_DECODER = json.JSONDecoder()
+
+
+class ExtractionError(ValueError):
+    """Raised when a response holds no JSON object that passes validation"""
+
+
+def fenced_blocks(text):
+    """Contents of ``` fenced blocks, with any language tag (```json) dropped"""
+    position = 0
+    while True:
+        start = text.find(_FENCE, position)
+        if start == -1:
+            return
+        end = text.find(_FENCE, start + len(_FENCE))
+        if end == -1:
+            return
+        block = text[start + len(_FENCE):end]
+        newline = block.find('\n')
+        if newline != -1 and not block[:newline].strip().startswith(('{', '[')):
+            block = block[newline + 1:]
+        yield block
+        position = end + len(_FENCE)
+
+
+def json_object_spans(text):
+    """(start, end) of every balanced {...} span, outermost first, in one pass.
+
+    Braces are matched with a stack. Quotes are only treated as strings inside
+    braces, so apostrophes and quotes in surrounding prose do not throw off the
+    scan, while braces inside JSON strings are skipped. The scan visits each
+    character once: the regexes jump straight to the next brace or quote.
+    """
+    spans, stack = [], []
+    position, length = 0, len(text)
+    while True:
+        match = _STRUCTURE.search(text, position)
+        if match is None:
+            break
+        char, position = match.group(), match.end()
+        if char == '{':
+            stack.append(match.start())
+        elif char == '}':
+            if stack:
+                spans.append((stack.pop(), position))
+        elif stack:
+            # Skip to the closing quote, stepping over escapes
+            end = _STRING_REST.match(text, position)
+            position = end.end() if end is not None else length
+    spans.sort()
+    return spans
+
+
+def _candidates(text):
+    """Decoded JSON objects in the order they are tried.
+
+    The whole response first, then fenced blocks, then balanced spans. Spans
+    that cannot start a JSON object are skipped without parsing, and once a
+    span parses, the spans nested inside it are not tried on their own. When
+    a span fails at some position, the nested spans that run past it would
+    fail there too and are skipped; those that close before it did parse as
+    part of the span and are still tried. So each character of the spans is
+    decoded at most twice however deep the nesting. JSON nested deeper than
+    the decoder's recursion limit counts as unparseable, along with
+    everything nested inside it.
+    """
+    stripped = text.strip()
+    if stripped.startswith('{'):
+        try:
+            yield json.loads(stripped)
+        except (json.JSONDecodeError, RecursionError):
+            pass
+    for block in fenced_blocks(text):
+        try:
+            yield json.loads(block)
+        except (json.JSONDecodeError, RecursionError):
+            pass
+    parsed_until = failed_at = 0
+    for start, end in json_object_spans(text):
+        if start < parsed_until or (start < failed_at < end) or not _OBJECT_START.match(text, start):
+            continue
+        try:
+            # Decode in place: slicing each span out would copy the nested ones over and over
+            value, parsed_until = _DECODER.raw_decode(text, start)
+        except json.JSONDecodeError as e:
+            failed_at = max(failed_at, e.pos)
+            continue
+        except RecursionError:
+            parsed_until = end
+            continue
+        yield value
+
+
+def extract_json(text, validate=None):
+    """The first JSON object in an LLM response that validate accepts.
+
+    Handles bare JSON, ```json fenced blocks and objects surrounded by prose or
+    followed by commentary. validate(obj) returns the (possibly normalized)
+    object or raises ExtractionError to move on to the next candidate.
+    Raises ExtractionError if nothing is accepted.
+    """
+    if not isinstance(text, str):
+        raise ExtractionError('Response content is not text')
+    reason = 'No JSON object found in response'
+    for value in _candidates(text):
+        if not isinstance(value, dict):
+            reason = f'Expected a JSON object, got {type(value).__name__}'
+            continue
+        if validate is None:
+            return value
+        try:
+            return validate(value)
+        except ExtractionError as e:
+            reason = str(e)
+    raise ExtractionError(reason)
+
+
+def check_template_fields(data, required=False):
+    """Validate template fields in model output.
+
+    With required=True every template field must be present (a generated
+    schema); otherwise at least one must be (a set of updates). Unknown keys
+    are dropped. Returns the template fields.
+    """
+    fields = {field: data[field] for field in TEMPLATE_FIELD_TYPES if field in data}
+    if required:
+        missing = [field for field in TEMPLATE_FIELD_TYPES if field not in fields]
+        if missing:
+            raise ExtractionError(f"Missing required fields: {', '.join(missing)}")
+    elif not fields:
+        raise ExtractionError('No template fields in response')
+    for field, value in fields.items():
+        if not isinstance(value, TEMPLATE_FIELD_TYPES[field]):
+            raise ExtractionError(f'{field} has unexpected type {type(value).__name__}')
+    return fields
@@ -0,0 +1,14 @@
+"""Reading stored template fields whose shape changed over time"""
+import json
+
+
+def as_list(value):
+    """List fields may hold a JSON-encoded string from older edits; decode those"""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            return [value] if value.strip() else []
+    if isinstance(value, dict):
+        return [f"{key}: {text}" for key, text in value.items()]
+    return list(value or [])
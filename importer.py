@@ -0,0 +1,183 @@
+import json
+import logging
+from sqlalchemy import select, insert, update, func
+from sqlalchemy.exc import SQLAlchemyError
+
+logger = logging.getLogger(__name__)
+
+IMPORT_MODES = ('insert', 'upsert')
+
+# Fields overwritten when an upsert matches an existing template by name; the
+# publishing state is left to the publish workflow
+UPSERT_FIELDS = ('bio', 'voice_style', 'persona', 'rules', 'instructions', 'example_dialogue',
+                 'version_note', 'updated_at')
+
+LIST_FIELDS = ('rules', 'instructions', 'example_dialogue')
+
+
+def normalize_template(data):
+    """Coerce a generated or imported template into the shapes stored in the database.
+
+    persona may be a JSON string or free text, example_dialogue a role->text
+    dict or newline-separated text, and rules/instructions a single string.
+    """
+    persona = data.get('persona', {})
+    if isinstance(persona, str):
+        try:
+            persona = json.loads(persona)
+        except json.JSONDecodeError:
+            persona = {'description': persona}
+
+    example_dialogue = data.get('example_dialogue', [])
+    if isinstance(example_dialogue, dict):
+        example_dialogue = [f"{role}: {text}" for role, text in example_dialogue.items()]
+    elif isinstance(example_dialogue, str):
+        example_dialogue = [line.strip() for line in example_dialogue.split('\n') if line.strip()]
+
+    rules = data.get('rules', [])
+    if isinstance(rules, str):
+        rules = [rules]
+
+    instructions = data.get('instructions', [])
+    if isinstance(instructions, str):
+        instructions = [instructions]
+
+    return dict(data, persona=persona, example_dialogue=example_dialogue, rules=rules, instructions=instructions)
+
+
+def parse_import_payload(text):
+    """Split an NDJSON or JSON array body into rows.
+
+    Returns ([(position, row)], errors). Positions are 1-based array indexes or
+    NDJSON line numbers; lines that are not valid JSON are reported as errors.
+    """
+    stripped = text.lstrip()
+    if stripped.startswith('['):
+        try:
+            rows = json.loads(stripped)
+        except json.JSONDecodeError as e:
+            return [], [{'row': None, 'error': f'Invalid JSON array: {e}'}]
+        return list(enumerate(rows, 1)), []
+
+    rows, errors = [], []
+    for line_number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            rows.append((line_number, json.loads(line)))
+        except json.JSONDecodeError as e:
+            errors.append({'row': line_number, 'error': f'Invalid JSON: {e.msg}'})
+    return rows, errors
+
+
+def build_record(row, now):
+    """Validate one normalized row and return its column values; raises ValueError"""
+    name = row.get('name')
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError('name is required')
+    if len(name.strip()) > 100:
+        raise ValueError('name must be at most 100 characters')
+    for field in ('bio', 'voice_style'):
+        if not isinstance(row.get(field, ''), str):
+            raise ValueError(f'{field} must be a string')
+    if not isinstance(row['persona'], dict):
+        raise ValueError('persona must be an object')
+    for field in LIST_FIELDS:
+        if not isinstance(row[field], list):
+            raise ValueError(f'{field} must be a list')
+
+    published = bool(row.get('published', False))
+    return {
+        'name': name.strip(),
+        'bio': row.get('bio', ''),
+        'voice_style': row.get('voice_style', ''),
+        'persona': row['persona'],
+        'rules': row['rules'],
+        'instructions': row['instructions'],
+        'example_dialogue': row['example_dialogue'],
+        'published': published,
+        'published_at': now if published else None,
+        'version_note': row.get('version_note'),
+        'created_at': now,
+        'updated_at': now
+    }
+
+
+def prepare_import(rows, mode, now):
+    """Normalize and validate every row before anything is written.
+
+    Returns ([(position, values)], errors). In upsert mode a name that appears
+    more than once keeps only its last row.
+    """
+    records, errors = [], []
+    for position, row in rows:
+        if not isinstance(row, dict):
+            errors.append({'row': position, 'error': 'row must be a JSON object'})
+            continue
+        try:
+            records.append((position, build_record(normalize_template(row), now)))
+        except ValueError as e:
+            errors.append({'row': position, 'error': str(e)})
+
+    if mode == 'upsert':
+        last = {values['name']: position for position, values in records}
+        records = [(position, values) for position, values in records if last[values['name']] == position]
+    return records, errors
+
+
+def _write_chunk(session, model, chunk, mode, before_update=None):
+    """Insert (or upsert) one chunk with executemany; returns (inserted, updated)"""
+    inserts, updates = [], []
+    if mode == 'upsert':
+        names = [values['name'] for _, values in chunk]
+        # When several templates share a name the newest one is updated
+        existing = dict(session.execute(
+            select(model.name, func.max(model.id)).where(model.name.in_(names)).group_by(model.name)
+        ).all())
+        for _, values in chunk:
+            if values['name'] in existing:
+                updates.append(dict({field: values[field] for field in UPSERT_FIELDS}, id=existing[values['name']]))
+            else:
+                inserts.append(values)
+    else:
+        inserts = [values for _, values in chunk]
+
+    if inserts:
+        session.execute(insert(model), inserts)
+    if updates:
+        if before_update is not None:
+            before_update(session, [values['id'] for values in updates])
+        session.execute(update(model), updates)
+    return len(inserts), len(updates)
+
+
+def import_records(session, model, records, mode='insert', chunk_size=500, before_update=None):
+    """Write validated records in chunked transactions.
+
+    Each chunk is committed on its own. If a chunk fails, its rows are retried
+    one at a time inside savepoints so the failing rows can be reported while
+    the rest of the chunk is still written. before_update(session, ids) runs
+    ahead of each bulk update in upsert mode.
+    """
+    summary = {'inserted': 0, 'updated': 0, 'errors': []}
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start:start + chunk_size]
+        try:
+            inserted, updated = _write_chunk(session, model, chunk, mode, before_update)
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.warning(f"Import chunk starting at row {chunk[0][0]} failed, retrying row by row: {e}")
+            inserted = updated = 0
+            for item in chunk:
+                try:
+                    with session.begin_nested():
+                        row_inserted, row_updated = _write_chunk(session, model, [item], mode, before_update)
+                    inserted += row_inserted
+                    updated += row_updated
+                except SQLAlchemyError as row_error:
+                    summary['errors'].append({'row': item[0], 'error': str(getattr(row_error, 'orig', row_error))})
+            session.commit()
+        summary['inserted'] += inserted
+        summary['updated'] += updated
+    return summary
@@ -0,0 +1,131 @@
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+import trafilatura
+from tokens import CHARS_PER_TOKEN, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text to roughly max_tokens, preferring a paragraph or sentence boundary"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    # Only back off to a boundary if it keeps most of the budget
+    for boundary in ('\n\n', '\n', '. '):
+        index = cut.rfind(boundary)
+        if index >= max_chars * 0.8:
+            return cut[:index + len(boundary)].rstrip()
+    return cut.rstrip()
+
+
+class ContentIngestor:
+    """Fetches and extracts website text for schema generation.
+
+    Extracted text is cached per URL for ``INGEST_TTL`` seconds; once stale it
+    is revalidated with If-None-Match / If-Modified-Since so unchanged pages are
+    neither re-downloaded nor re-parsed. Several URLs are fetched concurrently.
+    """
+
+    def __init__(self, app=None):
+        self.session = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.ttl = config["INGEST_TTL"]
+        self.max_entries = config["INGEST_CACHE_SIZE"]
+        self.timeout = config["INGEST_TIMEOUT"]
+        self.token_budget = config["INGEST_TOKEN_BUDGET"]
+        self.max_urls = config["INGEST_MAX_URLS"]
+        self.executor = ThreadPoolExecutor(max_workers=config["INGEST_MAX_WORKERS"], thread_name_prefix='ingest')
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        adapter = HTTPAdapter(pool_connections=config["INGEST_MAX_WORKERS"], pool_maxsize=config["INGEST_MAX_WORKERS"])
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['User-Agent'] = 'SystemPromptingApp/1.0 (+content ingestion)'
+        app.extensions['content_ingestor'] = self
+
+    def _cached(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def _remember(self, url, entry):
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def fetch(self, url):
+        """Return the extracted main text of url (possibly empty), using the cache when valid"""
+        entry = self._cached(url)
+        if entry is not None and time.time() - entry['fetched_at'] < self.ttl:
+            return entry['text']
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304 and entry is not None:
+            logger.debug(f"Content for {url} not modified; reusing cached extraction")
+            self._remember(url, dict(entry, fetched_at=time.time()))
+            return entry['text']
+        response.raise_for_status()
+
+        text = trafilatura.extract(response.text) or ''
+        self._remember(url, {
+            'text': text,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched_at': time.time()
+        })
+        return text
+
+    def ingest(self, urls, token_budget=None):
+        """Fetch urls concurrently and return [(url, text)] trimmed to a shared token budget.
+
+        Pages that fail to load are logged and skipped. Unused budget from short
+        pages is handed on to the longer ones.
+        """
+        urls = list(dict.fromkeys(u for u in urls if u))[:self.max_urls]
+        futures = [(url, self.executor.submit(self.fetch, url)) for url in urls]
+
+        pages = []
+        for url, future in futures:
+            try:
+                text = future.result()
+            except Exception as e:
+                logger.warning(f"Failed to fetch URL content from {url}: {e}")
+                continue
+            text = re.sub(r'\n{3,}', '\n\n', text).strip()
+            if text:
+                pages.append((url, text))
+
+        budget = token_budget if token_budget is not None else self.token_budget
+        # Fill the shortest pages first so their leftovers roll over to the rest
+        trimmed = {}
+        remaining = budget
+        for index, (url, text) in enumerate(sorted(pages, key=lambda page: len(page[1]))):
+            share = remaining // (len(pages) - index)
+            trimmed[url] = truncate_to_tokens(text, share)
+            remaining -= estimate_tokens(trimmed[url])
+        return [(url, trimmed[url]) for url, _ in pages if trimmed[url]]
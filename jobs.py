@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class JobError(Exception):
+    """Raised inside a job to fail it with a client-facing message and HTTP status"""
+
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class QueueFullError(Exception):
+    """Raised by submit() when the pending-job limit has been reached"""
+
+
+class MemoryJobStore:
+    """Job records kept in process memory; only visible to the submitting process"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job):
+        with self._lock:
+            self._purge()
+            self._jobs[job['id']] = job
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(fields, updated_at=time.time())
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _purge(self):
+        cutoff = time.time() - self.ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job['status'] in ('succeeded', 'failed') and job['updated_at'] < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+class SQLiteJobStore:
+    """Job records in a local SQLite file, shared by every worker process on the host"""
+
+    COLUMNS = ('id', 'kind', 'status', 'progress', 'result', 'error', 'status_code', 'created_at', 'updated_at')
+    JSON_COLUMNS = ('progress', 'result')
+
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = None
+
+    def _connection(self):
+        """This process's connection, opened on first use (a forked worker must not reuse its parent's)"""
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS job ('
+                'id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, progress TEXT, '
+                'result TEXT, error TEXT, status_code INTEGER, created_at REAL NOT NULL, updated_at REAL NOT NULL)'
+            )
+            self._pid = os.getpid()
+        return self._db
+
+    def create(self, job):
+        row = [json.dumps(job[c]) if c in self.JSON_COLUMNS else job[c] for c in self.COLUMNS]
+        with self._lock:
+            db = self._connection()
+            db.execute('DELETE FROM job WHERE status IN (?, ?) AND updated_at < ?',
+                             ('succeeded', 'failed', time.time() - self.ttl))
+            db.execute(f"INSERT INTO job ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})", row)
+
+    def update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f'{column} = ?' for column in fields)
+        values = [json.dumps(v) if k in self.JSON_COLUMNS else v for k, v in fields.items()]
+        with self._lock:
+            self._connection().execute(f'UPDATE job SET {assignments} WHERE id = ?', values + [job_id])
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connection().execute(f"SELECT {', '.join(self.COLUMNS)} FROM job WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(self.COLUMNS, row))
+        for column in self.JSON_COLUMNS:
+            job[column] = json.loads(job[column]) if job[column] is not None else None
+        return job
+
+
+_current = threading.local()
+
+
+class JobQueue:
+    """Runs submitted callables on a bounded thread pool inside an app context.
+
+    Jobs are tracked in a MemoryJobStore (default) or, when ``JOB_BACKEND`` is
+    ``sqlite``, a SQLiteJobStore so any worker process can answer status polls.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.executor = None
+        self.store = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.app = app
+        self.max_pending = config["JOB_MAX_PENDING"]
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=config["JOB_WORKERS"], thread_name_prefix='job')
+        if config["JOB_BACKEND"] == 'sqlite':
+            self.store = SQLiteJobStore(config["JOB_DB_PATH"], ttl=config["JOB_RESULT_TTL"])
+        else:
+            self.store = MemoryJobStore(ttl=config["JOB_RESULT_TTL"])
+        app.extensions['job_queue'] = self
+
+    def submit(self, kind, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) and return the new job id immediately"""
+        with self._pending_lock:
+            if self._pending >= self.max_pending:
+                raise QueueFullError(f'Job queue is full ({self.max_pending} pending)')
+            self._pending += 1
+
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        try:
+            self.store.create({
+                'id': job_id, 'kind': kind, 'status': 'queued', 'progress': None, 'result': None,
+                'error': None, 'status_code': None, 'created_at': now, 'updated_at': now
+            })
+            self.executor.submit(self._run, job_id, fn, args, kwargs)
+        except Exception:
+            # The job never reached a worker, so _run will not release its slot
+            with self._pending_lock:
+                self._pending -= 1
+            raise
+        return job_id
+
+    def _run(self, job_id, fn, args, kwargs):
+        _current.job_id = job_id
+        try:
+            self.store.update(job_id, status='running')
+            with self.app.app_context():
+                result = fn(*args, **kwargs)
+            self.store.update(job_id, status='succeeded', result=result, status_code=200)
+        except JobError as e:
+            logger.error(f"Job {job_id} failed: {e}")
+            self.store.update(job_id, status='failed', error=str(e), status_code=e.status_code)
+        except Exception as e:
+            logger.error(f"Job {job_id} crashed: {e}", exc_info=True)
+            self.store.update(job_id, status='failed', error=str(e), status_code=500)
+        finally:
+            _current.job_id = None
+            with self._pending_lock:
+                self._pending -= 1
+
+    def set_progress(self, progress):
+        """Record progress for the job running on the calling thread"""
+        job_id = getattr(_current, 'job_id', None)
+        if job_id is not None:
+            self.store.update(job_id, progress=progress)
+
+    def get(self, job_id):
+        return self.store.get(job_id)
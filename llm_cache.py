@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(model, messages, temperature):
+    """Content-addressed key over the model and the fully rendered prompt"""
+    payload = json.dumps([model, messages, temperature], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """LLM response cache: in-process LRU with TTL plus an optional SQLite tier.
+
+    The SQLite tier survives restarts and is shared by every worker process
+    pointed at the same file. Entries found there are promoted into the LRU.
+    """
+
+    def __init__(self, max_entries=256, ttl=3600, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        self._db = None
+        self._pid = None
+
+    def _connection(self):
+        """The SQLite connection of this process, opened on first use (None without a path).
+
+        Connections must not be carried across fork(), so a forked worker opens its own.
+        """
+        if not self.path:
+            return None
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS llm_response ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            self._pid = os.getpid()
+        return self._db
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return value
+                del self._entries[key]
+
+            db = self._connection()
+            if db is not None:
+                row = db.execute(
+                    'SELECT value, expires_at FROM llm_response WHERE key = ? AND expires_at > ?',
+                    (key, now)
+                ).fetchone()
+                if row is not None:
+                    self._remember(key, row[0], row[1])
+                    self._stats['disk_hits'] += 1
+                    return row[0]
+
+            self._stats['misses'] += 1
+            return None
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, value, expires_at)
+            self._stats['stores'] += 1
+            db = self._connection()
+            if db is not None:
+                try:
+                    db.execute(
+                        'INSERT OR REPLACE INTO llm_response (key, value, expires_at) VALUES (?, ?, ?)',
+                        (key, value, expires_at)
+                    )
+                except sqlite3.Error as e:
+                    logger.warning(f"Failed to persist LLM response to cache: {e}")
+
+    def _remember(self, key, value, expires_at):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            db = self._connection()
+            if db is not None:
+                db.execute('DELETE FROM llm_response WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            db = self._connection()
+            if db is not None:
+                db.execute('DELETE FROM llm_response')
+
+    def purge_expired(self):
+        """Drop expired rows from the SQLite tier"""
+        if self.path:
+            with self._lock:
+                self._connection().execute('DELETE FROM llm_response WHERE expires_at <= ?', (time.time(),))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['hits'] + stats['disk_hits']) / lookups, 4) if lookups else 0.0
+        stats['enabled'] = True
+        stats['persistent'] = bool(self.path)
+        return stats
@@ -0,0 +1,747 @@
+import os
+import json
+import math
+import time
+import queue
+import random
+import logging
+import threading
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+from llm_cache import ResponseCache, cache_key
+from tokens import estimate_tokens
+from metrics import (LLM_LATENCY, LLM_RETRIES, LLM_PROMPT_CHARS, LLM_RESPONSE_CHARS, LLM_COALESCED,
+                     LLM_SHED, LLM_RATE_LIMIT_WAIT, LLM_HEDGES, LLM_FALLBACKS)
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses worth retrying: rate limiting and transient upstream failures
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Provider settings that LLM_PROVIDERS entries may override, with the LLM_* config key supplying the default
+PROVIDER_SETTINGS = {
+    'base_url': 'LLM_BASE_URL',
+    'api_key': 'LLM_API_KEY',
+    'model': 'LLM_MODEL',
+    'connect_timeout': 'LLM_CONNECT_TIMEOUT',
+    'read_timeout': 'LLM_READ_TIMEOUT',
+    'max_retries': 'LLM_MAX_RETRIES',
+    'backoff_base': 'LLM_BACKOFF_BASE',
+    'backoff_max': 'LLM_BACKOFF_MAX',
+    'pool_size': 'LLM_POOL_SIZE',
+    'breaker_threshold': 'LLM_BREAKER_THRESHOLD',
+    'breaker_reset': 'LLM_BREAKER_RESET',
+    'rate_limit_rpm': 'LLM_RATE_LIMIT_RPM',
+    'rate_limit_tpm': 'LLM_RATE_LIMIT_TPM',
+    'rate_limit_max_wait': 'LLM_RATE_LIMIT_MAX_WAIT',
+}
+
+DEFAULT_PROVIDER = 'default'
+DEFAULT_ROUTE = 'default'
+
+
+def prompt_chars(messages):
+    return sum(len(message.get('content') or '') for message in messages)
+
+
+class LLMError(Exception):
+    """Raised when a chat-completions call cannot produce a usable response"""
+
+    def __init__(self, message, status_code=502, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(LLMError):
+    """Raised without contacting upstream while the circuit breaker is open"""
+
+    def __init__(self, retry_after):
+        super().__init__('LLM upstream unavailable (circuit open)', 503, retry_after)
+
+
+class RateLimitedError(LLMError):
+    """Raised without contacting upstream when the local rate limiter sheds a call"""
+
+    def __init__(self, retry_after):
+        super().__init__('LLM rate limit reached', 429, retry_after)
+
+
+class TokenBucket:
+    """Continuously refilling bucket holding at most one minute's allowance.
+
+    The level may go negative when usage is charged after the fact; callers
+    then wait until it has refilled.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount, now):
+        """Seconds until amount (capped at the capacity) is available"""
+        self._refill(now)
+        needed = min(amount, self.capacity)
+        return 0.0 if self.level >= needed else (needed - self.level) / self.rate
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= amount
+
+
+class RateLimiter:
+    """Process-wide requests/min and tokens/min limits in front of the upstream.
+
+    acquire() queues a call for up to max_wait seconds until both buckets can
+    cover it, and otherwise sheds it with RateLimitedError carrying the wait it
+    would have needed. Prompt tokens are charged up front and completion tokens
+    once the response is in. A limit of 0 disables that bucket.
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, max_wait=2.0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+
+    def _charges(self, tokens):
+        return [(bucket, amount) for bucket, amount in ((self.requests, 1), (self.tokens, tokens)) if bucket is not None]
+
+    def acquire(self, tokens):
+        charges = self._charges(tokens)
+        if not charges:
+            return
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = max(bucket.wait_for(amount, now) for bucket, amount in charges)
+                if wait <= 0:
+                    for bucket, amount in charges:
+                        bucket.take(amount, now)
+                    LLM_RATE_LIMIT_WAIT.observe(now - started)
+                    return
+            if now + wait - started > self.max_wait:
+                LLM_SHED.inc()
+                raise RateLimitedError(math.ceil(wait))
+            time.sleep(wait)
+
+    def charge(self, tokens):
+        """Charge tokens used after the fact (the completion)"""
+        if self.tokens is not None:
+            with self._lock:
+                self.tokens.take(tokens, time.monotonic())
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class FlightAbandoned(Exception):
+    """The leading call was abandoned (a stream closed early); callers go upstream themselves"""
+
+
+class SingleFlight:
+    """Coalesces identical concurrent calls.
+
+    The first caller for a key becomes the leader and makes the call; callers
+    arriving while it is in flight wait for it and share its result or error.
+    Nothing is remembered once the call completes, that is the cache's job.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key):
+        """Return (flight, is_leader)"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = _Flight()
+            return flight, True
+
+    def finish(self, key, flight, result=None, error=None):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.result, flight.error = result, error
+        flight.done.set()
+
+    @staticmethod
+    def wait(flight):
+        LLM_COALESCED.inc()
+        flight.done.wait()
+        if isinstance(flight.error, FlightAbandoned):
+            raise flight.error
+        if isinstance(flight.error, LLMError):
+            # A fresh exception per waiter; the leader's is being raised in its own thread
+            raise LLMError(str(flight.error), flight.error.status_code, flight.error.retry_after)
+        if flight.error is not None:
+            raise LLMError(f'LLM request failed: {flight.error}')
+        return flight.result
+
+    def do(self, key, function):
+        flight, leader = self.begin(key)
+        if not leader:
+            return self.wait(flight)
+        try:
+            result = function()
+        except BaseException as e:
+            self.finish(key, flight, error=e)
+            raise
+        self.finish(key, flight, result=result)
+        return result
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open trial call"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go upstream right now"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            elapsed = time.monotonic() - self._opened_at
+            if elapsed < self.reset_timeout or self._trial_in_flight:
+                raise CircuitOpenError(max(self.reset_timeout - elapsed, 1.0))
+            self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release(self):
+        """End a call that says nothing about upstream health, freeing the half-open trial"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(f"LLM circuit opened after {self._failures} consecutive failures")
+                self._opened_at = time.monotonic()
+
+
+class UpstreamCooldown:
+    """Shared back-off window so concurrent callers all pause after an upstream 429"""
+
+    def __init__(self, default_delay=5.0):
+        self.default_delay = default_delay
+        self._until = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            delay = self._until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def trip(self, retry_after=None):
+        with self._lock:
+            self._until = max(self._until, time.monotonic() + (retry_after or self.default_delay))
+
+
+class Provider:
+    """One chat-completions endpoint with its own pooled session, retries,
+    circuit breaker and rate limits.
+
+    The session keeps TCP/TLS connections alive across requests; failures only
+    trip this provider's breaker, so a fallback provider keeps serving.
+    """
+
+    def __init__(self, name, base_url, api_key=None, model=None, connect_timeout=5.0, read_timeout=30.0,
+                 max_retries=2, backoff_base=0.5, backoff_max=8.0, pool_size=10, breaker_threshold=5,
+                 breaker_reset=30.0, rate_limit_rpm=0, rate_limit_tpm=0, rate_limit_max_wait=2.0):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.model = model
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(failure_threshold=breaker_threshold, reset_timeout=breaker_reset)
+        self.limiter = RateLimiter(requests_per_minute=rate_limit_rpm, tokens_per_minute=rate_limit_tpm,
+                                   max_wait=rate_limit_max_wait)
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @classmethod
+    def from_config(cls, name, config, overrides=None):
+        """Build a provider from the LLM_* config keys, with per-provider overrides.
+
+        An override may name an environment variable holding the key as
+        ``api_key_env`` instead of embedding it.
+        """
+        overrides = dict(overrides or {})
+        api_key_env = overrides.pop('api_key_env', None)
+        if api_key_env:
+            overrides['api_key'] = os.environ.get(api_key_env)
+        unknown = set(overrides) - set(PROVIDER_SETTINGS)
+        if unknown:
+            raise ValueError(f"Unknown settings for LLM provider {name!r}: {', '.join(sorted(unknown))}")
+        settings = {setting: config.get(key) for setting, key in PROVIDER_SETTINGS.items()}
+        settings.update(overrides)
+        return cls(name, **settings)
+
+    def _headers(self):
+        if not self.api_key:
+            raise LLMError(f'No API key is configured for LLM provider {self.name!r}', 500)
+        return {
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json'
+        }
+
+    def _backoff(self, attempt, retry_after=None):
+        """Full-jitter exponential backoff, honouring Retry-After when given"""
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    @staticmethod
+    def _retry_after(response):
+        value = response.headers.get('Retry-After')
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
+    def send(self, payload, timeout=None, stream=False, cancel=None, parse_json=False):
+        """POST a chat-completions payload, retrying until a successful response arrives.
+
+        With parse_json=True the decoded body is returned instead of the
+        response, and a body that is not JSON counts as a failure. Setting the
+        cancel event stops further retries: the back-off wait ends early and
+        LLMError is raised without a breaker outcome. An attempt already sent
+        runs to completion.
+        """
+        headers = self._headers()
+        tokens = estimate_tokens(json.dumps(payload.get('messages', [])))
+        self.limiter.acquire(tokens)
+        self.breaker.before_call()
+        url = f"{self.base_url}/chat/completions"
+        last_error = None
+        # Every exit resolves the breaker, including a half-open trial: an answer from upstream
+        # (even a client error) is a success, a retry shed by our own limiter or a cancelled one is
+        # neutral (None), anything else a failure
+        healthy = False
+        try:
+            for attempt in range(self.max_retries + 1):
+                retry_after = None
+                if attempt > 0:
+                    try:
+                        self.limiter.acquire(tokens)
+                    except RateLimitedError:
+                        healthy = None
+                        raise
+                try:
+                    response = self.session.post(url, headers=headers, json=payload,
+                                                 timeout=timeout or self.timeout, stream=stream)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    logger.warning(f"LLM request failed (attempt {attempt + 1}): {e}")
+                    last_error = LLMError(f'LLM upstream unreachable: {e}', 504)
+                    reason = 'timeout' if isinstance(e, requests.Timeout) else 'connection'
+                else:
+                    if response.ok:
+                        result = response
+                        if parse_json:
+                            try:
+                                result = response.json()
+                            except ValueError:
+                                raise LLMError('LLM upstream returned invalid JSON')
+                        healthy = True
+                        return result
+
+                    logger.error(f"API Error ({response.status_code}): {response.text}")
+                    retry_after = self._retry_after(response)
+                    reason = str(response.status_code)
+                    response.close()
+                    last_error = LLMError(f'LLM upstream returned {response.status_code}',
+                                          response.status_code, retry_after)
+                    if response.status_code not in RETRYABLE_STATUSES:
+                        # Client errors will not succeed on retry and say nothing about upstream health
+                        healthy = True
+                        raise last_error
+
+                if attempt < self.max_retries:
+                    delay = self._backoff(attempt, retry_after)
+                    if cancel is None:
+                        time.sleep(delay)
+                    elif cancel.wait(delay):
+                        healthy = None
+                        raise LLMError('LLM request cancelled')
+                    LLM_RETRIES.inc(reason=reason)
+
+            raise last_error
+        finally:
+            if healthy:
+                self.breaker.record_success()
+            elif healthy is None:
+                self.breaker.release()
+            else:
+                self.breaker.record_failure()
+
+    def post(self, payload, timeout=None, cancel=None):
+        """POST a chat-completions payload with retries; returns the decoded JSON body"""
+        return self.send(payload, timeout=timeout, cancel=cancel, parse_json=True)
+
+
+class LatencyWindow:
+    """Durations of the most recent successful calls to one target"""
+
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q, min_samples=1):
+        """The q-quantile (nearest rank), or None until min_samples calls were seen"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, max(0, math.ceil(q * len(samples)) - 1))]
+
+
+class Target:
+    """A model on a provider: one step of a route's fallback order"""
+
+    def __init__(self, provider, model=None):
+        self.provider = provider
+        self.model = model or provider.model
+        self.latency = LatencyWindow()
+
+    @property
+    def label(self):
+        return f'{self.provider.name}/{self.model}'
+
+
+class LLMClient:
+    """Shared chat-completions client routing calls to configured providers.
+
+    Configured from the Flask app config: ``LLM_*`` keys describe the default
+    provider, ``LLM_PROVIDERS`` adds or overrides named providers and
+    ``LLM_ROUTES`` gives each route (optimize, generate, ...) an ordered list
+    of provider/model targets. Each call goes to the first target and falls
+    back to the next one when it fails. A non-streamed call that has not
+    answered within the target's recent p95 latency is hedged with a duplicate
+    request; whichever succeeds first wins. Identical concurrent requests
+    share one call, and every upstream attempt passes its provider's rate
+    limiter first.
+    """
+
+    def __init__(self, app=None):
+        self.providers = {}
+        self.routes = {}
+        self.cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.providers = {DEFAULT_PROVIDER: Provider.from_config(DEFAULT_PROVIDER, config)}
+        for name, overrides in (config.get("LLM_PROVIDERS") or {}).items():
+            self.providers[name] = Provider.from_config(name, config, overrides)
+
+        self.routes = {DEFAULT_ROUTE: [Target(self.providers[DEFAULT_PROVIDER])]}
+        for route, targets in (config.get("LLM_ROUTES") or {}).items():
+            self.routes[route] = [self._target(route, target) for target in targets]
+
+        self.hedge_enabled = config["LLM_HEDGE_ENABLED"]
+        self.hedge_quantile = config["LLM_HEDGE_QUANTILE"]
+        self.hedge_min_samples = config["LLM_HEDGE_MIN_SAMPLES"]
+        self.hedge_min_delay = config["LLM_HEDGE_MIN_DELAY"]
+        self.flights = SingleFlight() if config["LLM_SINGLEFLIGHT"] else None
+
+        if config["LLM_CACHE_ENABLED"]:
+            self.cache = ResponseCache(
+                max_entries=config["LLM_CACHE_SIZE"],
+                ttl=config["LLM_CACHE_TTL"],
+                path=config.get("LLM_CACHE_PATH")
+            )
+
+        app.extensions['llm_client'] = self
+
+    def _target(self, route, target):
+        """A route entry: a provider name, or {"provider": name, "model": model}"""
+        if isinstance(target, str):
+            target = {'provider': target}
+        name = target.get('provider', DEFAULT_PROVIDER)
+        if name not in self.providers:
+            raise ValueError(f"LLM route {route!r} refers to unknown provider {name!r}")
+        return Target(self.providers[name], target.get('model'))
+
+    def targets(self, route):
+        return self.routes.get(route) or self.routes[DEFAULT_ROUTE]
+
+    def _hedge_delay(self, target):
+        """Seconds to wait for the first request before hedging, or None to not hedge"""
+        if not self.hedge_enabled:
+            return None
+        quantile = target.latency.quantile(self.hedge_quantile, self.hedge_min_samples)
+        return None if quantile is None else max(quantile, self.hedge_min_delay)
+
+    def _with_fallback(self, targets, call):
+        """call(target) for each target in order until one succeeds; returns (target, result)
+        or raises the last error"""
+        for index, target in enumerate(targets):
+            try:
+                return target, call(target)
+            except LLMError as e:
+                if index + 1 == len(targets):
+                    raise
+                logger.warning(f"LLM target {target.label} failed ({e}), falling back to {targets[index + 1].label}")
+                LLM_FALLBACKS.inc(target=targets[index + 1].label)
+
+    def _hedged(self, target, call):
+        """call(target, cancel), duplicated if it has not finished within the hedge delay; first
+        success wins.
+
+        Once there is a winner the cancel event is set, so the losing request
+        makes no further retries; an attempt it already sent finishes in the
+        background and its result is dropped. Errors are only raised once
+        every request sent has failed.
+        """
+        delay = self._hedge_delay(target)
+        if delay is None:
+            return call(target, None)
+
+        results = queue.Queue()
+        cancel = threading.Event()
+
+        def run(hedge):
+            try:
+                results.put((hedge, call(target, cancel), None))
+            except LLMError as e:
+                results.put((hedge, None, e))
+            except Exception as e:
+                results.put((hedge, None, LLMError(f'LLM request failed: {e}')))
+
+        threading.Thread(target=run, args=(False,), daemon=True).start()
+        pending, hedged = 1, False
+        while True:
+            try:
+                hedge, content, error = results.get(timeout=None if hedged else delay)
+            except queue.Empty:
+                logger.debug(f"No answer from {target.label} after {delay:.2f}s, sending a hedge request")
+                LLM_HEDGES.inc(outcome='sent')
+                threading.Thread(target=run, args=(True,), daemon=True).start()
+                pending, hedged = pending + 1, True
+                continue
+            pending -= 1
+            if error is None:
+                if hedge:
+                    LLM_HEDGES.inc(outcome='won')
+                cancel.set()
+                return content
+            if pending == 0:
+                raise error
+
+    def chat(self, messages, route=DEFAULT_ROUTE, temperature=0.2, timeout=None, use_cache=True):
+        """Run a chat completion for a route and return the assistant message content.
+
+        Identical (model, messages, temperature) requests are answered from the
+        response cache when one is configured. Only answers from the route's
+        first target are cached: the key names that model, and a fallback's
+        answer should not be served for it once it has recovered.
+        """
+        targets = self.targets(route)
+        key = cache_key(targets[0].model, messages, temperature)
+        if use_cache and self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                logger.debug("LLM response served from cache")
+                return cached
+
+        def complete():
+            return self._with_fallback(targets, lambda target: self._hedged(
+                target, lambda target, cancel: self._complete(target, messages, temperature, timeout, cancel)))
+
+        answered, content = self.flights.do(key, complete) if self.flights is not None else complete()
+
+        if use_cache and self.cache is not None and answered is targets[0]:
+            self.cache.set(key, content)
+        return content
+
+    def _complete(self, target, messages, temperature, timeout, cancel=None):
+        """One upstream chat completion (with retries); returns the content"""
+        provider = target.provider
+        started = time.perf_counter()
+        try:
+            response_data = provider.post({
+                'model': target.model,
+                'messages': messages,
+                'temperature': temperature
+            }, timeout=timeout, cancel=cancel)
+            logger.debug(f"API Response received: {response_data}")
+
+            if not response_data.get('choices'):
+                logger.error("No choices in API response")
+                raise LLMError('Invalid API response', 500)
+            try:
+                content = response_data['choices'][0]['message']['content']
+            except (KeyError, IndexError, TypeError):
+                raise LLMError('Invalid API response', 500)
+        except LLMError:
+            LLM_LATENCY.observe(time.perf_counter() - started, target=target.label, mode='chat', outcome='error')
+            raise
+        elapsed = time.perf_counter() - started
+        target.latency.add(elapsed)
+        LLM_LATENCY.observe(elapsed, target=target.label, mode='chat', outcome='ok')
+        LLM_PROMPT_CHARS.observe(prompt_chars(messages))
+        LLM_RESPONSE_CHARS.observe(len(content or ''))
+        usage = response_data.get('usage') or {}
+        provider.limiter.charge(usage.get('completion_tokens') or estimate_tokens(content or ''))
+        return content
+
+    def stream_chat(self, messages, route=DEFAULT_ROUTE, temperature=0.2, timeout=None, use_cache=True):
+        """Yield assistant content deltas from a streamed (``stream: true``) completion.
+
+        Retries and fallback to the route's next target only happen before the
+        first byte; once tokens are flowing a failure is raised to the caller.
+        Streams are not hedged. A cached response is yielded whole, as is the
+        result of an identical call already in flight. As with chat(), only the
+        first target's answers are cached.
+        """
+        targets = self.targets(route)
+        key = cache_key(targets[0].model, messages, temperature)
+        if use_cache and self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                logger.debug("LLM response served from cache")
+                yield cached
+                return
+
+        flight, leader = self.flights.begin(key) if self.flights is not None else (None, False)
+        if flight is not None and not leader:
+            try:
+                yield SingleFlight.wait(flight)
+                return
+            except FlightAbandoned:
+                flight = None
+
+        chunks = []
+        outcome = 'abandoned'
+        try:
+            answered = yield from self._stream_with_fallback(targets, messages, temperature, timeout, chunks)
+            outcome = 'ok'
+        except BaseException as e:
+            outcome = e
+            raise
+        finally:
+            if flight is not None:
+                if outcome == 'ok':
+                    self.flights.finish(key, flight, result=''.join(chunks))
+                elif outcome == 'abandoned' or isinstance(outcome, GeneratorExit):
+                    self.flights.finish(key, flight, error=FlightAbandoned())
+                else:
+                    self.flights.finish(key, flight, error=outcome)
+
+        if use_cache and self.cache is not None and chunks and answered is targets[0]:
+            self.cache.set(key, ''.join(chunks))
+
+    def _stream_with_fallback(self, targets, messages, temperature, timeout, chunks):
+        """Stream from each target in order until one starts; returns the target that answered"""
+        for index, target in enumerate(targets):
+            try:
+                yield from self._stream(target, messages, temperature, timeout, chunks)
+                return target
+            except LLMError as e:
+                if chunks or index + 1 == len(targets):
+                    raise
+                logger.warning(f"LLM target {target.label} failed ({e}), falling back to {targets[index + 1].label}")
+                LLM_FALLBACKS.inc(target=targets[index + 1].label)
+
+    def _stream(self, target, messages, temperature, timeout, chunks):
+        """Stream one upstream completion, appending each delta to chunks as it is yielded"""
+        provider = target.provider
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            response = provider.send({
+                'model': target.model,
+                'messages': messages,
+                'temperature': temperature,
+                'stream': True
+            }, timeout=timeout, stream=True)
+        except LLMError:
+            LLM_LATENCY.observe(time.perf_counter() - started, target=target.label, mode='stream', outcome=outcome)
+            raise
+        response.encoding = 'utf-8'
+
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                data = line[5:].strip()
+                if data == '[DONE]':
+                    break
+                try:
+                    event = json.loads(data)
+                except ValueError:
+                    logger.warning(f"Skipping malformed stream event: {data[:200]}")
+                    continue
+                choices = event.get('choices') or []
+                delta = (choices[0].get('delta') or {}).get('content') if choices else None
+                if delta:
+                    chunks.append(delta)
+                    yield delta
+            outcome = 'ok'
+        except requests.RequestException as e:
+            provider.breaker.record_failure()
+            raise LLMError(f'LLM stream interrupted: {e}', 504)
+        finally:
+            # Also runs when the client disconnects and the generator is closed early
+            response.close()
+            LLM_LATENCY.observe(time.perf_counter() - started, target=target.label, mode='stream', outcome=outcome)
+            LLM_PROMPT_CHARS.observe(prompt_chars(messages))
+            LLM_RESPONSE_CHARS.observe(sum(len(chunk) for chunk in chunks))
+            provider.limiter.charge(estimate_tokens(''.join(chunks)))
+
+    def discard(self, messages, route=DEFAULT_ROUTE, temperature=0.2):
+        """Forget a cached response, e.g. one that turned out to be unparseable"""
+        if self.cache is not None:
+            self.cache.discard(cache_key(self.targets(route)[0].model, messages, temperature))
+
+    def cache_stats(self):
+        return self.cache.stats() if self.cache is not None else {'enabled': False}
@@ -1,4 +1,9 @@
-from app import app
+from app import create_app, upgrade_schema
+
+app = create_app()
 
 if __name__ == "__main__":
+    # The development server keeps the schema current itself; deployments run `flask upgrade-db`
+    with app.app_context():
+        upgrade_schema()
     app.run(host="0.0.0.0", port=5000, debug=True)
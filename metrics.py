@@ -0,0 +1,326 @@
+import time
+import bisect
+import threading
+from flask import g, request, before_render_template, template_rendered
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+# Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+TOKEN_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """Metrics rendered together by /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return ''.join(metric.render() for metric in metrics)
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, pairs, value in self._samples():
+            lines.append(f'{name}{_labels(pairs)} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, list(zip(self.labelnames, key)), value) for key, value in values]
+
+
+class Gauge(_Metric):
+    """A gauge set directly, or read from set_function() at render time.
+
+    The function returns a number, or {label values tuple: number} for a
+    labelled gauge.
+    """
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            values = self._function()
+            values = values if isinstance(values, dict) else {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [(self.name, list(zip(self.labelnames, key)), value) for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self._values.items())
+        samples = []
+        for key, (counts, total, count) in values:
+            pairs = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append((f'{self.name}_bucket', pairs + [('le', _number(bound))], cumulative))
+            samples.append((f'{self.name}_sum', pairs, total))
+            samples.append((f'{self.name}_count', pairs, count))
+        return samples
+
+
+HTTP_LATENCY = Histogram('http_request_duration_seconds', 'Request latency by route, including streamed bodies',
+                         ('method', 'route', 'status'))
+HTTP_SQL_STATEMENTS = Histogram('http_request_sql_statements', 'SQL statements executed per request',
+                                ('route',), buckets=COUNT_BUCKETS)
+HTTP_SQL_SECONDS = Histogram('http_request_sql_seconds', 'Time spent executing SQL per request', ('route',))
+SQL_STATEMENTS = Counter('db_statements_total', 'SQL statements executed, requests and background jobs alike')
+SQL_SECONDS = Counter('db_statement_seconds_total', 'Time spent executing SQL statements')
+POOL_CHECKOUT = Histogram('db_pool_checkout_seconds',
+                          'Time to get a pooled connection: waiting for one, or opening one as the pool grows')
+POOL_TIMEOUTS = Counter('db_pool_checkout_timeouts_total', 'Checkouts that gave up after pool_timeout')
+POOL_STATE = Gauge('db_pool_connections', 'Connection pool state (size and max_overflow are the configured limits)',
+                   ('state',))
+LLM_LATENCY = Histogram('llm_request_duration_seconds', 'Chat-completions latency including retries (cache hits excluded)',
+                        ('target', 'mode', 'outcome'))
+LLM_RETRIES = Counter('llm_retries_total', 'Chat-completions attempts that were retried', ('reason',))
+LLM_PROMPT_CHARS = Histogram('llm_prompt_chars', 'Characters of message content sent per completion',
+                             buckets=SIZE_BUCKETS)
+LLM_RESPONSE_CHARS = Histogram('llm_response_chars', 'Characters of content received per completion',
+                               buckets=SIZE_BUCKETS)
+LLM_COALESCED = Counter('llm_coalesced_total', 'Calls that shared an identical in-flight upstream call')
+LLM_SHED = Counter('llm_rate_limited_total', 'Calls shed by the local LLM rate limiter')
+LLM_RATE_LIMIT_WAIT = Histogram('llm_rate_limit_wait_seconds', 'Time calls queued in the local LLM rate limiter')
+LLM_HEDGES = Counter('llm_hedges_total', 'Hedge requests sent after the p95 delay, and how many of them won',
+                     ('outcome',))
+LLM_FALLBACKS = Counter('llm_fallbacks_total', 'Calls that fell back to the next target of their route', ('target',))
+PROMPT_TOKENS = Histogram('prompt_tokens_estimated',
+                          'Estimated tokens per optimization prompt: the full template, and what was sent',
+                          ('stage',), buckets=TOKEN_BUCKETS)
+PROMPT_TRIMMED_LINES = Counter('prompt_dialogue_lines_trimmed_total',
+                               'Example dialogue lines dropped to fit optimization prompts in their budget')
+CACHE_STATS = Gauge('cache_stat', 'Counters and sizes reported by the in-process caches', ('cache', 'stat'))
+RENDER_SECONDS = Histogram('template_render_seconds', 'Jinja template rendering time', ('template',))
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout takes and how often it times out.
+
+    Set as ``poolclass`` in SQLALCHEMY_ENGINE_OPTIONS; pool_size, max_overflow
+    and pool_timeout keep their usual meaning.
+    """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            POOL_CHECKOUT.observe(time.perf_counter() - started)
+
+
+class _RequestState(threading.local):
+    statements = 0
+    sql_seconds = 0.0
+    active = False
+
+
+class Metrics:
+    """Request, SQL, pool and template instrumentation behind a /metrics endpoint.
+
+    Request hooks time every request until its response (streamed bodies
+    included) is finished and attribute the SQL statements executed on that
+    thread to its route. Routes are labelled by URL rule, never by raw path.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._request = _RequestState()
+        self._render_started = threading.local()
+        self._stats_sources = {}
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        before_render_template.connect(self._before_render, app, weak=False)
+        template_rendered.connect(self._after_render, app, weak=False)
+        CACHE_STATS.set_function(self._cache_stats)
+        app.extensions['metrics'] = self
+
+    def instrument_engine(self, engine):
+        """Count statement executions and expose the engine's pool state"""
+        state = self._request
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info['metrics_started'].pop()
+            SQL_STATEMENTS.inc()
+            SQL_SECONDS.inc(elapsed)
+            if state.active:
+                state.statements += 1
+                state.sql_seconds += elapsed
+
+        @event.listens_for(engine, 'handle_error')
+        def handle_error(context):
+            if context.connection is not None:
+                started = context.connection.info.get('metrics_started')
+                if started:
+                    started.pop()
+
+        pool = engine.pool
+        if isinstance(pool, QueuePool):
+            POOL_STATE.set_function(lambda: {
+                ('size',): pool.size(),
+                ('max_overflow',): pool._max_overflow,
+                ('checked_out',): pool.checkedout(),
+                ('idle',): pool.checkedin(),
+                ('overflow',): max(0, pool.overflow()),
+            })
+
+    def track_stats(self, name, function):
+        """Publish the numeric values of function() (a stats dict) as cache_stat{cache=name}"""
+        self._stats_sources[name] = function
+
+    def _cache_stats(self):
+        values = {}
+        for name, function in self._stats_sources.items():
+            for stat, value in function().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values[(name, stat)] = value
+        return values
+
+    @staticmethod
+    def _route():
+        return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    def _before_request(self):
+        g.metrics_started = time.perf_counter()
+        self._request.statements = 0
+        self._request.sql_seconds = 0.0
+        self._request.active = True
+
+    def _after_request(self, response):
+        if response.is_streamed and 'metrics_started' in g:
+            # The request is torn down before a streamed body is sent (with or without
+            # stream_with_context), so observe it once the server has closed the body
+            started, method, route = g.pop('metrics_started'), request.method, self._route()
+            response.call_on_close(lambda: self._observe(started, method, route, response.status_code))
+        else:
+            g.metrics_status = response.status_code
+        return response
+
+    def _teardown_request(self, error=None):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        status = g.pop('metrics_status', 500 if error is not None else 200)
+        self._observe(started, request.method, self._route(), status)
+
+    def _observe(self, started, method, route, status):
+        self._request.active = False
+        HTTP_LATENCY.observe(time.perf_counter() - started, method=method, route=route, status=status)
+        HTTP_SQL_STATEMENTS.observe(self._request.statements, route=route)
+        HTTP_SQL_SECONDS.observe(self._request.sql_seconds, route=route)
+
+    def _before_render(self, sender, template, context, **extra):
+        stack = getattr(self._render_started, 'stack', None)
+        if stack is None:
+            stack = self._render_started.stack = []
+        stack.append(time.perf_counter())
+
+    def _after_render(self, sender, template, context, **extra):
+        stack = getattr(self._render_started, 'stack', None)
+        if stack:
+            RENDER_SECONDS.observe(time.perf_counter() - stack.pop(), template=template.name or 'string')
+
+    def render(self):
+        return REGISTRY.render()
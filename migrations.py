@@ -0,0 +1,55 @@
+import logging
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Weighted full-text document for template search: name (A), bio and voice style (B),
+# rules and instructions (C), persona values (D). Kept as a generated column so
+# Postgres maintains it on every insert and update.
+SEARCH_VECTOR_EXPRESSION = (
+    "setweight(to_tsvector('english'::regconfig, coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('english'::regconfig, coalesce(bio, '') || ' ' || coalesce(voice_style, '')), 'B') || "
+    "setweight(jsonb_to_tsvector('english'::regconfig, "
+    "coalesce(rules, '[]'::jsonb) || coalesce(instructions, '[]'::jsonb), '[\"string\"]'), 'C') || "
+    "setweight(jsonb_to_tsvector('english'::regconfig, coalesce(persona, '{}'::jsonb), '[\"string\"]'), 'D')"
+)
+
+# Idempotent DDL and data fixes applied after db.create_all(). create_all() only creates missing
+# tables, so indexes and columns added to existing tables are listed here.
+MIGRATIONS = [
+    # Keyset pagination over (created_at, id) for the template listings
+    "CREATE INDEX IF NOT EXISTS ix_system_message_created_at_id "
+    "ON system_message (created_at DESC, id DESC)",
+    # Version lineage lookups walk original_id in both directions
+    "CREATE INDEX IF NOT EXISTS ix_system_message_original_id ON system_message (original_id)",
+    # Full-text search document plus GIN indexes for ranked search and JSONB containment
+    "ALTER TABLE system_message ADD COLUMN IF NOT EXISTS search_vector tsvector "
+    f"GENERATED ALWAYS AS ({SEARCH_VECTOR_EXPRESSION}) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_system_message_search_vector ON system_message USING gin (search_vector)",
+    "CREATE INDEX IF NOT EXISTS ix_system_message_persona ON system_message USING gin (persona jsonb_path_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_system_message_rules ON system_message USING gin (rules jsonb_path_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_system_message_instructions ON system_message USING gin (instructions jsonb_path_ops)",
+    # Live published snapshot; the published_snapshot table itself comes from create_all()
+    "ALTER TABLE system_message ADD COLUMN IF NOT EXISTS published_snapshot_id integer "
+    "REFERENCES published_snapshot (id)",
+    # Optional delta-encoded version storage
+    "ALTER TABLE system_message ADD COLUMN IF NOT EXISTS delta_base_id integer REFERENCES system_message (id)",
+    "ALTER TABLE system_message ADD COLUMN IF NOT EXISTS delta jsonb",
+    "CREATE INDEX IF NOT EXISTS ix_system_message_delta_base_id ON system_message (delta_base_id) "
+    "WHERE delta_base_id IS NOT NULL",
+    # Older edits stored list fields as JSON-encoded strings; turn them back into arrays
+    "UPDATE system_message SET rules = (rules #>> '{}')::jsonb "
+    "WHERE jsonb_typeof(rules) = 'string' AND left(rules #>> '{}', 1) = '['",
+    "UPDATE system_message SET instructions = (instructions #>> '{}')::jsonb "
+    "WHERE jsonb_typeof(instructions) = 'string' AND left(instructions #>> '{}', 1) = '['",
+    "UPDATE system_message SET example_dialogue = (example_dialogue #>> '{}')::jsonb "
+    "WHERE jsonb_typeof(example_dialogue) = 'string' AND left(example_dialogue #>> '{}', 1) = '['",
+]
+
+
+def upgrade(db):
+    """Apply every migration statement in order inside one transaction"""
+    with db.engine.begin() as connection:
+        for statement in MIGRATIONS:
+            connection.execute(text(statement))
+    logger.info(f"Applied {len(MIGRATIONS)} schema migration statements")
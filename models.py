@@ -1,85 +1,157 @@
-from app import db
 from datetime import datetime
-from sqlalchemy.dialects.postgresql import JSONB
-import json
+from sqlalchemy import select, literal
+from sqlalchemy.orm import load_only, aliased
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
+from extensions import db
+import migrations
 
-class Category(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(50), nullable=False, unique=True)
-    description = db.Column(db.String(200))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-
-class Tag(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(30), nullable=False, unique=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-
-message_tags = db.Table('message_tags',
-    db.Column('message_id', db.Integer, db.ForeignKey('system_message.id'), primary_key=True),
-    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True)
-)
-
-class SystemMessage(db.Model):
+class Message(db.Model):
+    __tablename__ = 'system_message'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     bio = db.Column(db.Text, nullable=False)
     voice_style = db.Column(db.Text, nullable=False)
-    persona = db.Column(JSONB, nullable=False, default=lambda: {
-        'age': '',
-        'occupation': '',
-        'attitude': '',
-        'education': '',
-        'personality': '',
-        'communication_style': '',
-        'skills': '',
-        'knowledge': '',
-        'customer_relationship': '',
-        'representation': '',
-        'contrast': ''
-    })
+    persona = db.Column(JSONB, nullable=False)
     rules = db.Column(JSONB, nullable=False)
     instructions = db.Column(JSONB, nullable=False)
     example_dialogue = db.Column(JSONB, nullable=False)
+    published = db.Column(db.Boolean, default=False)
+    published_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    published = db.Column(db.Boolean, default=False)
-    published_at = db.Column(db.DateTime, nullable=True)
-    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=True)
-    category = db.relationship('Category', backref=db.backref('messages', lazy=True))
-    tags = db.relationship('Tag', secondary=message_tags, lazy='subquery',
-        backref=db.backref('messages', lazy=True))
-    # Version tracking fields
     original_id = db.Column(db.Integer, db.ForeignKey('system_message.id'), nullable=True)
     version_number = db.Column(db.Integer, default=1)
-    version_note = db.Column(db.String(200))
-    # Relationship to track copies
+    version_note = db.Column(db.Text)
+    # Snapshot currently served for this template while it is published
+    published_snapshot_id = db.Column(db.Integer, db.ForeignKey('published_snapshot.id'), nullable=True)
+    # Set when the content is stored as a JSON Patch against another (full) version;
+    # the content columns then hold placeholders and are rebuilt on load
+    delta_base_id = db.Column(db.Integer, db.ForeignKey('system_message.id'), nullable=True)
+    delta = db.Column(JSONB)
+    # Maintained by Postgres; never loaded unless a query asks for it
+    search_vector = db.deferred(db.Column(TSVECTOR, db.Computed(migrations.SEARCH_VECTOR_EXPRESSION, persisted=True)))
+
+    __table_args__ = (
+        db.Index('ix_system_message_created_at_id', created_at.desc(), id.desc()),
+        db.Index('ix_system_message_original_id', original_id),
+        db.Index('ix_system_message_search_vector', search_vector, postgresql_using='gin'),
+        db.Index('ix_system_message_persona', persona, postgresql_using='gin', postgresql_ops={'persona': 'jsonb_path_ops'}),
+        db.Index('ix_system_message_rules', rules, postgresql_using='gin', postgresql_ops={'rules': 'jsonb_path_ops'}),
+        db.Index('ix_system_message_instructions', instructions, postgresql_using='gin', postgresql_ops={'instructions': 'jsonb_path_ops'}),
+        db.Index('ix_system_message_delta_base_id', delta_base_id, postgresql_where=delta_base_id.isnot(None)),
+    )
+
+    # Add relationship for version tracking
     copies = db.relationship(
-        'SystemMessage',
+        'Message',
         backref=db.backref('original', remote_side=[id]),
         foreign_keys=[original_id]
     )
 
-    def __init__(self, **kwargs):
-        # Ensure JSON data is properly serialized
-        if 'persona' in kwargs and isinstance(kwargs['persona'], str):
-            kwargs['persona'] = json.loads(kwargs['persona'])
-        if 'rules' in kwargs and isinstance(kwargs['rules'], list):
-            kwargs['rules'] = json.dumps(kwargs['rules'])
-        if 'instructions' in kwargs and isinstance(kwargs['instructions'], list):
-            kwargs['instructions'] = json.dumps(kwargs['instructions'])
-        if 'example_dialogue' in kwargs and isinstance(kwargs['example_dialogue'], list):
-            kwargs['example_dialogue'] = json.dumps(kwargs['example_dialogue'])
-        super().__init__(**kwargs)
+    def to_dict(self):
+        """Convert message to dictionary format"""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'bio': self.bio,
+            'voice_style': self.voice_style,
+            'persona': self.persona,
+            'rules': self.rules,
+            'instructions': self.instructions,
+            'example_dialogue': self.example_dialogue,
+            'published': self.published,
+            'published_at': self.published_at.isoformat() if self.published_at else None,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat(),
+            'original_id': self.original_id,
+            'version_number': self.version_number,
+            'version_note': self.version_note
+        }
 
     def get_version_history(self):
-        """Get the complete version history of this message"""
-        if self.original_id:
-            # This is a copy, start from the original
-            original = SystemMessage.query.get(self.original_id)
-            return original.get_version_history()
-        else:
-            # This is an original, get all copies
-            versions = [self]
-            for copy in self.copies:
-                versions.append(copy)
-            return sorted(versions, key=lambda x: x.version_number)
\ No newline at end of file
+        """Get the complete version history of this message.
+
+        Resolved in a single query: a recursive CTE walks up to the lineage root
+        and back down through every copy. Only lightweight columns are loaded.
+        """
+        return (Message.query
+                .options(load_only(*VERSION_COLUMNS))
+                .filter(Message.id.in_(lineage_ids(self.id)))
+                .order_by(Message.version_number, Message.id)
+                .all())
+
+    def version_summary(self):
+        """Lightweight dictionary for version listings"""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'version_number': self.version_number,
+            'version_note': self.version_note,
+            'original_id': self.original_id,
+            'published': self.published,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+class PublishedSnapshot(db.Model):
+    """Immutable copy of a template's content and compiled prompt as it was published"""
+    __tablename__ = 'published_snapshot'
+    id = db.Column(db.Integer, primary_key=True)
+    # No foreign key: snapshots are kept as history after their template is deleted
+    message_id = db.Column(db.Integer, nullable=False, index=True)
+    revision = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(100), nullable=False)
+    version_number = db.Column(db.Integer)
+    content = db.Column(JSONB, nullable=False)
+    prompt = db.Column(db.Text, nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False)
+    published_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('message_id', 'revision', name='uq_published_snapshot_revision'),
+    )
+
+    def to_dict(self, include_content=False):
+        data = {
+            'id': self.id,
+            'message_id': self.message_id,
+            'revision': self.revision,
+            'name': self.name,
+            'version_number': self.version_number,
+            'content_hash': self.content_hash,
+            'published_at': self.published_at.isoformat()
+        }
+        if include_content:
+            data['content'] = self.content
+            data['prompt'] = self.prompt
+        return data
+
+@db.event.listens_for(PublishedSnapshot, 'before_update')
+def reject_snapshot_update(mapper, connection, target):
+    raise ValueError('Published snapshots are immutable')
+
+def lineage_root_id(id):
+    """Scalar subquery for the root of the lineage containing id (walks original_id upwards)"""
+    ancestors = select(
+        Message.id, Message.original_id, literal(0).label('depth')
+    ).where(Message.id == id).cte('ancestors', recursive=True)
+    parent = aliased(Message)
+    ancestors = ancestors.union_all(
+        select(parent.id, parent.original_id, ancestors.c.depth + 1)
+        .where(parent.id == ancestors.c.original_id, ancestors.c.depth < 1000)
+    )
+    # The furthest ancestor found is the root (or the last one still present)
+    return select(ancestors.c.id).order_by(ancestors.c.depth.desc()).limit(1).scalar_subquery()
+
+def lineage_ids(id):
+    """Select of every id in the lineage containing id.
+
+    A recursive CTE walks up to the lineage root and back down through every copy.
+    """
+    lineage = select(Message.id).where(Message.id == lineage_root_id(id)).cte('lineage', recursive=True)
+    child = aliased(Message)
+    lineage = lineage.union_all(select(child.id).where(child.original_id == lineage.c.id))
+    return select(lineage.c.id)
+
+# Columns loaded for version listings; the JSONB content is left unloaded
+VERSION_COLUMNS = (Message.id, Message.name, Message.version_number, Message.version_note,
+                   Message.original_id, Message.published, Message.created_at)
@@ -0,0 +1,183 @@
+from sqlalchemy import func, literal, case, cast, Text
+from sqlalchemy.dialects.postgresql import JSONB, ARRAY
+
+# Template fields a patch may touch, by stored shape
+TEXT_FIELDS = ('name', 'bio', 'voice_style')
+OBJECT_FIELDS = ('persona',)
+ARRAY_FIELDS = ('rules', 'instructions', 'example_dialogue')
+PATCHABLE_FIELDS = TEXT_FIELDS + OBJECT_FIELDS + ARRAY_FIELDS
+
+JSON_PATCH_MIMETYPE = 'application/json-patch+json'
+MERGE_PATCH_MIMETYPE = 'application/merge-patch+json'
+
+
+class PatchError(ValueError):
+    """Raised when a patch document is malformed or targets something that cannot be patched"""
+
+
+def _jsonb(value):
+    return literal(value, JSONB)
+
+
+def _path(tokens):
+    return cast(literal(list(tokens), ARRAY(Text)), ARRAY(Text))
+
+
+def _get(expr, tokens):
+    return expr.op('#>', return_type=JSONB)(_path(tokens))
+
+
+def _remove(expr, tokens):
+    return expr.op('#-', return_type=JSONB)(_path(tokens))
+
+
+def _check_value(field, value):
+    if field in TEXT_FIELDS:
+        if not isinstance(value, str):
+            raise PatchError(f'{field} must be a string')
+        if field == 'name' and not (value.strip() and len(value) <= 100):
+            raise PatchError('name must be 1-100 characters')
+    elif field in OBJECT_FIELDS and not isinstance(value, dict):
+        raise PatchError(f'{field} must be an object')
+    elif field in ARRAY_FIELDS and not isinstance(value, list):
+        raise PatchError(f'{field} must be an array')
+
+
+def _merge_expr(target, patch):
+    """SQL for RFC 7386 applied to a JSONB expression: objects merge key by key,
+    null removes a key and anything else replaces the value wholesale"""
+    result = case((func.jsonb_typeof(target) == 'object', target), else_=_jsonb({}))
+    for key, value in patch.items():
+        if value is None:
+            result = result.op('-', return_type=JSONB)(cast(literal(key), Text))
+        elif isinstance(value, dict):
+            member = result.op('->', return_type=JSONB)(cast(literal(key), Text))
+            result = func.jsonb_set(result, _path([key]), _merge_expr(member, value), True, type_=JSONB)
+        else:
+            result = func.jsonb_set(result, _path([key]), _jsonb(value), True, type_=JSONB)
+    return result
+
+
+def compile_merge_patch(table, patch):
+    """Column values for an RFC 7386 merge patch. Returns (values, conditions)."""
+    if not isinstance(patch, dict):
+        raise PatchError('A merge patch must be a JSON object')
+    values = {}
+    for field, value in patch.items():
+        if field not in PATCHABLE_FIELDS:
+            raise PatchError(f'{field} cannot be patched')
+        if value is None:
+            raise PatchError(f'{field} cannot be removed')
+        if field in OBJECT_FIELDS and isinstance(value, dict):
+            values[field] = _merge_expr(table.c[field], value)
+        else:
+            _check_value(field, value)
+            values[field] = value if field in TEXT_FIELDS else _jsonb(value)
+    return values, []
+
+
+def _split_pointer(pointer):
+    if not isinstance(pointer, str) or not pointer.startswith('/'):
+        raise PatchError(f'Invalid JSON pointer: {pointer!r}')
+    tokens = [token.replace('~1', '/').replace('~0', '~') for token in pointer.split('/')[1:]]
+    if tokens[0] not in PATCHABLE_FIELDS:
+        raise PatchError(f'{tokens[0]} cannot be patched')
+    if len(tokens) > 1 and tokens[0] in TEXT_FIELDS:
+        raise PatchError(f'{pointer} points inside a text field')
+    return tokens[0], tokens[1:]
+
+
+def compile_json_patch(table, ops):
+    """Column values for an RFC 6902 JSON Patch. Returns (values, conditions).
+
+    Operations are composed into one expression per column, so the whole patch
+    is a single UPDATE. test operations and "the path must exist" checks become
+    WHERE conditions evaluated against the intermediate document, so an update
+    that matches no row means the patch did not apply.
+    """
+    if not isinstance(ops, list) or not ops:
+        raise PatchError('A JSON Patch must be a non-empty array of operations')
+    exprs, conditions = {}, []
+
+    def current(field):
+        return exprs.get(field, table.c[field])
+
+    def read(field, tokens):
+        return _get(current(field), tokens) if tokens else current(field)
+
+    def exists(field, tokens):
+        if field in TEXT_FIELDS or not tokens:
+            return None
+        return read(field, tokens).isnot(None)
+
+    def add(field, tokens, value):
+        if not tokens:
+            exprs[field] = value
+            return
+        parent, last = tokens[:-1], tokens[-1]
+        container = read(field, parent)
+        if last == '-':
+            appended = container.op('||', return_type=JSONB)(func.jsonb_build_array(value, type_=JSONB))
+            exprs[field] = func.jsonb_set(current(field), _path(parent), appended, False, type_=JSONB) if parent else appended
+            conditions.append(func.jsonb_typeof(container) == 'array')
+            return
+        # add into an array inserts before the index; into an object it sets the member
+        exprs[field] = case(
+            (func.jsonb_typeof(container) == 'array', func.jsonb_insert(current(field), _path(tokens), value, type_=JSONB)),
+            else_=func.jsonb_set(current(field), _path(tokens), value, True, type_=JSONB))
+        if parent:
+            conditions.append(container.isnot(None))
+        if last.isdigit():
+            conditions.append(case((func.jsonb_typeof(container) == 'array',
+                                    func.jsonb_array_length(container) >= int(last)), else_=True))
+
+    def remove(field, tokens):
+        if not tokens:
+            raise PatchError(f'{field} cannot be removed')
+        conditions.append(exists(field, tokens))
+        exprs[field] = _remove(current(field), tokens)
+
+    for op in ops:
+        if not isinstance(op, dict) or 'op' not in op or 'path' not in op:
+            raise PatchError('Every operation needs "op" and "path"')
+        kind = op['op']
+        field, tokens = _split_pointer(op['path'])
+
+        if kind in ('add', 'replace', 'test'):
+            if 'value' not in op:
+                raise PatchError(f'{kind} needs a value')
+            if not tokens:
+                _check_value(field, op['value'])
+            value = op['value'] if field in TEXT_FIELDS else _jsonb(op['value'])
+            if kind == 'test':
+                conditions.append(read(field, tokens) == value)
+            elif kind == 'replace' and tokens:
+                conditions.append(exists(field, tokens))
+                exprs[field] = func.jsonb_set(current(field), _path(tokens), value, False, type_=JSONB)
+            else:
+                add(field, tokens, value)
+        elif kind == 'remove':
+            remove(field, tokens)
+        elif kind in ('move', 'copy'):
+            source_field, source_tokens = _split_pointer(op.get('from'))
+            if (source_field in TEXT_FIELDS) != (field in TEXT_FIELDS):
+                raise PatchError(f'Cannot {kind} between text and JSON fields')
+            if kind == 'move' and source_field == field and tokens[:len(source_tokens)] == source_tokens:
+                raise PatchError('Cannot move a value into itself')
+            value = read(source_field, source_tokens)
+            check = exists(source_field, source_tokens)
+            if check is not None:
+                conditions.append(check)
+            if kind == 'move':
+                remove(source_field, source_tokens)
+            add(field, tokens, value)
+        else:
+            raise PatchError(f'Unsupported patch operation: {kind}')
+
+    # Whole-field results must keep the column's shape
+    for field, expr in exprs.items():
+        if field in OBJECT_FIELDS:
+            conditions.append(func.jsonb_typeof(expr) == 'object')
+        elif field in ARRAY_FIELDS:
+            conditions.append(func.jsonb_typeof(expr) == 'array')
+    return exprs, conditions
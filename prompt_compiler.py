@@ -0,0 +1,177 @@
+"""Token-budgeted optimization prompts.
+
+Templates are serialized as compact JSON and only the fields an optimization
+request is about are sent, so a request about rules does not pay for the whole
+example dialogue. When no field can be matched to the request the full
+template is sent. Token counts are estimated locally (tokens.estimate_tokens);
+over the budget, example dialogue lines are dropped from the end first.
+"""
+import re
+import json
+import logging
+from tokens import estimate_tokens
+from fields import as_list
+from metrics import PROMPT_TOKENS, PROMPT_TRIMMED_LINES
+
+logger = logging.getLogger(__name__)
+
+# Prompt order of the template fields, with their labels
+FIELD_LABELS = {
+    'bio': 'Bio',
+    'voice_style': 'Voice Style',
+    'persona': 'Persona',
+    'rules': 'Rules',
+    'instructions': 'Instructions',
+    'example_dialogue': 'Example Dialogue',
+}
+
+# Always shown as context; only editable when the request is about them
+CONTEXT_FIELDS = ('bio',)
+
+# Words in an optimization request that point at a field (matched on word stems)
+FIELD_KEYWORDS = {
+    'bio': ('bio', 'background', 'description', 'describe', 'summary', 'backstory', 'story'),
+    'voice_style': ('voice', 'tone', 'style', 'formal', 'informal', 'casual', 'friendl', 'polite', 'warm',
+                    'professional', 'wording', 'language', 'concise', 'verbose', 'empath'),
+    'persona': ('persona', 'personality', 'character', 'name', 'age', 'occupation', 'job', 'role', 'trait',
+                'skill', 'hobb', 'identity'),
+    'rules': ('rule', 'never', 'always', 'must', 'polic', 'compliance', 'gdpr', 'hipaa', 'privacy', 'forbid',
+              'prohibit', 'allow', 'restrict', 'guardrail', 'constraint', 'escalat', 'safety', 'legal',
+              'disclaimer', 'limit'),
+    'instructions': ('instruction', 'step', 'process', 'procedure', 'flow', 'workflow', 'greet', 'handle',
+                     'task', 'goal'),
+    'example_dialogue': ('dialog', 'example', 'conversation', 'sample', 'exchange', 'transcript', 'reply',
+                         'replies', 'respons', 'turn'),
+}
+
+# Requests that explicitly ask for a broad rewrite get the full template
+FULL_CONTEXT_KEYWORDS = ('everything', 'entire', 'whole', 'overall', 'all fields', 'rewrite', 'overhaul')
+
+_WORD = re.compile(r"[a-z][a-z'-]*")
+
+
+def compact_json(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def relevant_fields(custom_request):
+    """Template fields the request is about, in prompt order, or all of them when none is recognisable"""
+    text = custom_request.lower()
+    if any(keyword in text for keyword in FULL_CONTEXT_KEYWORDS):
+        return list(FIELD_LABELS)
+    words = _WORD.findall(text)
+    fields = [field for field, stems in FIELD_KEYWORDS.items()
+              if any(word.startswith(stem) for word in words for stem in stems)]
+    return [field for field in FIELD_LABELS if field in fields] or list(FIELD_LABELS)
+
+
+class CompiledPrompt:
+    """A rendered prompt plus what went into it.
+
+    editable are the fields the model was shown in full and may update;
+    updates to any other field must be ignored.
+    """
+
+    def __init__(self, text, editable, tokens, full_tokens, trimmed_lines):
+        self.text = text
+        self.editable = editable
+        self.tokens = tokens
+        self.full_tokens = full_tokens
+        self.trimmed_lines = trimmed_lines
+
+
+def _render_field(field, value):
+    label = FIELD_LABELS[field]
+    if field in ('bio', 'voice_style'):
+        return f"{label}: {value or ''}"
+    if value is None:
+        value = {} if field == 'persona' else []
+    return f"{label}: {compact_json(value)}"
+
+
+def _render(custom_request, sections, editable, notes):
+    shape = {
+        'rules': '["list of all rules including any new ones"]',
+        'bio': '"only if it needs updating"',
+        'voice_style': '"only if it needs updating"',
+        'persona': '{}',
+        'instructions': '[]',
+        'example_dialogue': '[]',
+    }
+    response_shape = ',\n'.join(f'    "{field}": {shape[field]}' for field in shape if field in editable)
+    important = [
+        '- Return valid JSON only',
+        '- For rules, include ALL existing rules plus any new ones',
+        '- Only include fields that actually need updating',
+        '- Keep existing content for fields not mentioned in request',
+    ]
+    if len(editable) < len(FIELD_LABELS):
+        important.append(f"- Only these fields may be updated: {', '.join(editable)}")
+    important.extend(f'- {note}' for note in notes)
+    body = '\n'.join(sections)
+    return f"""Analyze and modify this template based on the following request:
+{custom_request}
+
+Current Template:
+{body}
+
+Return a JSON object containing ONLY the fields that need to be updated:
+{{
+{response_shape}
+}}
+
+Important:
+""" + '\n'.join(important)
+
+
+def compile_optimization_prompt(message, custom_request, budget, select_fields=True):
+    """Render the optimization prompt for a template within roughly budget tokens.
+
+    Returns a CompiledPrompt. Rules and the other fields are never cut, so a
+    template that does not fit even without example dialogue is sent over
+    budget (and logged), as is one where the dialogue is all the request is
+    about.
+    """
+    fields = relevant_fields(custom_request) if select_fields else list(FIELD_LABELS)
+    shown = [field for field in FIELD_LABELS if field in fields or field in CONTEXT_FIELDS]
+    editable = list(fields)
+
+    def sections(dialogue):
+        rendered = []
+        for field in shown:
+            value = dialogue if field == 'example_dialogue' else getattr(message, field)
+            rendered.append(_render_field(field, value))
+        return rendered
+
+    dialogue = as_list(message.example_dialogue) if 'example_dialogue' in shown else []
+    full_tokens = estimate_tokens(_render(custom_request, [_render_field(field, getattr(message, field))
+                                                           for field in FIELD_LABELS],
+                                          list(FIELD_LABELS), []))
+    text = _render(custom_request, sections(dialogue), editable, [])
+    tokens = estimate_tokens(text)
+
+    trimmed = 0
+    if tokens > budget and dialogue and editable != ['example_dialogue']:
+        # A shortened dialogue must not be written back over the full one
+        editable = [field for field in editable if field != 'example_dialogue']
+        kept = len(dialogue)
+        while tokens > budget and kept:
+            # Drop lines from the end; each costs about its JSON encoding plus a comma
+            excess = tokens - budget
+            while kept and excess > 0:
+                kept -= 1
+                excess -= estimate_tokens(compact_json(dialogue[kept])) + 1
+            note = (f'Example Dialogue is abridged to its first {kept} of {len(dialogue)} lines; '
+                    'do not return example_dialogue')
+            text = _render(custom_request, sections(dialogue[:kept]), editable, [note])
+            tokens = estimate_tokens(text)
+        trimmed = len(dialogue) - kept
+        PROMPT_TRIMMED_LINES.inc(trimmed)
+
+    if tokens > budget:
+        logger.warning(f"Optimization prompt is {tokens} tokens, over the budget of {budget}")
+    logger.info(f"Optimization prompt: ~{tokens} tokens (full template ~{full_tokens}), "
+                f"fields {', '.join(shown)}, {trimmed} dialogue lines trimmed")
+    PROMPT_TOKENS.observe(full_tokens, stage='full')
+    PROMPT_TOKENS.observe(tokens, stage='sent')
+    return CompiledPrompt(text, editable, tokens, full_tokens, trimmed)
@@ -0,0 +1,124 @@
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+from fields import as_list
+
+
+def _text(value):
+    return escape(value if isinstance(value, str) else json.dumps(value))
+
+
+def _tag(key):
+    """Persona keys are free text; make them usable as element names"""
+    tag = re.sub(r'[^A-Za-z0-9_]+', '_', str(key).strip()).strip('_').lower() or 'attribute'
+    return tag if not tag[0].isdigit() else f'_{tag}'
+
+
+def compile_prompt(message):
+    """Assemble a template into the XML system prompt handed to a chatbot"""
+    lines = ['<system_message>']
+    if message.bio:
+        lines.append(f'    <bio>{_text(message.bio)}</bio>')
+    if message.voice_style:
+        lines.append(f'    <voice_style>{_text(message.voice_style)}</voice_style>')
+
+    persona = message.persona
+    if isinstance(persona, str):
+        try:
+            persona = json.loads(persona)
+        except json.JSONDecodeError:
+            persona = {'description': persona}
+    if persona:
+        lines.append('    <persona>')
+        for key, value in persona.items():
+            tag = _tag(key)
+            lines.append(f'        <{tag}>{_text(value)}</{tag}>')
+        lines.append('    </persona>')
+
+    for field, element, item in (('rules', 'important_rules', 'rule'),
+                                 ('instructions', 'instructions', 'step'),
+                                 ('example_dialogue', 'example_dialogue', 'line')):
+        values = as_list(getattr(message, field))
+        if values:
+            lines.append(f'    <{element}>')
+            lines.extend(f'        <{item}>{_text(value)}</{item}>' for value in values)
+            lines.append(f'    </{element}>')
+
+    lines.append('</system_message>')
+    return '\n'.join(lines)
+
+
+class PromptCache:
+    """Bounded LRU of compiled prompts for published templates, keyed by template id.
+
+    Each entry remembers the validator it was built from: the live snapshot id,
+    or ``updated_at`` for templates published before snapshots existed. Within
+    ``PROMPT_CACHE_REVALIDATE`` seconds of its last check an entry is served
+    without touching the database; after that the caller re-reads the
+    validator (a one-row lookup) and reloads only if it changed. Writes in
+    this process invalidate entries immediately.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_entries = app.config["PROMPT_CACHE_SIZE"]
+        self.revalidate_after = app.config["PROMPT_CACHE_REVALIDATE"]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0}
+        app.extensions['prompt_cache'] = self
+
+    def get(self, id):
+        """Return the entry if it was validated recently enough to serve as-is, else None"""
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is not None and time.monotonic() - entry['checked_at'] < self.revalidate_after:
+                self._entries.move_to_end(id)
+                self._stats['hits'] += 1
+                return entry
+            return None
+
+    def revalidate(self, id, validator):
+        """Return the cached entry if it still matches validator, refreshing its check time"""
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is not None and entry['validator'] == validator:
+                entry['checked_at'] = time.monotonic()
+                self._entries.move_to_end(id)
+                self._stats['revalidated'] += 1
+                return entry
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, id, validator, **values):
+        entry = dict(values, id=id, validator=validator, checked_at=time.monotonic())
+        with self._lock:
+            self._entries[id] = entry
+            self._entries.move_to_end(id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+        return entry
+
+    def invalidate(self, id):
+        with self._lock:
+            if self._entries.pop(id, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['revalidated'] + stats['misses']
+        stats['hit_rate'] = round((stats['hits'] + stats['revalidated']) / lookups, 4) if lookups else 0.0
+        return stats
@@ -0,0 +1,353 @@
+"""In-process similarity index for finding near-duplicate templates.
+
+Each template's bio, rules and instructions are turned into hashed word
+unigram and bigram counts (the hashing trick, so there is no vocabulary to
+keep), weighted by TF-IDF and L2-normalized into one row of a dense float32
+NumPy matrix. Cosine similarity to every template is then a single
+matrix-vector product.
+"""
+import re
+import time
+import zlib
+import logging
+import threading
+from collections import Counter
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INDEXED_FIELDS = ('bio', 'rules', 'instructions')
+
+_WORD = re.compile(r'[a-z0-9]+')
+
+# Rows are tombstoned rather than moved on delete, so views taken by readers stay valid
+_DELETED = -1
+
+# Duplicate reports kept for the current generation of the index (different thresholds)
+_DUPLICATES_CACHE_SIZE = 8
+
+# Grams repeat heavily across templates; remember their hashes (cleared when full)
+_DIGEST_CACHE_SIZE = 500000
+_digests = {}
+
+
+def template_text(content):
+    """The indexed text of a template: bio, rules and instructions"""
+    parts = []
+    for field in INDEXED_FIELDS:
+        value = content.get(field)
+        if isinstance(value, dict):
+            value = list(value.values())
+        if isinstance(value, (list, tuple)):
+            parts.extend(str(item) for item in value)
+        elif value:
+            parts.append(str(value))
+    return '\n'.join(parts)
+
+
+def _digest(gram):
+    digest = _digests.get(gram)
+    if digest is None:
+        if len(_digests) >= _DIGEST_CACHE_SIZE:
+            _digests.clear()
+        digest = _digests[gram] = zlib.crc32(gram.encode('utf-8'))
+    return digest
+
+
+def hashed_features(text, dimensions):
+    """Signed, sublinear (1 + log tf) counts of hashed word unigrams and bigrams, as a dense vector"""
+    words = _WORD.findall(text.lower())
+    grams = Counter(words)
+    grams.update(f'{first} {second}' for first, second in zip(words, words[1:]))
+    digests = np.fromiter(map(_digest, grams), dtype=np.uint32, count=len(grams))
+    counts = np.fromiter(grams.values(), dtype=np.float64, count=len(grams))
+    # The top bit picks the sign so colliding grams tend to cancel rather than pile up
+    weights = np.where(digests & 0x80000000, 1.0, -1.0) * (1.0 + np.log(counts))
+    return np.bincount(digests % dimensions, weights=weights, minlength=dimensions).astype(np.float32)
+
+
+class SimilarityIndex:
+    """Hashed n-gram TF-IDF vectors of every template, kept in one NumPy matrix.
+
+    The index is built from the database in a background thread on first use
+    (``refresh``) and then updated incrementally as templates are created,
+    edited and deleted. Incremental rows are weighted with the document
+    frequencies known at the time, so once ``SIMILARITY_REBUILD_FRACTION`` of
+    the rows have changed since the last build it is rebuilt in the
+    background, while the current one keeps answering. Updates and removals
+    made while a build runs are recorded and replayed onto the new matrix
+    before it is swapped in, so none are lost. Memory is about
+    ``SIMILARITY_DIMENSIONS`` * 4 bytes per template.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.dimensions = app.config["SIMILARITY_DIMENSIONS"]
+        self.rebuild_fraction = app.config["SIMILARITY_REBUILD_FRACTION"]
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._builder = None
+        # id -> (lineage, features) or None (removed) for changes made while a build runs
+        self._pending = None
+        # Bumped on every change, so cached duplicate reports are only reused for the same index
+        self._generation = 0
+        self._duplicates, self._duplicates_generation = {}, None
+        self._reset(0)
+        self._built = False
+        self._invalidated = False
+        app.extensions['similarity_index'] = self
+
+    def _reset(self, capacity):
+        self._vectors = np.zeros((max(capacity, 64), self.dimensions), dtype=np.float32)
+        self._ids = np.full(len(self._vectors), _DELETED, dtype=np.int64)
+        self._lineages = np.full(len(self._vectors), _DELETED, dtype=np.int64)
+        self._rows = {}
+        self._count = 0
+        self._df = np.zeros(self.dimensions, dtype=np.float64)
+        self._changes = 0
+
+    def _idf(self):
+        documents = len(self._rows)
+        return (np.log((1.0 + documents) / (1.0 + self._df)) + 1.0).astype(np.float32)
+
+    @staticmethod
+    def _normalize(vector):
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm > 0 else vector
+
+    def _grow(self):
+        capacity = len(self._vectors) * 2
+        vectors = np.zeros((capacity, self.dimensions), dtype=np.float32)
+        vectors[:self._count] = self._vectors[:self._count]
+        ids = np.full(capacity, _DELETED, dtype=np.int64)
+        ids[:self._count] = self._ids[:self._count]
+        lineages = np.full(capacity, _DELETED, dtype=np.int64)
+        lineages[:self._count] = self._lineages[:self._count]
+        # Swap in whole new arrays: readers holding the old ones are unaffected
+        self._vectors, self._ids, self._lineages = vectors, ids, lineages
+
+    @property
+    def stale(self):
+        return (not self._built or self._invalidated
+                or self._changes > self.rebuild_fraction * max(len(self._rows), 1))
+
+    def invalidate(self):
+        """Rebuild on next use, e.g. after a bulk import that bypassed the incremental updates"""
+        self._invalidated = True
+
+    def refresh(self, load):
+        """Start a background (re)build if the index is missing or stale; True once it can answer queries.
+
+        load() yields (id, lineage_id, content) for every template and runs in
+        an app context on the builder thread.
+        """
+        if self.stale:
+            with self._build_lock:
+                if self.stale and (self._builder is None or not self._builder.is_alive()):
+                    self._builder = threading.Thread(target=self._build, args=(load,), daemon=True,
+                                                     name='similarity-build')
+                    self._builder.start()
+        return self._built
+
+    def _build(self, load):
+        try:
+            with self.app.app_context():
+                self._invalidated = False
+                # Record changes from before load() reads the templates until the swap
+                with self._lock:
+                    self._pending = {}
+                self.rebuild(load())
+        except Exception as e:
+            logger.error(f"Failed to build the similarity index: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def rebuild(self, templates):
+        started = time.perf_counter()
+        features = []
+        df = np.zeros(self.dimensions, dtype=np.float64)
+        for id, lineage, content in templates:
+            vector = hashed_features(template_text(content), self.dimensions)
+            # Keep only the non-zero buckets until the matrix can be sized
+            buckets = np.flatnonzero(vector)
+            df[buckets] += 1
+            features.append((id, lineage, buckets.astype(np.int32), vector[buckets]))
+
+        count = len(features)
+        # Headroom for templates created before the next rebuild
+        vectors = np.zeros((max(count + count // 4, 64), self.dimensions), dtype=np.float32)
+        ids = np.full(len(vectors), _DELETED, dtype=np.int64)
+        lineages = np.full(len(vectors), _DELETED, dtype=np.int64)
+        for row, (id, lineage, buckets, values) in enumerate(features):
+            vectors[row, buckets] = values
+            ids[row] = id
+            lineages[row] = lineage
+        del features
+        if count:
+            idf = (np.log((1.0 + count) / (1.0 + df)) + 1.0).astype(np.float32)
+            vectors[:count] *= idf
+            norms = np.linalg.norm(vectors[:count], axis=1, keepdims=True)
+            np.divide(vectors[:count], norms, out=vectors[:count], where=norms > 0)
+
+        with self._lock:
+            self._vectors, self._ids, self._lineages = vectors, ids, lineages
+            self._rows = {int(id): row for row, id in enumerate(ids[:count])}
+            self._count = count
+            self._df = df
+            self._changes = 0
+            self._built = True
+            self._generation += 1
+            # The templates may have been read before these changes committed; replaying
+            # one that was already read is harmless
+            pending, self._pending = self._pending or {}, None
+            for id, change in pending.items():
+                if change is None:
+                    self._remove(id)
+                else:
+                    self._update(id, *change)
+        logger.info(f"Built similarity index of {count} templates in {time.perf_counter() - started:.2f}s"
+                    f" ({len(pending)} changes replayed)")
+
+    def update(self, id, lineage, content):
+        """Index a created or edited template (a no-op until the index is first built or building)"""
+        if not self._built and self._pending is None:
+            return
+        vector = hashed_features(template_text(content), self.dimensions)
+        with self._lock:
+            if self._pending is not None:
+                self._pending[id] = (lineage, vector)
+            if self._built:
+                self._update(id, lineage, vector)
+
+    def _update(self, id, lineage, vector):
+        row = self._rows.get(id)
+        if row is None:
+            if self._count == len(self._vectors):
+                self._grow()
+            row = self._count
+            self._count += 1
+            self._rows[id] = row
+        else:
+            self._df -= self._vectors[row] != 0
+        self._df += vector != 0
+        self._vectors[row] = self._normalize(vector * self._idf())
+        self._ids[row] = id
+        self._lineages[row] = lineage
+        self._changes += 1
+        self._generation += 1
+
+    def remove(self, id):
+        if not self._built and self._pending is None:
+            return
+        with self._lock:
+            if self._pending is not None:
+                self._pending[id] = None
+            if self._built:
+                self._remove(id)
+
+    def _remove(self, id):
+        row = self._rows.pop(id, None)
+        if row is None:
+            return
+        self._df -= self._vectors[row] != 0
+        self._vectors[row] = 0
+        self._ids[row] = _DELETED
+        self._lineages[row] = _DELETED
+        self._changes += 1
+        self._generation += 1
+
+    def _snapshot(self, id=None):
+        """Views of the matrix and copies of the row metadata (plus id's row and the generation),
+        so queries run unlocked"""
+        with self._lock:
+            count = self._count
+            return (self._vectors[:count], self._ids[:count].copy(), self._lineages[:count].copy(),
+                    self._rows.get(id), self._generation)
+
+    def similar(self, id, k=10, exclude_lineage=False):
+        """Top k (id, score, same_lineage) for the template id, best first, or None if it is not indexed"""
+        vectors, ids, lineages, row, _ = self._snapshot(id)
+        if row is None:
+            return None
+        scores = vectors @ vectors[row]
+        excluded = ids == _DELETED
+        excluded[row] = True
+        if exclude_lineage:
+            excluded |= lineages == lineages[row]
+        scores[excluded] = -np.inf
+        k = min(k, int((~excluded).sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(int(ids[i]), float(scores[i]), bool(lineages[i] == lineages[row])) for i in top]
+
+    def duplicate_groups(self, threshold, include_lineage=False, block_size=256):
+        """Groups of templates connected by pairs at least threshold similar, largest first.
+
+        Compares every pair in blocks of rows (each block is one matrix
+        product against the rows after it), so the cost grows with the square
+        of the library size. The result is cached until the index next
+        changes. Each group is {'ids', 'pairs', 'max_score', 'min_score'}.
+        """
+        vectors, ids, lineages, _, generation = self._snapshot()
+        key = (threshold, include_lineage)
+        with self._lock:
+            cached = self._duplicates.get(key) if self._duplicates_generation == generation else None
+        if cached is not None:
+            return cached
+
+        count = len(ids)
+        parent = {}
+
+        def find(row):
+            while parent.setdefault(row, row) != row:
+                parent[row] = parent[parent[row]]
+                row = parent[row]
+            return row
+
+        pairs = []
+        for start in range(0, count, block_size):
+            end = min(start + block_size, count)
+            scores = vectors[start:end] @ vectors[start:].T
+            # Only pairs (i, j) with j > i, within the block and after it
+            scores[np.tril_indices(end - start, 0, scores.shape[1])] = 0
+            if not include_lineage:
+                scores[lineages[start:end, None] == lineages[None, start:]] = 0
+            for i, j in zip(*np.nonzero(scores >= threshold)):
+                left, right = start + int(i), start + int(j)
+                if ids[left] == _DELETED or ids[right] == _DELETED:
+                    continue
+                pairs.append((left, right, float(scores[i, j])))
+                parent[find(left)] = find(right)
+
+        groups = {}
+        for left, right, score in pairs:
+            group = groups.setdefault(find(left), {'rows': set(), 'pairs': 0, 'max_score': 0.0, 'min_score': 1.0})
+            group['rows'].update((left, right))
+            group['pairs'] += 1
+            group['max_score'] = max(group['max_score'], score)
+            group['min_score'] = min(group['min_score'], score)
+        result = [{'ids': sorted(int(ids[row]) for row in group['rows']), 'pairs': group['pairs'],
+                   'max_score': round(min(group['max_score'], 1.0), 4),
+                   'min_score': round(min(group['min_score'], 1.0), 4)}
+                  for group in groups.values()]
+        result.sort(key=lambda group: (-len(group['ids']), -group['max_score']))
+
+        with self._lock:
+            if generation == self._generation:
+                if self._duplicates_generation != generation or len(self._duplicates) >= _DUPLICATES_CACHE_SIZE:
+                    self._duplicates, self._duplicates_generation = {}, generation
+                self._duplicates[key] = result
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'built': self._built, 'templates': len(self._rows), 'rows': self._count,
+                    'dimensions': self.dimensions, 'changes_since_build': self._changes,
+                    'bytes': int(self._vectors.nbytes)}
@@ -0,0 +1,40 @@
+import pytest
+import app as application
+
+API_TOKEN = 'test-token'
+
+
+@pytest.fixture
+def client():
+    # The database is never contacted: every request here is answered before a query
+    app = application.create_app({'SQLALCHEMY_DATABASE_URI': 'postgresql+psycopg2://127.0.0.1:9/unreachable',
+                                  'API_TOKEN': API_TOKEN})
+    return app.test_client()
+
+
+def bearer(token):
+    return {'Authorization': f'Bearer {token}'}
+
+
+def test_import_accepts_the_api_token_instead_of_a_csrf_token(client):
+    response = client.post('/messages/import?mode=bogus', data='', headers=bearer(API_TOKEN))
+    assert response.status_code == 400
+    assert 'mode must be one of' in response.json['error']
+
+
+def test_import_rejects_a_wrong_api_token(client):
+    assert client.post('/messages/import', data='', headers=bearer('wrong')).status_code == 401
+
+
+def test_import_without_a_token_still_needs_csrf(client):
+    response = client.post('/messages/import', data='')
+    assert response.status_code == 400
+    assert b'CSRF' in response.data
+
+
+def test_batch_optimization_accepts_the_api_token(client):
+    response = client.post('/optimize-batch', json={'ids': [1]}, headers=bearer(API_TOKEN))
+    assert response.status_code == 400
+    assert response.json['error'] == 'No optimization request provided'
+    assert client.post('/optimize-batch', json={'ids': [1]}, headers=bearer('wrong')).status_code == 401
+    assert client.post('/optimize-batch', json={'ids': [1]}).status_code == 400
@@ -0,0 +1,51 @@
+import io
+import pytest
+from catalog import CatalogError, PromptCatalog, write_catalog
+
+
+def catalog_file(tmp_path, entries):
+    buffer = io.BytesIO()
+    write_catalog(buffer, entries)
+    path = tmp_path / 'prompts.catalog'
+    path.write_bytes(buffer.getvalue())
+    return path
+
+
+ENTRIES = [
+    {'message_id': 2, 'snapshot_id': 7, 'revision': 1, 'version_number': 1, 'prompt': '<system>two</system>',
+     'name': 'two'},
+    {'message_id': 1, 'snapshot_id': 5, 'revision': 3, 'version_number': 2, 'prompt': '<system>one</system>',
+     'name': 'one'},
+]
+
+
+def test_lookup(tmp_path):
+    with PromptCatalog(catalog_file(tmp_path, ENTRIES)) as catalog:
+        assert catalog.ids() == [1, 2]
+        assert catalog.prompt(1) == '<system>one</system>'
+        assert catalog.metadata(2)['name'] == 'two'
+        assert catalog.prompt(3) is None
+
+
+@pytest.mark.parametrize('content', [b'', b'SPCATLG', b'not a catalog at all, just text'])
+def test_empty_short_or_foreign_files_raise_catalog_error(tmp_path, content):
+    path = tmp_path / 'bad.catalog'
+    path.write_bytes(content)
+    with pytest.raises(CatalogError):
+        PromptCatalog(path)
+
+
+def test_truncated_file_raises_catalog_error(tmp_path):
+    path = catalog_file(tmp_path, ENTRIES)
+    path.write_bytes(path.read_bytes()[:-10])
+    with pytest.raises(CatalogError):
+        PromptCatalog(path)
+
+
+def test_close_requires_released_views(tmp_path):
+    catalog = PromptCatalog(catalog_file(tmp_path, ENTRIES))
+    view = catalog.prompt_bytes(1)
+    with pytest.raises(CatalogError):
+        catalog.close()
+    view.release()
+    catalog.close()
@@ -0,0 +1,28 @@
+import pytest
+from extraction import ExtractionError, check_template_fields, extract_json
+
+
+def test_object_in_fenced_block_after_prose():
+    text = 'Here you go:\n```json\n{"bio": "A {braced} bio"}\n```\nLet me know.'
+    assert extract_json(text, check_template_fields) == {'bio': 'A {braced} bio'}
+
+
+@pytest.mark.parametrize('depth', [5000, 100000])
+def test_nesting_past_the_recursion_limit_is_unparseable(depth):
+    text = '{"bio": ' + '[' * depth + ']' * depth + '}'
+    with pytest.raises(ExtractionError):
+        extract_json(text, check_template_fields)
+    with pytest.raises(ExtractionError):
+        extract_json('```json\n' + text + '\n```')
+
+
+def test_deep_response_still_yields_a_later_object():
+    text = '{"bio": ' + '[' * 5000 + ']' * 5000 + '} then {"bio": "ok"}'
+    assert extract_json(text, check_template_fields) == {'bio': 'ok'}
+
+
+def test_object_closed_before_a_failure_is_still_found():
+    # The outer span fails after the inner object has closed, so the inner one is tried
+    assert extract_json('{"x": {"bio": "ok"} oops}', check_template_fields) == {'bio': 'ok'}
+    # A nested span that runs past the failure fails there too, and the next object is found
+    assert extract_json('{"x": {"y": {"bio": "no",}} and {"bio": "ok"}', check_template_fields) == {'bio': 'ok'}
@@ -0,0 +1,23 @@
+import pytest
+from flask import Flask
+from jobs import JobQueue
+
+
+def job_queue(**config):
+    app = Flask(__name__)
+    app.config.update(JOB_BACKEND='memory', JOB_WORKERS=1, JOB_MAX_PENDING=1, JOB_RESULT_TTL=60, **config)
+    return JobQueue(app)
+
+
+def test_failed_submit_releases_its_slot():
+    queue = job_queue()
+    queue.executor.shutdown()
+    with pytest.raises(RuntimeError):
+        queue.submit('test', lambda: None)
+
+    queue.executor = job_queue().executor
+    job_id = queue.submit('test', lambda: 'done')
+    queue.executor.shutdown(wait=True)
+    assert queue.get(job_id)['status'] == 'succeeded'
+    assert queue.get(job_id)['result'] == 'done'
+
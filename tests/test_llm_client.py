@@ -0,0 +1,170 @@
+import time
+import pytest
+import requests
+from flask import Flask
+from config import load_config
+from llm_client import LLMClient, Provider, LLMError, CircuitOpenError, RateLimitedError
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = {}
+        self.text = ''
+        self._body = body or {'choices': [{'message': {'content': 'ok'}}]}
+
+    def json(self):
+        return self._body
+
+    def close(self):
+        pass
+
+
+def provider(**options):
+    options = dict({'api_key': 'test', 'max_retries': 0, 'breaker_threshold': 1, 'breaker_reset': 0.05}, **options)
+    return Provider('test', 'http://llm.invalid', **options)
+
+
+def respond(target, *results):
+    """Make target's session answer with results in turn (responses, or exceptions to raise)"""
+    results = list(results)
+
+    def post(*args, **kwargs):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    target.session.post = post
+
+
+def open_until_half_open(target):
+    respond(target, FakeResponse(503))
+    with pytest.raises(LLMError):
+        target.send({'messages': []})
+    assert target.breaker.state == 'open'
+    time.sleep(0.06)
+    assert target.breaker.state == 'half-open'
+
+
+def test_client_error_in_half_open_closes_the_breaker():
+    target = provider()
+    open_until_half_open(target)
+
+    respond(target, FakeResponse(400), FakeResponse(200))
+    with pytest.raises(LLMError) as error:
+        target.send({'messages': []})
+    assert error.value.status_code == 400
+    # The trial was resolved: the next call goes upstream instead of raising CircuitOpenError
+    assert target.breaker.state == 'closed'
+    assert target.send({'messages': []}).status_code == 200
+
+
+def test_unexpected_error_in_half_open_reopens_the_breaker():
+    target = provider()
+    open_until_half_open(target)
+
+    respond(target, requests.exceptions.InvalidURL('bad url'))
+    with pytest.raises(requests.exceptions.InvalidURL):
+        target.send({'messages': []})
+    assert target.breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        target.send({'messages': []})
+
+
+def test_retry_shed_by_the_rate_limiter_leaves_the_breaker_alone():
+    # One request a minute: the first attempt spends it, so the retry is shed locally
+    target = provider(max_retries=1, backoff_base=0.001, rate_limit_rpm=1, rate_limit_max_wait=0)
+
+    respond(target, FakeResponse(503), FakeResponse(200))
+    with pytest.raises(RateLimitedError):
+        target.send({'messages': []})
+    assert target.breaker.state == 'closed'
+
+
+def llm_client(**config):
+    app = Flask(__name__)
+    load_config(app)
+    app.config.update({'LLM_API_KEY': 'test', 'LLM_BASE_URL': 'http://llm.invalid', 'LLM_MAX_RETRIES': 0,
+                       'LLM_BACKOFF_BASE': 0.001, 'LLM_CACHE_ENABLED': True, 'LLM_CACHE_PATH': None,
+                       'LLM_HEDGE_ENABLED': False, 'LLM_PROVIDERS': {}, 'LLM_ROUTES': {}}, **config)
+    return LLMClient(app)
+
+
+def answer(content):
+    return FakeResponse(200, {'choices': [{'message': {'content': content}}]})
+
+
+def test_hedge_fires_after_the_delay_and_the_loser_stops_retrying():
+    client = llm_client(LLM_MAX_RETRIES=1, LLM_HEDGE_ENABLED=True, LLM_HEDGE_MIN_SAMPLES=1,
+                        LLM_HEDGE_MIN_DELAY=0.05)
+    target = client.targets('default')[0]
+    target.latency.add(0.05)
+    sent = []
+
+    def post(*args, **kwargs):
+        sent.append(time.monotonic())
+        if len(sent) == 1:
+            # The first request is slow and then fails, so left alone it would retry
+            time.sleep(0.3)
+            return FakeResponse(503)
+        return answer('hedged')
+
+    target.provider.session.post = post
+    started = time.monotonic()
+    assert client.chat([{'role': 'user', 'content': 'hi'}]) == 'hedged'
+    assert len(sent) == 2
+    assert sent[1] - started >= 0.05
+    time.sleep(0.4)
+    assert len(sent) == 2
+    assert target.provider.breaker.state == 'closed'
+
+
+def fallback_client():
+    return llm_client(LLM_PROVIDERS={'backup': {'base_url': 'http://backup.invalid', 'model': 'backup-model'}},
+                      LLM_ROUTES={'optimize': ['default', 'backup']})
+
+
+def test_fallback_on_server_error_is_not_cached():
+    client = fallback_client()
+    primary, backup = client.targets('optimize')
+    respond(primary.provider, FakeResponse(503), answer('primary'))
+    respond(backup.provider, answer('backup'))
+    messages = [{'role': 'user', 'content': 'hi'}]
+
+    assert client.chat(messages, route='optimize') == 'backup'
+    # The primary has recovered and is asked again rather than the fallback's answer being replayed
+    assert client.chat(messages, route='optimize') == 'primary'
+    assert client.chat(messages, route='optimize') == 'primary'
+
+
+def test_fallback_when_the_breaker_is_open():
+    client = fallback_client()
+    primary, backup = client.targets('optimize')
+    for _ in range(primary.provider.breaker.failure_threshold):
+        primary.provider.breaker.record_failure()
+
+    def unreachable(*args, **kwargs):
+        raise AssertionError('an open breaker must not send upstream')
+
+    primary.provider.session.post = unreachable
+    respond(backup.provider, answer('backup'))
+    assert client.chat([{'role': 'user', 'content': 'hi'}], route='optimize') == 'backup'
+
+
+class NotJSON(FakeResponse):
+    def json(self):
+        raise ValueError('Expecting value')
+
+
+def test_invalid_json_body_counts_once_as_a_failure():
+    target = provider(breaker_threshold=2)
+    respond(target, NotJSON(200), NotJSON(200))
+    with pytest.raises(LLMError, match='invalid JSON'):
+        target.post({'messages': []})
+    # One failure, not a success and a failure: the breaker is still closed
+    assert target.breaker.state == 'closed'
+    with pytest.raises(LLMError, match='invalid JSON'):
+        target.post({'messages': []})
+    assert target.breaker.state == 'open'
@@ -0,0 +1,64 @@
+from flask import Flask
+from similarity import SimilarityIndex
+
+TEMPLATES = {
+    1: {'bio': 'A friendly support agent for billing questions', 'rules': ['Be polite'], 'instructions': []},
+    2: {'bio': 'A friendly support agent for billing questions', 'rules': ['Be polite'], 'instructions': []},
+    3: {'bio': 'A pirate who tells sea shanties', 'rules': ['Speak like a pirate'], 'instructions': []},
+}
+
+
+def similarity_index():
+    app = Flask(__name__)
+    app.config.update(SIMILARITY_DIMENSIONS=256, SIMILARITY_REBUILD_FRACTION=0.25)
+    return SimilarityIndex(app)
+
+
+def build(index, load):
+    index.refresh(load)
+    index._builder.join()
+    assert index.refresh(load)
+
+
+def test_changes_made_during_a_build_are_replayed():
+    index = similarity_index()
+    edited = dict(TEMPLATES[3], bio=TEMPLATES[1]['bio'], rules=TEMPLATES[1]['rules'])
+
+    def load():
+        for id, content in TEMPLATES.items():
+            yield id, id, content
+        # Committed after these rows were read, before the new matrix is swapped in
+        index.update(3, 3, edited)
+        index.update(4, 4, TEMPLATES[1])
+        index.remove(2)
+
+    build(index, load)
+    assert index.stats()['templates'] == 3
+    assert index.similar(2) is None
+    assert {id for id, score, _ in index.similar(1) if score > 0.99} == {3, 4}
+
+
+def test_rebuild_replays_onto_the_new_matrix():
+    index = similarity_index()
+    build(index, lambda: ((id, id, content) for id, content in TEMPLATES.items()))
+
+    def load():
+        yield from ((id, id, content) for id, content in TEMPLATES.items() if id != 3)
+        index.remove(1)
+
+    index.invalidate()
+    build(index, load)
+    assert index.similar(1) is None
+    assert [id for id, _, _ in index.similar(2)] == []
+
+
+def test_duplicate_report_is_cached_until_the_index_changes():
+    index = similarity_index()
+    build(index, lambda: ((id, id, content) for id, content in TEMPLATES.items()))
+
+    groups = index.duplicate_groups(0.9)
+    assert [group['ids'] for group in groups] == [[1, 2]]
+    assert index.duplicate_groups(0.9) is groups
+
+    index.update(3, 3, TEMPLATES[1])
+    assert [group['ids'] for group in index.duplicate_groups(0.9)] == [[1, 2, 3]]
@@ -0,0 +1,50 @@
+import os
+import threading
+import pytest
+
+pytestmark = pytest.mark.skipif(not os.environ.get('DATABASE_URL'), reason='needs a PostgreSQL DATABASE_URL')
+
+
+@pytest.fixture
+def app():
+    import app as application
+    return application.create_app({'WTF_CSRF_ENABLED': False, 'SCHEMA_AUTO_UPGRADE': True})
+
+
+def test_concurrent_copies_get_unique_gap_free_versions(app):
+    from extensions import db
+    from models import Message, lineage_ids
+
+    with app.app_context():
+        original = Message(name='concurrency', bio='bio', voice_style='calm', persona={}, rules=[],
+                           instructions=[], example_dialogue=[], version_number=1)
+        db.session.add(original)
+        db.session.commit()
+        root_id = original.id
+
+    copies = 8
+    barrier = threading.Barrier(copies)
+    statuses = []
+
+    def copy():
+        client = app.test_client()
+        barrier.wait()
+        statuses.append(client.post(f'/messages/{root_id}/copy').status_code)
+
+    threads = [threading.Thread(target=copy) for _ in range(copies)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    try:
+        assert statuses == [302] * copies
+        with app.app_context():
+            versions = sorted(db.session.execute(
+                db.select(Message.version_number).where(Message.id.in_(lineage_ids(root_id)))).scalars())
+            assert versions == list(range(1, copies + 2))
+    finally:
+        with app.app_context():
+            db.session.execute(db.update(Message).where(Message.original_id == root_id).values(original_id=None))
+            db.session.execute(db.delete(Message).where(Message.id.in_(lineage_ids(root_id))))
+            db.session.commit()
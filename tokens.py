@@ -0,0 +1,8 @@
+"""Local token estimates for prompt budgets and rate limits, without a tokenizer"""
+
+# Rough characters-per-token ratio for English prose
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
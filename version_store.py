@@ -0,0 +1,179 @@
+import copy
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Template content covered by delta encoding, and what a delta-stored row keeps
+# in those columns (they are NOT NULL)
+CONTENT_FIELDS = ('bio', 'voice_style', 'persona', 'rules', 'instructions', 'example_dialogue')
+PLACEHOLDERS = {'bio': '', 'voice_style': '', 'persona': {}, 'rules': [], 'instructions': [], 'example_dialogue': []}
+
+
+class DeltaBaseMismatch(Exception):
+    """A delta's base version no longer holds the content the delta was encoded against"""
+
+
+def content_digest(content):
+    """Stable SHA-256 of template content, recorded in each delta to verify its base on decode"""
+    encoded = json.dumps(content, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def _escape(token):
+    return str(token).replace('~', '~0').replace('/', '~1')
+
+
+def _unescape(token):
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+def json_diff(old, new, path=''):
+    """RFC 6902 JSON Patch operations that turn old into new.
+
+    Lists are compared after trimming their common prefix and suffix, so a
+    single inserted or removed item costs one operation.
+    """
+    if type(old) is type(new) and old == new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = [{'op': 'remove', 'path': f'{path}/{_escape(key)}'} for key in old if key not in new]
+        for key, value in new.items():
+            if key in old:
+                ops.extend(json_diff(old[key], value, f'{path}/{_escape(key)}'))
+            else:
+                ops.append({'op': 'add', 'path': f'{path}/{_escape(key)}', 'value': value})
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        start = 0
+        while start < len(old) and start < len(new) and type(old[start]) is type(new[start]) and old[start] == new[start]:
+            start += 1
+        end_old, end_new = len(old), len(new)
+        while (end_old > start and end_new > start and type(old[end_old - 1]) is type(new[end_new - 1])
+               and old[end_old - 1] == new[end_new - 1]):
+            end_old -= 1
+            end_new -= 1
+        common = min(end_old - start, end_new - start)
+        ops = []
+        for offset in range(common):
+            ops.extend(json_diff(old[start + offset], new[start + offset], f'{path}/{start + offset}'))
+        # Remove surplus items from the back so earlier indexes stay valid
+        for index in range(end_old - 1, start + common - 1, -1):
+            ops.append({'op': 'remove', 'path': f'{path}/{index}'})
+        for index in range(start + common, end_new):
+            ops.append({'op': 'add', 'path': f'{path}/{index}', 'value': new[index]})
+        return ops
+    return [{'op': 'replace', 'path': path, 'value': new}]
+
+
+def apply_patch(document, ops):
+    """Apply add/remove/replace operations to a copy of document; raises ValueError"""
+    document = copy.deepcopy(document)
+    for op in ops:
+        path, kind = op.get('path', ''), op.get('op')
+        if kind not in ('add', 'remove', 'replace'):
+            raise ValueError(f'Unsupported patch operation: {kind}')
+        if path == '':
+            if kind == 'remove':
+                raise ValueError('Cannot remove the document root')
+            document = copy.deepcopy(op['value'])
+            continue
+        tokens = [_unescape(token) for token in path.split('/')[1:]]
+        parent = document
+        try:
+            for token in tokens[:-1]:
+                parent = parent[int(token)] if isinstance(parent, list) else parent[token]
+            last = tokens[-1]
+            if isinstance(parent, list):
+                index = len(parent) if last == '-' else int(last)
+                if kind == 'add':
+                    if index > len(parent):
+                        raise IndexError(index)
+                    parent.insert(index, copy.deepcopy(op['value']))
+                elif kind == 'remove':
+                    del parent[index]
+                else:
+                    parent[index] = copy.deepcopy(op['value'])
+            else:
+                if kind == 'remove':
+                    del parent[last]
+                else:
+                    if kind == 'replace' and last not in parent:
+                        raise KeyError(last)
+                    parent[last] = copy.deepcopy(op['value'])
+        except (KeyError, IndexError, ValueError, TypeError) as e:
+            raise ValueError(f'Patch path {path} does not apply: {e}')
+    return document
+
+
+def encoded_size(value):
+    return len(json.dumps(value, separators=(',', ':')))
+
+
+def plan_lineage(versions, interval):
+    """Decide how each version of a lineage is stored.
+
+    versions is a list of (id, content) ordered oldest first. Every interval-th
+    version and the newest one are kept in full; the rest become a patch
+    against the nearest full version before them, unless the patch is not
+    actually smaller. Returns {id: None} for full rows or {id: (base_id, ops)}.
+    """
+    plan = {}
+    base_id = base_content = None
+    for position, (id, content) in enumerate(versions):
+        if position % interval == 0 or position == len(versions) - 1 or base_id is None:
+            plan[id] = None
+            base_id, base_content = id, content
+            continue
+        ops = json_diff(base_content, content)
+        if encoded_size(ops) < encoded_size(content):
+            plan[id] = (base_id, ops)
+        else:
+            plan[id] = None
+            base_id, base_content = id, content
+    return plan
+
+
+class VersionStore:
+    """Optional delta encoding of version lineages.
+
+    With ``VERSION_STORAGE=delta`` older versions in a lineage are stored as a
+    JSON Patch against a periodic full version (every
+    ``VERSION_KEYFRAME_INTERVAL``-th, plus the newest). Full base content is
+    cached by (id, updated_at), so rebuilding a version is one patch
+    application. Delta-stored rows are always decoded on load, whatever the
+    configured mode.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config["VERSION_STORAGE"] == 'delta'
+        self.interval = max(2, app.config["VERSION_KEYFRAME_INTERVAL"])
+        self.max_entries = app.config["VERSION_CACHE_SIZE"]
+        self._bases = OrderedDict()
+        self._lock = threading.Lock()
+        app.extensions['version_store'] = self
+
+    def cached_base(self, key):
+        with self._lock:
+            content = self._bases.get(key)
+            if content is not None:
+                self._bases.move_to_end(key)
+            return content
+
+    def remember_base(self, key, content):
+        with self._lock:
+            self._bases[key] = content
+            self._bases.move_to_end(key)
+            while len(self._bases) > self.max_entries:
+                self._bases.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._bases.clear()